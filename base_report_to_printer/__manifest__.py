@@ -22,6 +22,7 @@
         "views/printing_printer.xml",
         "views/printing_server.xml",
         "views/printing_job.xml",
+        "views/printing_spool_job.xml",
         "views/printing_report.xml",
         "views/res_users.xml",
         "views/ir_actions_report.xml",
@@ -4,5 +4,7 @@ from . import printing_job
 from . import printing_printer
 from . import printing_server
 from . import printing_report_xml_action
+from . import printing_spool_job
 from . import printing_tray
 from . import res_users
+from . import printing_batch
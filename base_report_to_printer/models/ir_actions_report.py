@@ -4,12 +4,64 @@
 # Copyright (C) 2011 Domsense srl (<http://www.domsense.com>)
 # Copyright (C) 2013-2014 Camptocamp (<http://www.camptocamp.com>)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+import json
+import threading
+from collections import OrderedDict
 from time import time
 
-from odoo import _, api, exceptions, fields, models
+from psycopg2 import sql
+
+from odoo import _, api, exceptions, fields, models, tools
 from odoo.tools.safe_eval import safe_eval
 
 REPORT_TYPES = {"qweb-pdf": "pdf", "qweb-text": "text"}
+# Fields of the reports used to compute the print behaviour
+BEHAVIOUR_FIELDS = {
+    "property_printing_action_id",
+    "printing_printer_id",
+    "printer_tray_id",
+}
+# Total size of the rendered documents kept in memory, in bytes
+RENDER_CACHE_SIZE = 64 * 1024 * 1024
+
+
+class RenderCache(object):
+    """Keep the last rendered documents, up to a total size in bytes"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._documents = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            document = self._documents.get(key)
+            if document is not None:
+                self._documents.move_to_end(key)
+            return document
+
+    def set(self, key, document):
+        size = len(document[0])
+        if size > self.max_size:
+            return
+        with self._lock:
+            previous = self._documents.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[0])
+            self._documents[key] = document
+            self.size += size
+            while self.size > self.max_size:
+                __, previous = self._documents.popitem(last=False)
+                self.size -= len(previous[0])
+
+    def clear(self):
+        with self._lock:
+            self._documents.clear()
+            self.size = 0
+
+
+_render_cache = RenderCache(RENDER_CACHE_SIZE)
 
 
 class IrActionsReport(models.Model):
@@ -34,6 +86,13 @@ class IrActionsReport(models.Model):
         string="Actions",
         help="This field allows configuring action and printer on a per " "user basis",
     )
+    printing_render_cache = fields.Boolean(
+        string="Cache Printed Documents",
+        help="Keep the documents sent to the printers in memory, and print "
+        "them again without rendering them when the same records are printed "
+        "and they were not modified since. Only the modifications of the "
+        "printed records are detected, not the ones of their lines.",
+    )
 
     @api.onchange("printing_printer_id")
     def onchange_printing_printer_id(self):
@@ -56,6 +115,28 @@ class IrActionsReport(models.Model):
         }
         return serializable_result
 
+    def print_document_from_client(self, record_ids, data=None):
+        """Print the document if the report is sent to the printer
+
+        Called from js, so that a document is printed in a single call.
+        The client downloads the document when the returned action is not
+        ``server``, and shows the ``error`` when the document could not be
+        sent to the printer.
+        """
+        self.ensure_one()
+        behaviour = self.behaviour()
+        result = {
+            "action": behaviour["action"],
+            "printer_name": behaviour["printer"].name,
+        }
+        if behaviour["action"] == "server":
+            try:
+                with self.env.cr.savepoint():
+                    self.print_document(record_ids, data=data)
+            except exceptions.UserError as exc:
+                result["error"] = exc.args[0]
+        return result
+
     def _get_user_default_print_behaviour(self):
         printer_obj = self.env["printing.printer"]
         user = self.env.user
@@ -78,7 +159,42 @@ class IrActionsReport(models.Model):
             result["tray"] = self.printer_tray_id.system_name
         return result
 
+    def _get_behaviour_cache_key(self):
+        """Return the values, other than the report and the user, which the
+        print behaviour depends on
+
+        Override to add the context keys or the request values used by the
+        print behaviour of the report.
+        """
+        return (self.env.company.id,)
+
     def behaviour(self):
+        """Return the print behaviour of the report for the current user
+
+        The behaviour is computed once, then cached until the printing
+        settings of the reports, the users or the printers change.
+        """
+        self.ensure_one()
+        values, records = self._get_cached_behaviour(self._get_behaviour_cache_key())
+        result = dict(values)
+        for key, (model, ids) in records.items():
+            result[key] = self.env[model].browse(ids)
+        return result
+
+    @tools.ormcache("self.id", "self.env.uid", "cache_key")
+    def _get_cached_behaviour(self, cache_key):
+        """Return the print behaviour without records, which cannot be cached,
+        as a dict of values and a dict of ``(model, ids)``"""
+        values = {}
+        records = {}
+        for key, value in self._compute_behaviour().items():
+            if isinstance(value, models.BaseModel):
+                records[key] = (value._name, tuple(value.ids))
+            else:
+                values[key] = value
+        return values, records
+
+    def _compute_behaviour(self):
         self.ensure_one()
         printing_act_obj = self.env["printing.report.xml.action"]
 
@@ -100,6 +216,13 @@ class IrActionsReport(models.Model):
             result.update({k: v for k, v in print_action.behaviour().items() if v})
         return result
 
+    def write(self, vals):
+        res = super().write(vals)
+        if BEHAVIOUR_FIELDS.intersection(vals):
+            # Drop the cached print behaviours
+            self.clear_caches()
+        return res
+
     def print_document(self, record_ids, data=None):
         """Print a document, do not return the document file"""
         report_type = REPORT_TYPES.get(self.report_type)
@@ -108,31 +231,80 @@ class IrActionsReport(models.Model):
                 _("This report type (%s) is not supported by direct printing!")
                 % str(self.report_type)
             )
-        method_name = "_render_qweb_%s" % (report_type)
-        document, doc_format = getattr(
-            self.with_context(must_skip_send_to_printer=True), method_name
-        )(record_ids, data=data)
+        document, doc_format = self._render_document(report_type, record_ids, data)
         behaviour = self.behaviour()
         printer = behaviour.pop("printer", None)
 
         if not printer:
             raise exceptions.UserError(_("No printer configured to print this report."))
-        if self.print_report_name:
-            report_file_names = [
-                safe_eval(self.print_report_name, {"object": obj, "time": time})
-                for obj in self.env[self.model].browse(record_ids)
-            ]
-            title = " ".join(report_file_names)
-            if len(title) > 80:
-                title = title[:80] + "…"
-        else:
-            title = self.report_name
-        behaviour["title"] = title
+        behaviour["title"] = self._get_print_document_title(record_ids)
         # TODO should we use doc_format instead of report_type
         return printer.print_document(
             self, document, doc_format=self.report_type, **behaviour
         )
 
+    def _get_print_document_title(self, record_ids):
+        self.ensure_one()
+        if not self.print_report_name:
+            return self.report_name
+        report_file_names = [
+            safe_eval(self.print_report_name, {"object": obj, "time": time})
+            for obj in self.env[self.model].browse(record_ids)
+        ]
+        title = " ".join(report_file_names)
+        if len(title) > 80:
+            title = title[:80] + "…"
+        return title
+
+    def _render_document(self, report_type, record_ids, data=None):
+        """Render the document to print, or take it from the render cache"""
+        method_name = "_render_qweb_%s" % (report_type)
+        render = getattr(self.with_context(must_skip_send_to_printer=True), method_name)
+        key = self._get_render_cache_key(record_ids, data)
+        if not key:
+            return render(record_ids, data=data)
+        document = _render_cache.get(key)
+        if document is None:
+            document = render(record_ids, data=data)
+            _render_cache.set(key, document)
+        return document
+
+    def _get_render_cache_key(self, record_ids, data=None):
+        """Return the key of the document in the render cache
+
+        The key changes when the report or the printed records are modified.
+        Returns None when the document cannot be cached.
+        """
+        self.ensure_one()
+        if not self.printing_render_cache or not record_ids:
+            return None
+        records = self.env[self.model].browse(record_ids)
+        if not records._log_access:
+            return None
+        try:
+            data_key = json.dumps(data or {}, sort_keys=True)
+        except TypeError:
+            return None
+        # The write dates are read from the database to keep their
+        # microseconds, which tell apart two modifications in a second
+        records.flush(["write_date"])
+        query = sql.SQL("SELECT id, write_date FROM {} WHERE id IN %s ORDER BY id")
+        self.env.cr.execute(
+            query.format(sql.Identifier(records._table)), (tuple(records.ids),)
+        )
+        fingerprint = tuple(self.env.cr.fetchall())
+        return (
+            self.env.cr.dbname,
+            self.id,
+            self.write_date,
+            self.env.uid,
+            self.env.company.id,
+            self.env.context.get("lang"),
+            tuple(records.ids),
+            fingerprint,
+            data_key,
+        )
+
     def _can_print_report(self, behaviour, printer, document):
         """Predicate that decide if report can be sent to printer
 
@@ -158,6 +330,8 @@ class IrActionsReport(models.Model):
         generated document as well.
         """
         document, doc_format = super()._render_qweb_pdf(res_ids=res_ids, data=data)
+        if self.env.context.get("must_skip_send_to_printer"):
+            return document, doc_format
 
         behaviour = self.behaviour()
         printer = behaviour.pop("printer", None)
@@ -177,6 +351,8 @@ class IrActionsReport(models.Model):
         generated document as well.
         """
         document, doc_format = super()._render_qweb_text(docids=docids, data=data)
+        if self.env.context.get("must_skip_send_to_printer"):
+            return document, doc_format
 
         behaviour = self.behaviour()
         printer = behaviour.pop("printer", None)
@@ -24,3 +24,15 @@ class PrintingAction(models.Model):
     action_type = fields.Selection(
         selection=_available_action_types, string="Type", required=True
     )
+
+    def write(self, vals):
+        res = super().write(vals)
+        if "action_type" in vals:
+            # Drop the cached print behaviours
+            self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.clear_caches()
+        return res
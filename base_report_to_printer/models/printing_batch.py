@@ -0,0 +1,97 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import logging
+from collections import OrderedDict
+
+from odoo import _, api, exceptions, models
+
+from .ir_actions_report import REPORT_TYPES
+
+_logger = logging.getLogger(__name__)
+
+
+class PrintingBatch(models.AbstractModel):
+    _name = "printing.batch"
+    _description = "Printing Batch"
+
+    @api.model
+    def print_batch(self, items):
+        """Print many reports on many records in a single call
+
+        The documents are rendered one item after the other, then sent to
+        their printers, each printer receiving all its documents through a
+        single connection. A failing item does not prevent the other ones
+        from being printed.
+
+        :param items: list of ``(report, record_ids, options)``, where the
+            report is a record, an id or a report name, and the optional
+            options hold the ``data`` given to the report, the ``printer``
+            id to use instead of the configured one, and the printing
+            options (``copies``, ``tray``...)
+        :return: list of dicts, in the order of the items, with ``success``,
+            the ``printer_id`` and the ``error`` message of each item
+        """
+        results = []
+        documents_by_printer = OrderedDict()
+        for item in items:
+            result = {"success": False, "printer_id": False, "error": False}
+            results.append(result)
+            try:
+                with self.env.cr.savepoint():
+                    printer, document = self._prepare_batch_document(*item)
+            except Exception as exc:
+                _logger.warning("Failed to render a batch document", exc_info=True)
+                result["error"] = str(exc)
+                continue
+            result["printer_id"] = printer.id
+            documents_by_printer.setdefault(printer, []).append((result, document))
+
+        for printer, printer_documents in documents_by_printer.items():
+            errors = printer.print_documents(
+                [document for __, document in printer_documents]
+            )
+            for (result, __), error in zip(printer_documents, errors):
+                result["success"] = not error
+                result["error"] = error
+        return results
+
+    @api.model
+    def _get_batch_report(self, report):
+        report_obj = self.env["ir.actions.report"]
+        if isinstance(report, models.BaseModel):
+            return report
+        if isinstance(report, int):
+            return report_obj.browse(report).exists()
+        return report_obj._get_report_from_name(report)
+
+    @api.model
+    def _prepare_batch_document(self, report, record_ids, options=None):
+        """Render the document of a batch item
+
+        :return: the printer and the ``(report, content, print_opts)`` to
+            send to the printer
+        """
+        options = dict(options or {})
+        report = self._get_batch_report(report)
+        if not report:
+            raise exceptions.UserError(_("The report to print does not exist."))
+        report_type = REPORT_TYPES.get(report.report_type)
+        if not report_type:
+            raise exceptions.UserError(
+                _("This report type (%s) is not supported by direct printing!")
+                % str(report.report_type)
+            )
+        data = options.pop("data", None)
+        printer_id = options.pop("printer", False)
+        content, __ = report._render_document(report_type, record_ids, data)
+
+        behaviour = report.behaviour()
+        printer = behaviour.pop("printer", None)
+        if printer_id:
+            printer = self.env["printing.printer"].browse(printer_id)
+        if not printer:
+            raise exceptions.UserError(_("No printer configured to print this report."))
+        behaviour["title"] = report._get_print_document_title(record_ids)
+        behaviour.update(options)
+        behaviour["doc_format"] = report.report_type
+        return printer, (report, content, behaviour)
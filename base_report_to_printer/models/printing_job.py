@@ -3,10 +3,14 @@
 
 import logging
 
-from odoo import fields, models
+from odoo import api, fields, models, tools
+from odoo.tools import split_every
 
 _logger = logging.getLogger(__name__)
 
+# Number of jobs removed per transaction by the retention cleanup
+JOB_GC_CHUNK_SIZE = 1000
+
 
 class PrintingJob(models.Model):
     _name = "printing.job"
@@ -109,19 +113,56 @@ class PrintingJob(models.Model):
         )
     ]
 
+    def init(self):
+        # Lookup of the jobs of a server, used by the synchronization
+        tools.create_index(
+            self.env.cr,
+            "printing_job_server_id_job_id_cups_index",
+            self._table,
+            ["server_id", "job_id_cups"],
+        )
+        # Latest jobs of a printer, used by the list views and the retention
+        tools.create_index(
+            self.env.cr,
+            "printing_job_printer_id_time_at_creation_index",
+            self._table,
+            ["printer_id", "time_at_creation"],
+        )
+
     def action_cancel(self):
         self.ensure_one()
         return self.cancel()
 
     def cancel(self, purge_job=False):
         for job in self:
-            connection = job.server_id._open_connection()
-            if not connection:
-                continue
+            with job.server_id._cups_connection() as connection:
+                if not connection:
+                    continue
 
-            connection.cancelJob(job.job_id_cups, purge_job=purge_job)
+                connection.cancelJob(job.job_id_cups, purge_job=purge_job)
 
         # Update jobs' states info Odoo
         self.mapped("server_id").update_jobs(which="all", first_job_id=job.job_id_cups)
 
         return True
+
+    @api.model
+    def _gc_jobs(self):
+        """Remove the archived jobs exceeding the retention of their server
+
+        The jobs are removed in chunks, each one in its own transaction, so
+        that the table is not locked for long.
+        """
+        for server in self.env["printing.server"].search([]):
+            job_ids = server._get_expired_job_ids()
+            for job_ids_chunk in split_every(JOB_GC_CHUNK_SIZE, job_ids):
+                self.with_context(active_test=False).browse(job_ids_chunk).unlink()
+                if not self.env.registry.in_test_mode():
+                    self.env.cr.commit()  # pylint: disable=invalid-commit
+            if job_ids:
+                _logger.info(
+                    "Removed %s printing jobs of the server %s",
+                    len(job_ids),
+                    server.name,
+                )
+        return True
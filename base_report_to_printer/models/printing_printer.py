@@ -7,11 +7,16 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 import errno
+import hashlib
 import logging
 import os
+import select
+import socket
+import threading
+import time
 from tempfile import mkstemp
 
-from odoo import fields, models
+from odoo import _, api, exceptions, fields, models
 
 _logger = logging.getLogger(__name__)
 
@@ -20,6 +25,129 @@ try:
 except ImportError:
     _logger.debug("Cannot `import cups`.")
 
+# Size of the chunks of data sent to CUPS when submitting a document
+PRINT_CHUNK_SIZE = 64 * 1024
+# Status of the printers by CUPS printer-state
+PRINTER_STATES = {3: "available", 4: "printing", 5: "error"}
+
+# Zebra host status flags, as (string index, field index, message)
+HOST_STATUS_ERRORS = [
+    (0, 1, "paper out"),
+    (0, 2, "paused"),
+    (1, 2, "head open"),
+    (1, 3, "ribbon out"),
+]
+
+
+class RawSocketPool(object):
+    """Process-wide pool of idle sockets opened to raw printers
+
+    Most printers accept a single connection at a time on their raw port,
+    so a socket is only kept open ``idle_timeout`` seconds after its last
+    use, to chain the jobs sent in a short time without blocking the other
+    clients of the printer. The sockets idle for too long are closed by the
+    next use of the pool, whatever their printer.
+    """
+
+    def __init__(self, idle_timeout=5):
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def acquire(self, address, timeout):
+        """Check out a socket connected to ``address``, a (host, port) tuple"""
+        with self._lock:
+            expired = self._pop_expired()
+            entry = self._idle.pop(address, None)
+        self._close(expired)
+        if entry and self._check(entry[0]):
+            sock = entry[0]
+            sock.settimeout(timeout)
+            return sock
+        if entry:
+            entry[0].close()
+        return socket.create_connection(address, timeout=timeout)
+
+    @staticmethod
+    def _check(sock):
+        """Check that the printer did not close an idle socket
+
+        A closed socket is readable, while a printer never sends data on its
+        own.
+        """
+        try:
+            readable = select.select([sock], [], [], 0)[0]
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def release(self, address, sock):
+        """Give back a socket checked out with :meth:`acquire`
+
+        Sockets which failed must be closed by the caller instead.
+        """
+        with self._lock:
+            expired = self._pop_expired()
+            previous = self._idle.pop(address, None)
+            self._idle[address] = (sock, time.monotonic())
+        if previous:
+            expired.append(previous[0])
+        self._close(expired)
+
+    def _pop_expired(self):
+        """Remove the sockets idle for too long, the lock being held
+
+        :return: the removed sockets, to close once the lock is released
+        """
+        limit = time.monotonic() - self.idle_timeout
+        expired = [
+            address
+            for address, (__, released) in self._idle.items()
+            if released < limit
+        ]
+        return [self._idle.pop(address)[0] for address in expired]
+
+    @staticmethod
+    def _close(sockets):
+        for sock in sockets:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+
+_raw_socket_pool = RawSocketPool()
+
+
+def _read_host_status(sock):
+    """Return the answer of the printer to a host status request (~HS)
+
+    The answer is made of three strings framed by STX and ETX characters.
+    """
+    sock.sendall(b"~HS")
+    data = b""
+    while data.count(b"\x03") < 3:
+        chunk = sock.recv(1024)
+        if not chunk:
+            break
+        data += chunk
+    return [
+        part.split(b"\x02")[-1].decode("ascii", "replace").split(",")
+        for part in data.split(b"\x03")[:3]
+    ]
+
+
+def _get_host_status_errors(host_status):
+    errors = []
+    for string_index, field_index, message in HOST_STATUS_ERRORS:
+        try:
+            flag = host_status[string_index][field_index]
+        except IndexError:
+            continue
+        if flag.strip() == "1":
+            errors.append(message)
+    return errors
+
 
 class PrintingPrinter(models.Model):
     """
@@ -66,15 +194,68 @@ class PrintingPrinter(models.Model):
     tray_ids = fields.One2many(
         comodel_name="printing.tray", inverse_name="printer_id", string="Paper Sources"
     )
+    cups_attributes_hash = fields.Char(
+        readonly=True,
+        copy=False,
+        help="Hash of the CUPS attributes of the printer at the last refresh, "
+        "used to skip the refresh of unchanged printers.",
+    )
+    spool = fields.Boolean(
+        string="Spool Documents",
+        help="If checked, the documents are queued and sent to this printer "
+        "in the background, with retries when it cannot be reached, so that "
+        "printing does not wait for the CUPS server.",
+    )
+    spool_job_ids = fields.One2many(
+        comodel_name="printing.spool.job",
+        inverse_name="printer_id",
+        string="Spooled Jobs",
+    )
+    raw_transport = fields.Selection(
+        selection=[("cups", "CUPS"), ("socket", "Direct Socket")],
+        required=True,
+        default="cups",
+        help="Transport of the raw documents, like ZPL labels. Direct Socket "
+        "sends them straight to the printer on its raw port (AppSocket / "
+        "JetDirect), without the CUPS queue. The other documents are "
+        "always printed through CUPS.",
+    )
+    raw_host = fields.Char(
+        string="Printer Host", help="Host name or IP address of the printer."
+    )
+    raw_port = fields.Integer(
+        string="Printer Port", default=9100, help="Raw port of the printer."
+    )
+    raw_timeout = fields.Float(
+        string="Timeout",
+        default=10.0,
+        help="Number of seconds to wait for the printer when sending a document.",
+    )
+    raw_status_check = fields.Boolean(
+        string="Check Printer Status",
+        help="Ask the status of the printer (~HS command, for Zebra printers) "
+        "before sending a document, and refuse to print when the printer "
+        "is paused, or out of paper or ribbon.",
+    )
+    ppd_modtime = fields.Integer(
+        string="PPD Modification Time",
+        readonly=True,
+        copy=False,
+        help="Modification time of the PPD file the paper sources were read "
+        "from. The PPD file is only downloaded again when it changed on CUPS.",
+    )
+
+    @staticmethod
+    def _get_cups_attributes_hash(cups_printer):
+        return hashlib.sha1(repr(sorted(cups_printer.items())).encode()).hexdigest()
 
     def _prepare_update_from_cups(self, cups_connection, cups_printer):
-        mapping = {3: "available", 4: "printing", 5: "error"}
         cups_vals = {
             "name": cups_printer["printer-info"],
             "model": cups_printer.get("printer-make-and-model", False),
             "location": cups_printer.get("printer-location", False),
             "uri": cups_printer.get("device-uri", False),
-            "status": mapping.get(cups_printer.get("printer-state"), "unknown"),
+            "status": PRINTER_STATES.get(cups_printer.get("printer-state"), "unknown"),
             "status_message": cups_printer.get("printer-state-message", ""),
         }
 
@@ -87,8 +268,14 @@ class PrintingPrinter(models.Model):
 
         printer_uri = cups_printer["printer-uri-supported"]
         printer_system_name = printer_uri[printer_uri.rfind("/") + 1 :]
-        ppd_info = cups_connection.getPPD3(printer_system_name)
-        ppd_path = ppd_info[2]
+        # Only download the PPD file if it changed since the trays were read
+        status, ppd_modtime, ppd_path = cups_connection.getPPD3(
+            printer_system_name, modtime=self.ppd_modtime or 0
+        )
+        if status == cups.HTTP_NOT_MODIFIED:
+            return vals
+        if ppd_modtime != self.ppd_modtime:
+            vals["ppd_modtime"] = ppd_modtime
         if not ppd_path:
             return vals
 
@@ -110,11 +297,12 @@ class PrintingPrinter(models.Model):
         }
 
         # Add new trays
+        known_trays = set(self.tray_ids.mapped("system_name"))
         tray_commands.extend(
             [
                 (0, 0, {"name": text, "system_name": choice})
                 for choice, text in cups_trays.items()
-                if choice not in self.tray_ids.mapped("system_name")
+                if choice not in known_trays
             ]
         )
 
@@ -123,7 +311,7 @@ class PrintingPrinter(models.Model):
             [
                 (2, tray.id)
                 for tray in self.tray_ids.filtered(
-                    lambda record: record.system_name not in cups_trays.keys()
+                    lambda record: record.system_name not in cups_trays
                 )
             ]
         )
@@ -132,18 +320,186 @@ class PrintingPrinter(models.Model):
         return vals
 
     def print_document(self, report, content, **print_opts):
-        """Print a file
+        """Print a document
         Format could be pdf, qweb-pdf, raw, ...
+
+        The content, given as ``bytes``, a ``memoryview`` or an iterable of
+        chunks of bytes, is streamed to CUPS without temporary file. It is
+        queued instead when the printer spools its documents, and raw
+        documents are sent straight to the printers using a direct socket.
+        """
+        self.ensure_one()
+        if self.spool and not self.env.context.get("printing_spool_dispatch"):
+            self.env["printing.spool.job"]._enqueue(self, report, content, **print_opts)
+            return True
+        doc_format = print_opts.get("doc_format") or print_opts.get("format")
+        if doc_format == "raw" and self.raw_transport == "socket":
+            return self._send_raw_document(content, **print_opts)
+        with self.server_id._cups_connection(raise_on_error=True) as connection:
+            if hasattr(connection, "createJob"):
+                return self._submit_document(connection, report, content, **print_opts)
+        # Streaming is not supported by older pycups versions
+        return self._print_document_from_file(report, content, **print_opts)
+
+    def print_documents(self, documents):
+        """Print several documents, through a single connection to CUPS
+
+        A new connection is only opened when a document failed to be sent.
+        When the server cannot be reached, the remaining documents all fail
+        with the connection error.
+
+        :param documents: list of ``(report, content, print_opts)``
+        :return: list of the error messages, ``False`` for the documents
+            which were printed
         """
         self.ensure_one()
+        errors = [False] * len(documents)
+        cups_indexes = []
+        for index, (report, content, print_opts) in enumerate(documents):
+            if self._is_sent_to_cups(print_opts):
+                cups_indexes.append(index)
+                continue
+            try:
+                with self.env.cr.savepoint():
+                    self.print_document(report, content, **print_opts)
+            except Exception as exc:
+                _logger.warning("Failed to print on %s", self.name, exc_info=True)
+                errors[index] = str(exc)
+
+        while cups_indexes:
+            connected = False
+            try:
+                with self.server_id._cups_connection(raise_on_error=True) as connection:
+                    connected = True
+                    while cups_indexes:
+                        report, content, print_opts = documents[cups_indexes[0]]
+                        if hasattr(connection, "createJob"):
+                            self._submit_document(
+                                connection, report, content, **dict(print_opts)
+                            )
+                        else:
+                            self._print_document_from_file(
+                                report, content, **dict(print_opts)
+                            )
+                        cups_indexes.pop(0)
+            except Exception as exc:
+                # The connection is dropped from the pool
+                _logger.warning("Failed to print on %s", self.name, exc_info=True)
+                if not connected:
+                    # Do not wait for the server again for each document
+                    for index in cups_indexes:
+                        errors[index] = str(exc)
+                    break
+                errors[cups_indexes.pop(0)] = str(exc)
+        return errors
+
+    def _is_sent_to_cups(self, print_opts):
+        """Tell whether print_document would send the document to CUPS"""
+        self.ensure_one()
+        if self.spool and not self.env.context.get("printing_spool_dispatch"):
+            return False
+        doc_format = print_opts.get("doc_format") or print_opts.get("format")
+        return not (doc_format == "raw" and self.raw_transport == "socket")
+
+    def _print_document_from_file(self, report, content, **print_opts):
         fd, file_name = mkstemp()
         try:
-            os.write(fd, content)
+            for chunk in self._iter_document_chunks(content):
+                os.write(fd, chunk)
         finally:
             os.close(fd)
 
         return self.print_file(file_name, report=report, **print_opts)
 
+    @staticmethod
+    def _iter_document_chunks(content):
+        if isinstance(content, (bytes, bytearray, memoryview)):
+            content = memoryview(content).cast("B")
+            for start in range(0, len(content), PRINT_CHUNK_SIZE):
+                yield content[start : start + PRINT_CHUNK_SIZE].tobytes()
+        else:
+            for chunk in content:
+                if chunk:
+                    yield bytes(chunk)
+
+    def _submit_document(self, connection, report, content, **print_opts):
+        """Send a document to CUPS through an opened connection
+
+        The job is created with ``createJob``, then the content is written
+        chunk by chunk. The job is cancelled if the transfer fails.
+        """
+        self.ensure_one()
+        title = print_opts.pop("title", report.name if report else self.name)
+        doc_format = print_opts.get("doc_format") or print_opts.get("format")
+        cups_format = cups.CUPS_FORMAT_AUTO
+        if doc_format == "raw":
+            cups_format = cups.CUPS_FORMAT_RAW
+        options = self.print_options(report=report, **print_opts)
+
+        _logger.debug(
+            "Sending job to CUPS printer %s on %s with options %s"
+            % (self.system_name, self.server_id.address, options)
+        )
+        job_id = connection.createJob(self.system_name, title, options)
+        try:
+            connection.startDocument(self.system_name, job_id, title, cups_format, 1)
+            for chunk in self._iter_document_chunks(content):
+                connection.writeRequestData(chunk, len(chunk))
+            connection.finishDocument(self.system_name)
+        except Exception:
+            try:
+                connection.cancelJob(job_id)
+            except Exception:
+                _logger.warning("Unable to cancel the CUPS job %s", job_id)
+            raise
+        _logger.info("Printing job: '{}' on {}".format(title, self.server_id.address))
+        return True
+
+    def _send_raw_document(self, content, **print_opts):
+        """Send a raw document straight to the printer, without CUPS"""
+        self.ensure_one()
+        if not self.raw_host:
+            raise exceptions.UserError(
+                _("The host of the printer %s is not configured.") % self.name
+            )
+        address = (self.raw_host, self.raw_port or 9100)
+        try:
+            sock = _raw_socket_pool.acquire(address, self.raw_timeout or None)
+        except OSError as exc:
+            raise exceptions.UserError(self._get_raw_error_message(exc)) from exc
+        try:
+            if self.raw_status_check:
+                errors = _get_host_status_errors(_read_host_status(sock))
+                if errors:
+                    raise exceptions.UserError(
+                        _("The printer %s cannot print: %s.")
+                        % (self.name, ", ".join(errors))
+                    )
+            for chunk in self._iter_document_chunks(content):
+                sock.sendall(chunk)
+        except OSError as exc:
+            sock.close()
+            raise exceptions.UserError(self._get_raw_error_message(exc)) from exc
+        except Exception:
+            sock.close()
+            raise
+        _raw_socket_pool.release(address, sock)
+        _logger.info(
+            "Printing job: '%s' on %s:%s",
+            print_opts.get("title", self.name),
+            self.raw_host,
+            self.raw_port,
+        )
+        return True
+
+    def _get_raw_error_message(self, exc):
+        self.ensure_one()
+        return _(
+            "Failed to send the document to the printer %s on %s:%s (%s). "
+            "Check that the printer is on and that you can reach it from "
+            "the Odoo server."
+        ) % (self.name, self.raw_host, self.raw_port, exc)
+
     @staticmethod
     def _set_option_doc_format(report, value):
         return {"raw": "True"} if value == "raw" else {}
@@ -176,14 +532,14 @@ class PrintingPrinter(models.Model):
         """Print a file"""
         self.ensure_one()
         title = print_opts.pop("title", file_name)
-        connection = self.server_id._open_connection(raise_on_error=True)
         options = self.print_options(report=report, **print_opts)
 
         _logger.debug(
             "Sending job to CUPS printer %s on %s with options %s"
             % (self.system_name, self.server_id.address, options)
         )
-        connection.printFile(self.system_name, file_name, title, options=options)
+        with self.server_id._cups_connection(raise_on_error=True) as connection:
+            connection.printFile(self.system_name, file_name, title, options=options)
         _logger.info(
             "Printing job: '{}' on {}".format(file_name, self.server_id.address)
         )
@@ -193,6 +549,26 @@ class PrintingPrinter(models.Model):
             _logger.warning("Unable to remove temporary file %s: %s", file_name, exc)
         return True
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        printers = super().create(vals_list)
+        if any(vals.get("default") for vals in vals_list):
+            # Drop the cached print behaviours
+            self.clear_caches()
+        return printers
+
+    def write(self, vals):
+        res = super().write(vals)
+        if {"default", "active"}.intersection(vals):
+            # Drop the cached print behaviours
+            self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.clear_caches()
+        return res
+
     def set_default(self):
         if not self:
             return
@@ -215,8 +591,10 @@ class PrintingPrinter(models.Model):
 
     def cancel_all_jobs(self, purge_jobs=False):
         for printer in self:
-            connection = printer.server_id._open_connection()
-            connection.cancelAllJobs(name=printer.system_name, purge_jobs=purge_jobs)
+            with printer.server_id._cups_connection() as connection:
+                connection.cancelAllJobs(
+                    name=printer.system_name, purge_jobs=purge_jobs
+                )
 
         # Update jobs' states into Odoo
         self.mapped("server_id").update_jobs(which="completed")
@@ -225,8 +603,8 @@ class PrintingPrinter(models.Model):
 
     def enable(self):
         for printer in self:
-            connection = printer.server_id._open_connection()
-            connection.enablePrinter(printer.system_name)
+            with printer.server_id._cups_connection() as connection:
+                connection.enablePrinter(printer.system_name)
 
         # Update printers' stats into Odoo
         self.mapped("server_id").update_printers()
@@ -235,8 +613,8 @@ class PrintingPrinter(models.Model):
 
     def disable(self):
         for printer in self:
-            connection = printer.server_id._open_connection()
-            connection.disablePrinter(printer.system_name)
+            with printer.server_id._cups_connection() as connection:
+                connection.disablePrinter(printer.system_name)
 
         # Update printers' stats into Odoo
         self.mapped("server_id").update_printers()
@@ -245,15 +623,15 @@ class PrintingPrinter(models.Model):
 
     def print_test_page(self):
         for printer in self:
-            connection = printer.server_id._open_connection()
-            if printer.model == "Local Raw Printer":
-                fd, file_name = mkstemp()
-                try:
-                    os.write(fd, b"TEST")
-                finally:
-                    os.close(fd)
-                connection.printTestPage(printer.system_name, file=file_name)
-            else:
-                connection.printTestPage(printer.system_name)
+            with printer.server_id._cups_connection() as connection:
+                if printer.model == "Local Raw Printer":
+                    fd, file_name = mkstemp()
+                    try:
+                        os.write(fd, b"TEST")
+                    finally:
+                        os.close(fd)
+                    connection.printTestPage(printer.system_name, file=file_name)
+                else:
+                    connection.printTestPage(printer.system_name)
 
         self.mapped("server_id").update_jobs(which="completed")
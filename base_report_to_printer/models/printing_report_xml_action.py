@@ -33,6 +33,23 @@ class PrintingReportXmlAction(models.Model):
         domain="[('printer_id', '=', printer_id)]",
     )
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        actions = super().create(vals_list)
+        # Drop the cached print behaviours
+        self.clear_caches()
+        return actions
+
+    def write(self, vals):
+        res = super().write(vals)
+        self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.clear_caches()
+        return res
+
     @api.onchange("printer_id")
     def onchange_printer_id(self):
         """Reset the tray when the printer is changed"""
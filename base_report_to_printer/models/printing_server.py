@@ -1,11 +1,19 @@
 # Copyright (C) 2016 SYLEAM (<http://www.syleam.fr>)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
+import getpass
 import logging
-from datetime import datetime
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 
 from odoo import _, exceptions, fields, models
 
+from .printing_printer import PRINTER_STATES
+
 _logger = logging.getLogger(__name__)
 
 
@@ -14,6 +22,260 @@ try:
 except ImportError:
     _logger.debug("Cannot `import cups`.")
 
+JOB_FINISHED_STATES = ("canceled", "aborted", "completed")
+JOB_ATTRIBUTES = [
+    "job-name",
+    "job-id",
+    "printer-uri",
+    "job-media-progress",
+    "time-at-creation",
+    "job-state",
+    "job-state-reasons",
+    "time-at-processing",
+    "time-at-completed",
+]
+# Maximum number of CUPS servers synchronized at the same time
+SYNC_MAX_WORKERS = 8
+# Fields of printing.server used to open a connection
+CONNECTION_FIELDS = {"address", "port", "user", "password", "encryption_policy"}
+# Events of the IPP subscriptions, and lease duration of the subscriptions
+# in seconds
+SUBSCRIPTION_EVENTS = [
+    "job-created",
+    "job-state-changed",
+    "job-completed",
+    "job-stopped",
+    "printer-added",
+    "printer-deleted",
+    "printer-modified",
+    "printer-state-changed",
+    "server-restarted",
+]
+SUBSCRIPTION_LEASE_DURATION = 3600
+# Events after which the printers of the server are refreshed
+PRINTERS_CHANGED_EVENTS = {
+    "printer-added",
+    "printer-deleted",
+    "printer-modified",
+    "server-restarted",
+}
+
+
+# libcups keeps the server, user and encryption settings per thread, and
+# pycups keeps the password callback per thread as well. They are all set
+# again before each use of a connection, since a thread of the pool may have
+# used another server last. The callback returns the password of the server
+# used by the current thread.
+_thread_settings = threading.local()
+
+
+def _password_callback(prompt):
+    return getattr(_thread_settings, "password", None)
+
+
+def _apply_connection_settings(
+    address, port, user=None, password=None, encryption_policy=None
+):
+    """Use the settings of a CUPS server in the current thread
+
+    This must be done before each use of a connection, since the
+    authentication may only happen on a later request. The settings missing
+    on the server are reset to the libcups defaults.
+    """
+    # Sometimes connecting to printer servers outside of the local network
+    # can result in a weird error "cups.IPPError: (1030, 'The printer
+    # or class does not exist.')".
+    # An explicit call to `setServer` and `setPort` fixed the issue.
+    # (see https://github.com/OpenPrinting/pycups/issues/30)
+    cups.setServer(address)
+    cups.setPort(port)
+    cups.setUser(user or getpass.getuser())
+    if encryption_policy:
+        cups.setEncryption(int(encryption_policy))
+    else:
+        cups.setEncryption(cups.HTTP_ENCRYPT_IF_REQUESTED)
+    _thread_settings.password = password if user else None
+    cups.setPasswordCB(_password_callback)
+
+
+def _cups_connect(address, port, user=None, password=None, encryption_policy=None):
+    """Open a connection to a CUPS server
+
+    This function does not access the ORM, so that it can be called from
+    the synchronization worker threads.
+    """
+    _apply_connection_settings(address, port, user, password, encryption_policy)
+    return cups.Connection(host=address, port=port)
+
+
+class CupsConnectionPool(object):
+    """Process-wide pool of idle CUPS connections
+
+    A connection is checked out by a single caller at a time, so that it is
+    never used by two threads concurrently. Idle connections are discarded
+    after ``idle_timeout`` seconds, and all connections are recycled after
+    ``max_age`` seconds. A connection which stayed idle for more than
+    ``check_after`` seconds is checked with a cheap request before being
+    reused.
+    """
+
+    def __init__(self, max_idle=4, idle_timeout=60, max_age=600, check_after=10):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self.check_after = check_after
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def acquire(self, key, connect):
+        """Check out a connection for ``key``
+
+        :param connect: callable opening a new connection when no idle one
+            is available
+        :return: a ``(connection, created)`` tuple, to give back to
+            :meth:`release`
+        """
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                entry = idle.pop() if idle else None
+            if entry is None:
+                return connect(), time.monotonic()
+
+            connection, created, released = entry
+            now = time.monotonic()
+            if now - released > self.idle_timeout or now - created > self.max_age:
+                continue
+            if now - released > self.check_after and not self._check(connection):
+                continue
+            return connection, created
+
+    @staticmethod
+    def _check(connection):
+        try:
+            connection.getDefault()
+        except Exception:
+            return False
+        return True
+
+    def release(self, key, connection, created):
+        """Give back a connection checked out with :meth:`acquire`
+
+        Connections which failed must not be released, they are simply
+        dropped by the caller.
+        """
+        now = time.monotonic()
+        if now - created > self.max_age:
+            return
+        with self._lock:
+            idle = [
+                entry
+                for entry in self._idle.get(key, [])
+                if now - entry[2] <= self.idle_timeout
+            ]
+            if len(idle) < self.max_idle:
+                idle.append((connection, created, now))
+            self._idle[key] = idle
+
+    def invalidate(self, dbname, server_ids):
+        """Drop the idle connections of some servers"""
+        with self._lock:
+            for key in list(self._idle):
+                if key[0] == dbname and key[1] in server_ids:
+                    del self._idle[key]
+
+
+_connection_pool = CupsConnectionPool()
+
+
+def _checkout_connection(key, connection_params):
+    """Check out a pooled connection to use in the current thread"""
+    _apply_connection_settings(**connection_params)
+    return _connection_pool.acquire(
+        key,
+        lambda: cups.Connection(
+            host=connection_params["address"], port=connection_params["port"]
+        ),
+    )
+
+
+def _fetch_printers(connection):
+    return connection.getPrinters()
+
+
+def _fetch_jobs(connection, which, first_job_id, completed_first_job_id):
+    jobs_data = connection.getJobs(
+        which_jobs=which,
+        first_job_id=first_job_id,
+        requested_attributes=JOB_ATTRIBUTES,
+    )
+    if completed_first_job_id:
+        jobs_data.update(
+            connection.getJobs(
+                which_jobs="completed",
+                first_job_id=completed_first_job_id,
+                requested_attributes=JOB_ATTRIBUTES,
+            )
+        )
+    return jobs_data
+
+
+def _fetch_notifications(connection, uri, subscription_id, sequence_number, renew):
+    """Pull the events of the IPP subscription of Odoo on the server
+
+    A new subscription is created when the previous one expired or some of
+    its events were dropped by CUPS, the events are then ``None`` and the
+    server must be polled. The attributes of the jobs found in the events
+    are fetched as well.
+    """
+    result = {
+        "subscription_id": subscription_id,
+        "renewed": False,
+        "events": None,
+        "jobs": {},
+    }
+    events = None
+    if subscription_id:
+        try:
+            notifications = connection.getNotifications(
+                [subscription_id], sequence_numbers=[sequence_number]
+            )
+            if renew:
+                connection.renewSubscription(
+                    subscription_id, lease_duration=SUBSCRIPTION_LEASE_DURATION
+                )
+                result["renewed"] = True
+        except cups.IPPError:
+            # The subscription expired or was canceled
+            notifications = {}
+        else:
+            events = [
+                event
+                for event in notifications.get("events", [])
+                if event.get("notify-subscription-id") == subscription_id
+            ]
+            # CUPS only keeps the last events of a subscription
+            if events and events[0]["notify-sequence-number"] > sequence_number:
+                events = None
+    if events is None:
+        result["subscription_id"] = connection.createSubscription(
+            uri, events=SUBSCRIPTION_EVENTS, lease_duration=SUBSCRIPTION_LEASE_DURATION
+        )
+        result["renewed"] = True
+        return result
+
+    result["events"] = events
+    job_ids = {event["notify-job-id"] for event in events if event.get("notify-job-id")}
+    for job_id in sorted(job_ids):
+        try:
+            result["jobs"][job_id] = connection.getJobAttributes(
+                job_id, requested_attributes=JOB_ATTRIBUTES
+            )
+        except cups.IPPError:
+            # The job was purged from CUPS in the meantime
+            continue
+    return result
+
 
 class PrintingServer(models.Model):
     _name = "printing.server"
@@ -42,225 +304,711 @@ class PrintingServer(models.Model):
         string="Printers List",
         help="List of printers available on this server.",
     )
+    last_job_id_cups = fields.Integer(
+        string="Last Job ID",
+        readonly=True,
+        help="Highest CUPS job id synchronized from this server. Incremental "
+        "synchronizations only fetch the jobs above this id and the unfinished "
+        "ones.",
+    )
+    job_full_sync_interval = fields.Integer(
+        string="Full Jobs Synchronization Interval",
+        default=60,
+        help="Number of minutes between two full reconciliations of the jobs "
+        "with CUPS. In between, the scheduled synchronization only fetches the "
+        "new and the unfinished jobs. Set to 0 to always run a full "
+        "reconciliation.",
+    )
+    last_job_full_sync = fields.Datetime(
+        string="Last Full Jobs Synchronization", readonly=True
+    )
+    job_retention_days = fields.Integer(
+        string="Jobs Retention (Days)",
+        help="Number of days the jobs purged from CUPS are kept in Odoo. "
+        "Set to 0 to keep them.",
+    )
+    job_retention_count = fields.Integer(
+        string="Jobs Retention (Jobs per Printer)",
+        help="Number of jobs kept in Odoo for each printer, the older jobs "
+        "purged from CUPS are removed. Set to 0 to keep them.",
+    )
+    use_subscription = fields.Boolean(
+        string="Event Notifications",
+        help="Subscribe to the events of the CUPS server, so that the "
+        "scheduled synchronization only fetches the jobs and printers which "
+        "changed. The server is polled when the subscription is lost.",
+    )
+    subscription_id_cups = fields.Integer(
+        string="Subscription ID", readonly=True, copy=False
+    )
+    subscription_sequence = fields.Integer(
+        string="Last Event Sequence",
+        readonly=True,
+        copy=False,
+        help="Sequence number of the last event received from CUPS.",
+    )
+    subscription_expiry = fields.Datetime(readonly=True, copy=False)
+    sync_timeout = fields.Integer(
+        string="Synchronization Timeout",
+        default=30,
+        help="Maximum number of seconds to wait for this server when "
+        "synchronizing the printers and jobs of all servers.",
+    )
+
+    def _get_connection_params(self):
+        self.ensure_one()
+        return {
+            "address": self.address,
+            "port": self.port,
+            "user": self.user,
+            "password": self.password,
+            "encryption_policy": self.encryption_policy,
+        }
+
+    def _get_connection_error_message(self):
+        self.ensure_one()
+        return _(
+            "Failed to connect to the CUPS server on %s:%s. "
+            "Check that the CUPS server is running and that "
+            "you can reach it from the Odoo server."
+        ) % (self.address, self.port)
+
+    def _handle_connection_error(self, raise_on_error=False):
+        message = self._get_connection_error_message()
+        _logger.warning(message)
+        if raise_on_error:
+            raise exceptions.UserError(message)
 
     def _open_connection(self, raise_on_error=False):
         self.ensure_one()
         connection = False
+        try:
+            connection = _cups_connect(**self._get_connection_params())
+        except Exception:
+            self._handle_connection_error(raise_on_error)
 
-        # Password callback
-        password = self.password
+        return connection
 
-        def pw_callback(prompt):
-            return password
+    def _get_connection_pool_key(self):
+        """Return the key of the server connections in the pool
+
+        The credentials are part of the key, so that the connections opened
+        with outdated settings are never reused, even in other processes.
+        """
+        self.ensure_one()
+        params = self._get_connection_params()
+        return (self.env.cr.dbname, self.id, tuple(sorted(params.items())))
 
+    @contextmanager
+    def _cups_connection(self, raise_on_error=False):
+        """Check out a connection to the server from the connection pool
+
+        Yields ``False`` when the connection fails and ``raise_on_error`` is
+        not set. The connection is given back to the pool when leaving the
+        context, unless an exception was raised.
+        """
+        self.ensure_one()
+        key = self._get_connection_pool_key()
+        params = self._get_connection_params()
         try:
-            # Sometimes connecting to printer servers outside of the local network
-            # can result in a weird error "cups.IPPError: (1030, 'The printer
-            # or class does not exist.')".
-            # An explicit call to `setServer` and `setPort` fixed the issue.
-            # (see https://github.com/OpenPrinting/pycups/issues/30)
-            cups.setServer(self.address)
-            cups.setPort(self.port)
-            if self.user:
-                cups.setUser(self.user)
-                if self.encryption_policy:
-                    cups.setEncryption(int(self.encryption_policy))
-                if self.password:
-                    cups.setPasswordCB(pw_callback)
-
-            connection = cups.Connection(host=self.address, port=self.port)
+            connection, created = _checkout_connection(key, params)
         except Exception:
-            message = _(
-                "Failed to connect to the CUPS server on %s:%s. "
-                "Check that the CUPS server is running and that "
-                "you can reach it from the Odoo server."
-            ) % (self.address, self.port)
-            _logger.warning(message)
-            if raise_on_error:
-                raise exceptions.UserError(message)
+            self._handle_connection_error(raise_on_error)
+            yield False
+            return
+
+        yield connection
+        _connection_pool.release(key, connection, created)
+
+    def _invalidate_connections(self):
+        _connection_pool.invalidate(self.env.cr.dbname, set(self.ids))
+
+    def write(self, vals):
+        if CONNECTION_FIELDS.intersection(vals) or (
+            "use_subscription" in vals and not vals["use_subscription"]
+        ):
+            # The subscription is left to expire on CUPS
+            vals = dict(
+                vals,
+                subscription_id_cups=0,
+                subscription_sequence=0,
+                subscription_expiry=False,
+            )
+        res = super().write(vals)
+        if CONNECTION_FIELDS.intersection(vals):
+            self._invalidate_connections()
+        return res
 
-        return connection
+    def unlink(self):
+        self._invalidate_connections()
+        return super().unlink()
+
+    @contextmanager
+    def _fetch_from_cups(self, fetch, fetch_args=None):
+        """Run ``fetch(connection, *args)`` on all servers concurrently
+
+        Only the network calls are run in the worker threads, which never
+        access the ORM: the connection parameters are read beforehand and the
+        results are applied by the caller in the current transaction.
+        A server which fails or does not answer within its
+        ``sync_timeout`` does not delay the other ones.
+
+        The connections are checked out from the pool until the end of the
+        context, so that the caller can keep using them.
+
+        :param fetch_args: dict mapping a server to the extra ``fetch``
+            arguments for this server
+        :return: dict mapping each server to a ``(connection, data)`` tuple,
+            or to ``None`` when the server could not be synchronized
+        """
+        if fetch_args is None:
+            fetch_args = {}
+
+        def fetch_server(key, connection_params, args):
+            connection, created = _checkout_connection(key, connection_params)
+            return connection, created, fetch(connection, *args)
+
+        executor = ThreadPoolExecutor(
+            max_workers=max(1, min(len(self), SYNC_MAX_WORKERS)),
+            thread_name_prefix="printing_server_sync",
+        )
+        futures = {}
+        for server in self:
+            key = server._get_connection_pool_key()
+            futures[server] = key, executor.submit(
+                fetch_server,
+                key,
+                server._get_connection_params(),
+                fetch_args.get(server, ()),
+            )
+        # Do not wait for the servers which timed out
+        executor.shutdown(wait=False)
+
+        start = time.monotonic()
+        results = {}
+        checked_out = []
+        for server, (key, future) in futures.items():
+            timeout = max(0, server.sync_timeout - (time.monotonic() - start))
+            try:
+                connection, created, data = future.result(timeout=timeout)
+            except Exception:
+                _logger.warning(
+                    "Failed to synchronize with the CUPS server on %s:%s",
+                    server.address,
+                    server.port,
+                    exc_info=True,
+                )
+                results[server] = None
+                continue
+            results[server] = (connection, data)
+            checked_out.append((key, connection, created))
+
+        yield results
+        for key, connection, created in checked_out:
+            _connection_pool.release(key, connection, created)
 
     def action_update_printers(self):
-        return self.update_printers(raise_on_error=True)
+        return self.update_printers(raise_on_error=True, force=True)
 
-    def update_printers(self, domain=None, raise_on_error=False):
+    def update_printers(self, domain=None, raise_on_error=False, force=False):
+        """Refresh the printers of the servers from CUPS
+
+        Printers whose CUPS attributes did not change since the last refresh
+        are skipped, unless ``force`` is set, so that their PPD file is not
+        downloaded again.
+        """
         if domain is None:
             domain = []
 
         servers = self
         if not self:
             servers = self.search(domain)
+        servers = servers.with_context(active_test=False)
 
         res = True
-        for server in servers.with_context(active_test=False):
-            connection = server._open_connection(raise_on_error=raise_on_error)
-            if not connection:
-                server.printer_ids.write({"status": "server-error"})
-                res = False
-                continue
+        with servers._fetch_from_cups(_fetch_printers) as fetched:
+            for server in servers:
+                if not fetched[server]:
+                    server.printer_ids.write(
+                        {"status": "server-error", "cups_attributes_hash": False}
+                    )
+                    if raise_on_error:
+                        raise exceptions.UserError(
+                            server._get_connection_error_message()
+                        )
+                    res = False
+                    continue
 
-            # Update Printers
-            printers = connection.getPrinters()
-            existing_printers = {
-                printer.system_name: printer for printer in server.printer_ids
-            }
-            updated_printers = []
-            for name, printer_info in printers.items():
-                printer = self.env["printing.printer"]
-                if name in existing_printers:
-                    printer = existing_printers[name]
-
-                printer_values = printer._prepare_update_from_cups(
-                    connection, printer_info
-                )
-                if server != printer.server_id:
-                    printer_values["server_id"] = server.id
+                connection, printers = fetched[server]
+                server._update_printers_from_cups(connection, printers, force=force)
 
-                updated_printers.append(name)
-                if not printer:
-                    printer_values["system_name"] = name
-                    printer.create(printer_values)
-                elif printer_values:
-                    printer.write(printer_values)
+        return res
 
-            # Set printers not found as unavailable
-            server.printer_ids.filtered(
-                lambda record: record.system_name not in updated_printers
-            ).write({"status": "unavailable"})
+    def _update_printers_from_cups(self, connection, printers, force=False):
+        """Apply the printers fetched from CUPS to the printers of the server
 
-        return res
+        The changes are computed first, then applied with a single create of
+        the new printers and trays, a single unlink of the removed trays, one
+        write per distinct set of values, and a single query for the values
+        specific to each printer, so that the printers with the same changes,
+        for example the same new status, are written together.
+        """
+        self.ensure_one()
+        # The connection was checked out in a worker thread, the PPD files
+        # are downloaded from the current one
+        _apply_connection_settings(**self._get_connection_params())
+        printer_obj = self.env["printing.printer"]
+        existing_printers = {
+            printer.system_name: printer for printer in self.printer_ids
+        }
+        printers_vals = []
+        printers_writes = defaultdict(lambda: printer_obj)
+        trays_vals = []
+        trays_to_unlink = self.env["printing.tray"]
+        cups_columns = []
+        for name, printer_info in printers.items():
+            printer = existing_printers.get(name, printer_obj)
+            attributes_hash = printer_obj._get_cups_attributes_hash(printer_info)
+            if (
+                not force
+                and printer
+                and printer.cups_attributes_hash == attributes_hash
+            ):
+                continue
+
+            printer_values = printer._prepare_update_from_cups(connection, printer_info)
+            if self != printer.server_id:
+                printer_values["server_id"] = self.id
+
+            if not printer:
+                printer_values["system_name"] = name
+                printer_values["cups_attributes_hash"] = attributes_hash
+                printers_vals.append(printer_values)
+                continue
+            for command in printer_values.pop("tray_ids", []):
+                if command[0] == 0:
+                    trays_vals.append(dict(command[2], printer_id=printer.id))
+                elif command[0] == 2:
+                    trays_to_unlink |= trays_to_unlink.browse(command[1])
+            cups_columns.append(
+                (printer.id, attributes_hash, printer_values.pop("ppd_modtime", None))
+            )
+            if printer_values:
+                printers_writes[tuple(sorted(printer_values.items()))] |= printer
+
+        # Set printers not found as unavailable
+        missing_printers = self.printer_ids.filtered(
+            lambda record: record.system_name not in printers
+        )
+        if missing_printers:
+            unavailable_values = {
+                "status": "unavailable",
+                "cups_attributes_hash": False,
+            }
+            printers_writes[
+                tuple(sorted(unavailable_values.items()))
+            ] |= missing_printers
+
+        trays_to_unlink.unlink()
+        if trays_vals:
+            self.env["printing.tray"].create(trays_vals)
+        for values, printers_to_write in printers_writes.items():
+            printers_to_write.write(dict(values))
+        if cups_columns:
+            self._write_printers_cups_columns(cups_columns)
+        if printers_vals:
+            printer_obj.create(printers_vals)
+
+    def _write_printers_cups_columns(self, cups_columns):
+        """Write the attributes hash and the PPD modification time of many
+        printers in a single query
+
+        :param cups_columns: list of ``(printer_id, attributes_hash,
+            ppd_modtime)``, the PPD modification time being ``None`` when it
+            did not change
+        """
+        printer_obj = self.env["printing.printer"]
+        fnames = ["cups_attributes_hash", "ppd_modtime"]
+        printer_obj.flush(fnames)
+        printer_ids, attributes_hashes, ppd_modtimes = zip(*cups_columns)
+        self.env.cr.execute(
+            """
+            UPDATE printing_printer AS printer
+            SET cups_attributes_hash = cups.attributes_hash,
+                ppd_modtime = COALESCE(cups.ppd_modtime, printer.ppd_modtime),
+                write_uid = %s,
+                write_date = (now() at time zone 'UTC')
+            FROM unnest(%s::integer[], %s::varchar[], %s::integer[])
+                AS cups(printer_id, attributes_hash, ppd_modtime)
+            WHERE printer.id = cups.printer_id
+            """,
+            (
+                self.env.uid,
+                list(printer_ids),
+                list(attributes_hashes),
+                list(ppd_modtimes),
+            ),
+        )
+        printer_obj.invalidate_cache(
+            fnames + ["write_uid", "write_date"], list(printer_ids)
+        )
 
     def action_update_jobs(self):
         if not self:
-            self = self.search([])
+            return self.search([])._sync_jobs()
         return self.update_jobs()
 
-    def update_jobs(self, which="all", first_job_id=-1):
-        job_obj = self.env["printing.job"]
-        printer_obj = self.env["printing.printer"]
+    def _must_full_sync_jobs(self, now):
+        self.ensure_one()
+        if not self.last_job_full_sync or self.job_full_sync_interval <= 0:
+            return True
+        next_full_sync = self.last_job_full_sync + timedelta(
+            minutes=self.job_full_sync_interval
+        )
+        return next_full_sync <= now
+
+    def _get_incremental_first_job_id(self):
+        """Return the first CUPS job id to fetch for an incremental sync
+
+        Only the jobs above the high-water mark and the jobs still not
+        finished in Odoo can have changed since the last synchronization.
+        """
+        self.ensure_one()
+        first_job_id = self.last_job_id_cups + 1
+        oldest_unfinished_job = self._get_oldest_unfinished_job()
+        if oldest_unfinished_job:
+            first_job_id = min(first_job_id, oldest_unfinished_job.job_id_cups)
+        return first_job_id
 
-        mapping = {
-            3: "pending",
-            4: "pending held",
-            5: "processing",
-            6: "processing stopped",
-            7: "canceled",
-            8: "aborted",
-            9: "completed",
-        }
+    def _get_oldest_unfinished_job(self):
+        self.ensure_one()
+        return self.env["printing.job"].search(
+            [
+                ("server_id", "=", self.id),
+                ("job_state", "not in", JOB_FINISHED_STATES),
+            ],
+            limit=1,
+            order="job_id_cups",
+        )
+
+    def _sync_jobs(self):
+        """Synchronize the jobs of the servers
+
+        A full reconciliation with CUPS is only done once per
+        ``job_full_sync_interval``, other runs are incremental.
+        """
+        now = fields.Datetime.now()
+        sync_args = {}
+        notified_servers = self.browse()
+        for server in self:
+            if server._must_full_sync_jobs(now):
+                sync_args[server] = ("all", -1)
+            elif server.use_subscription:
+                notified_servers |= server
+            else:
+                sync_args[server] = ("all", server._get_incremental_first_job_id())
+        for server in notified_servers._sync_notifications():
+            sync_args[server] = ("all", server._get_incremental_first_job_id())
+        servers = self.browse([server.id for server in sync_args])
+        return servers._update_jobs(sync_args)
+
+    def _get_subscription_uri(self):
+        self.ensure_one()
+        return "ipp://{}:{}/".format(self.address, self.port)
 
-        # Update printers list, to ensure that jobs printers will be in Odoo
-        self.update_printers()
+    def _sync_notifications(self):
+        """Apply the events received from CUPS since the last synchronization
 
+        :return: the servers whose subscription was created again, which
+            must be polled as some of their events may have been lost
+        """
+        now = fields.Datetime.now()
+        renew_date = now + timedelta(seconds=SUBSCRIPTION_LEASE_DURATION / 2)
+        fetch_args = {}
         for server in self:
-            connection = server._open_connection()
-            if not connection:
+            subscription_id = server.subscription_id_cups
+            expiry = server.subscription_expiry
+            if not expiry or expiry <= now:
+                subscription_id = 0
+            fetch_args[server] = (
+                server._get_subscription_uri(),
+                subscription_id,
+                server.subscription_sequence + 1,
+                bool(subscription_id) and expiry <= renew_date,
+            )
+
+        polled_servers = self.browse()
+        with self._fetch_from_cups(_fetch_notifications, fetch_args) as fetched:
+            for server in self:
+                if not fetched[server]:
+                    continue
+                result = fetched[server][1]
+                values = {}
+                if result["renewed"]:
+                    values["subscription_id_cups"] = result["subscription_id"]
+                    values["subscription_expiry"] = now + timedelta(
+                        seconds=SUBSCRIPTION_LEASE_DURATION
+                    )
+                events = result["events"]
+                if events is None:
+                    values["subscription_sequence"] = 0
+                    polled_servers |= server
+                    # The printers events may have been lost as well
+                    server.update_printers()
+                else:
+                    if events:
+                        values["subscription_sequence"] = max(
+                            event["notify-sequence-number"] for event in events
+                        )
+                    values.update(server._apply_notifications(events, result["jobs"]))
+                if values:
+                    server.write(values)
+        return polled_servers
+
+    def _apply_notifications(self, events, jobs_data):
+        """Update the jobs and printers of the server from CUPS events
+
+        :return: the values to write on the server
+        """
+        self.ensure_one()
+        values = {}
+        if jobs_data:
+            self._update_jobs_from_cups(jobs_data)
+            if max(jobs_data) > self.last_job_id_cups:
+                values["last_job_id_cups"] = max(jobs_data)
+
+        event_names = {event.get("notify-subscribed-event") for event in events}
+        if PRINTERS_CHANGED_EVENTS.intersection(event_names):
+            self.update_printers()
+            return values
+
+        # The last event of a printer gives its current state
+        printers_values = {}
+        for event in events:
+            if event.get("notify-subscribed-event") != "printer-state-changed":
                 continue
+            printer_values = {
+                "status": PRINTER_STATES.get(event.get("printer-state"), "unknown")
+            }
+            if "printer-state-message" in event:
+                printer_values["status_message"] = event["printer-state-message"]
+            printers_values[event.get("printer-name")] = printer_values
 
-            # Retrieve asked job data
-            jobs_data = connection.getJobs(
-                which_jobs=which,
-                first_job_id=first_job_id,
-                requested_attributes=[
-                    "job-name",
-                    "job-id",
-                    "printer-uri",
-                    "job-media-progress",
-                    "time-at-creation",
-                    "job-state",
-                    "job-state-reasons",
-                    "time-at-processing",
-                    "time-at-completed",
-                ],
-            )
+        printer_obj = self.env["printing.printer"]
+        printers = self._get_printers_by_system_name()
+        printers_writes = defaultdict(lambda: printer_obj)
+        for name, printer_values in printers_values.items():
+            printer = printers.get(name)
+            if printer:
+                printers_writes[tuple(sorted(printer_values.items()))] |= printer
+        for printer_values, printers_to_write in printers_writes.items():
+            printers_to_write.write(dict(printer_values))
+        return values
+
+    def update_jobs(self, which="all", first_job_id=-1):
+        return self._update_jobs({server: (which, first_job_id) for server in self})
+
+    def _update_jobs(self, sync_args):
+        """Synchronize the jobs of the servers
 
+        :param sync_args: dict mapping each server to the ``(which,
+            first_job_id)`` arguments of the jobs query to run on it
+        """
+        fetch_args = {}
+        for server in self:
+            which, first_job_id = sync_args[server]
             # Retrieve known uncompleted jobs data to update them
+            completed_first_job_id = False
             if which == "not-completed":
-                oldest_uncompleted_job = job_obj.search(
-                    [("job_state", "not in", ("canceled", "aborted", "completed"))],
-                    limit=1,
-                    order="job_id_cups",
-                )
-                if oldest_uncompleted_job:
-                    jobs_data.update(
-                        connection.getJobs(
-                            which_jobs="completed",
-                            first_job_id=oldest_uncompleted_job.job_id_cups,
-                            requested_attributes=[
-                                "job-name",
-                                "job-id",
-                                "printer-uri",
-                                "job-media-progress",
-                                "time-at-creation",
-                                "job-state",
-                                "job-state-reasons",
-                                "time-at-processing",
-                                "time-at-completed",
-                            ],
-                        )
-                    )
+                oldest_uncompleted_job = server._get_oldest_unfinished_job()
+                completed_first_job_id = oldest_uncompleted_job.job_id_cups
+            fetch_args[server] = (which, first_job_id, completed_first_job_id)
 
-            all_cups_job_ids = set()
-            for cups_job_id, job_data in jobs_data.items():
-                all_cups_job_ids.add(cups_job_id)
-                jobs = job_obj.with_context(active_test=False).search(
-                    [("job_id_cups", "=", cups_job_id), ("server_id", "=", server.id)]
-                )
-                cups_job_values = {
-                    "name": job_data.get("job-name", ""),
-                    "active": True,
-                    "job_media_progress": job_data.get("job-media-progress", 0),
-                    "job_state": mapping.get(job_data.get("job-state"), "unknown"),
-                    "job_state_reason": job_data.get("job-state-reasons", ""),
-                    "time_at_creation": datetime.fromtimestamp(
-                        job_data.get("time-at-creation", 0)
-                    ),
-                }
-                if job_data.get("time-at-processing"):
-                    cups_job_values["time_at_processing"] = datetime.fromtimestamp(
-                        job_data["time-at-processing"]
-                    )
-                if job_data.get("time-at-completed"):
-                    cups_job_values["time_at_completed"] = datetime.fromtimestamp(
-                        job_data["time-at-completed"]
-                    )
+        with self._fetch_from_cups(_fetch_jobs, fetch_args) as fetched:
+            for server in self:
+                if not fetched[server]:
+                    continue
+
+                which, first_job_id = sync_args[server]
+                jobs_data = fetched[server][1]
+                all_cups_job_ids = set(jobs_data)
+                server._update_jobs_from_cups(jobs_data)
+
+                # Deactive purged jobs
+                if which == "all" and first_job_id == -1:
+                    server._deactivate_purged_jobs(all_cups_job_ids)
+
+                server_values = {}
+                if all_cups_job_ids and max(all_cups_job_ids) > server.last_job_id_cups:
+                    server_values["last_job_id_cups"] = max(all_cups_job_ids)
+                if which == "all" and first_job_id == -1:
+                    server_values["last_job_full_sync"] = fields.Datetime.now()
+                if server_values:
+                    server.write(server_values)
+
+        return True
 
-                job_values = {
-                    fieldname: value
-                    for fieldname, value in cups_job_values.items()
-                    if not jobs or value != jobs[fieldname]
-                }
+    def _deactivate_purged_jobs(self, cups_job_ids):
+        """Archive the jobs of the server which are not known by CUPS anymore
+
+        The jobs are compared in a single query, whatever their number.
+        """
+        self.ensure_one()
+        job_obj = self.env["printing.job"]
+        job_obj.flush(["active", "server_id", "job_id_cups"])
+        self.env.cr.execute(
+            """
+            UPDATE printing_job AS job
+            SET active = FALSE,
+                write_uid = %s,
+                write_date = (now() at time zone 'UTC')
+            WHERE job.server_id = %s
+            AND job.active
+            AND NOT EXISTS (
+                SELECT 1 FROM unnest(%s::integer[]) AS cups_job(job_id)
+                WHERE cups_job.job_id = job.job_id_cups
+            )
+            RETURNING job.id
+            """,
+            (self.env.uid, self.id, sorted(cups_job_ids)),
+        )
+        purged_job_ids = [row[0] for row in self.env.cr.fetchall()]
+        job_obj.invalidate_cache(["active", "write_uid", "write_date"], purged_job_ids)
+        return job_obj.browse(purged_job_ids)
+
+    def _get_expired_job_ids(self):
+        """Return the ids of the jobs exceeding the retention of the server
+
+        Only the jobs purged from CUPS are removed, the other ones would be
+        created again by the next full synchronization.
+        """
+        self.ensure_one()
+        if not self.job_retention_days and not self.job_retention_count:
+            return []
+        self.env["printing.job"].flush()
+        conditions = []
+        params = {"server_id": self.id}
+        if self.job_retention_days:
+            conditions.append("job.time_at_creation < %(limit_date)s")
+            params["limit_date"] = fields.Datetime.now() - timedelta(
+                days=self.job_retention_days
+            )
+        if self.job_retention_count:
+            conditions.append("job.rank > %(count)s")
+            params["count"] = self.job_retention_count
+        self.env.cr.execute(
+            """
+            SELECT job.id FROM (
+                SELECT id, active, time_at_creation, row_number() OVER (
+                    PARTITION BY printer_id
+                    ORDER BY time_at_creation DESC, id DESC
+                ) AS rank
+                FROM printing_job
+                WHERE server_id = %(server_id)s
+            ) AS job
+            WHERE NOT job.active AND ({})
+            ORDER BY job.id
+            """.format(
+                " OR ".join(conditions)
+            ),
+            params,
+        )
+        return [row[0] for row in self.env.cr.fetchall()]
+
+    def _get_printers_by_system_name(self):
+        self.ensure_one()
+        printers = {}
+        for printer in self.env["printing.printer"].search(
+            [("server_id", "=", self.id)]
+        ):
+            printers.setdefault(printer.system_name, printer)
+        return printers
+
+    @staticmethod
+    def _get_cups_job_printer_name(job_data):
+        printer_uri = job_data["printer-uri"]
+        return printer_uri[printer_uri.rfind("/") + 1 :]
+
+    def _update_jobs_from_cups(self, jobs_data):
+        """Create or update the jobs of the server from CUPS jobs data
+
+        Existing jobs and printers are fetched once for the whole batch, new
+        jobs are inserted at once and updates are grouped by identical values.
+        """
+        self.ensure_one()
+        job_obj = self.env["printing.job"]
+        mapping = {
+            3: "pending",
+            4: "pending held",
+            5: "processing",
+            6: "processing stopped",
+            7: "canceled",
+            8: "aborted",
+            9: "completed",
+        }
 
-                # Search for the printer in Odoo
-                printer_uri = job_data["printer-uri"]
-                printer_system_name = printer_uri[printer_uri.rfind("/") + 1 :]
-                printer = printer_obj.search(
+        existing_jobs = {}
+        if jobs_data:
+            existing_jobs = {
+                job.job_id_cups: job
+                for job in job_obj.with_context(active_test=False).search(
                     [
-                        ("server_id", "=", server.id),
-                        ("system_name", "=", printer_system_name),
-                    ],
-                    limit=1,
+                        ("server_id", "=", self.id),
+                        ("job_id_cups", "in", list(jobs_data)),
+                    ]
                 )
-                # CUPS retains jobs for disconnected printers and also may
-                # leak jobs data for unshared printers, therefore we just
-                # discard here if not printer found
-                if not printer:
-                    continue
-                if jobs.printer_id != printer:
-                    job_values["printer_id"] = printer.id
-
-                if not jobs:
-                    job_values["job_id_cups"] = cups_job_id
-                    job_obj.create(job_values)
-                elif job_values:
-                    jobs.write(job_values)
-
-            # Deactive purged jobs
-            if which == "all" and first_job_id == -1:
-                purged_jobs = job_obj.search(
-                    [("job_id_cups", "not in", list(all_cups_job_ids))]
+            }
+        # The jobs of the printers still unknown in Odoo are skipped, they are
+        # synchronized once the printers are discovered by the printers update
+        printers = self._get_printers_by_system_name()
+
+        jobs_to_create = []
+        jobs_to_write = defaultdict(lambda: job_obj)
+        for cups_job_id, job_data in jobs_data.items():
+            job = existing_jobs.get(cups_job_id, job_obj)
+            cups_job_values = {
+                "name": job_data.get("job-name", ""),
+                "active": True,
+                "job_media_progress": job_data.get("job-media-progress", 0),
+                "job_state": mapping.get(job_data.get("job-state"), "unknown"),
+                "job_state_reason": job_data.get("job-state-reasons", ""),
+                "time_at_creation": datetime.fromtimestamp(
+                    job_data.get("time-at-creation", 0)
+                ),
+            }
+            if job_data.get("time-at-processing"):
+                cups_job_values["time_at_processing"] = datetime.fromtimestamp(
+                    job_data["time-at-processing"]
                 )
-                purged_jobs.write({"active": False})
+            if job_data.get("time-at-completed"):
+                cups_job_values["time_at_completed"] = datetime.fromtimestamp(
+                    job_data["time-at-completed"]
+                )
+
+            job_values = {
+                fieldname: value
+                for fieldname, value in cups_job_values.items()
+                if not job or value != job[fieldname]
+            }
 
+            # Search for the printer in Odoo
+            printer = printers.get(self._get_cups_job_printer_name(job_data))
+            # CUPS retains jobs for disconnected printers and also may
+            # leak jobs data for unshared printers, therefore we just
+            # discard here if not printer found
+            if not printer:
+                continue
+            if job.printer_id != printer:
+                job_values["printer_id"] = printer.id
+
+            if not job:
+                job_values["job_id_cups"] = cups_job_id
+                jobs_to_create.append(job_values)
+            elif job_values:
+                jobs_to_write[tuple(sorted(job_values.items()))] |= job
+
+        if jobs_to_create:
+            job_obj.create(jobs_to_create)
+        for job_values, jobs in jobs_to_write.items():
+            jobs.write(dict(job_values))
         return True
@@ -0,0 +1,227 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import base64
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+# Number of attempts before a spooled document is given up
+SPOOL_MAX_ATTEMPTS = 10
+# Delays between two attempts, in seconds, doubled after each failure
+SPOOL_RETRY_DELAY = 30
+SPOOL_RETRY_MAX_DELAY = 3600
+# Number of days the sent documents are kept in the spool
+SPOOL_DONE_RETENTION_DAYS = 7
+# First key of the advisory locks taken while draining a printer queue
+SPOOL_LOCK_KEY = 7211
+# Maximum number of printer queues drained at the same time
+SPOOL_MAX_WORKERS = 8
+
+
+class PrintingSpoolJob(models.Model):
+    _name = "printing.spool.job"
+    _description = "Spooled Printing Job"
+    _order = "id"
+
+    name = fields.Char(string="Title", readonly=True)
+    printer_id = fields.Many2one(
+        comodel_name="printing.printer",
+        string="Printer",
+        required=True,
+        readonly=True,
+        index=True,
+        ondelete="cascade",
+        help="Printer to which the document is sent.",
+    )
+    report_id = fields.Many2one(
+        comodel_name="ir.actions.report",
+        string="Report",
+        readonly=True,
+        ondelete="set null",
+        help="Report which generated the document.",
+    )
+    content = fields.Binary(attachment=True, readonly=True, help="Document to print.")
+    print_options = fields.Text(
+        readonly=True, help="Printing options of the document, as JSON."
+    )
+    state = fields.Selection(
+        selection=[
+            ("pending", "Pending"),
+            ("done", "Sent"),
+            ("failed", "Failed"),
+            ("cancel", "Canceled"),
+        ],
+        default="pending",
+        required=True,
+        readonly=True,
+        index=True,
+    )
+    attempts = fields.Integer(
+        readonly=True, help="Number of attempts to send the document."
+    )
+    next_attempt = fields.Datetime(
+        default=fields.Datetime.now,
+        readonly=True,
+        help="The document is not sent before this date.",
+    )
+    error_message = fields.Text(string="Error", readonly=True)
+
+    @api.model
+    def _enqueue(self, printer, report, content, **print_opts):
+        """Add a document at the end of the queue of a printer"""
+        if not isinstance(content, bytes):
+            content = b"".join(printer._iter_document_chunks(content))
+        job = self.sudo().create(
+            {
+                "name": print_opts.get("title") or (report.name if report else False),
+                "printer_id": printer.id,
+                "report_id": report.id if report else False,
+                "content": base64.b64encode(content),
+                "print_options": json.dumps(print_opts),
+            }
+        )
+        self._trigger_dispatch()
+        return job
+
+    @api.model
+    def _trigger_dispatch(self, at=None):
+        cron = self.env.ref(
+            "base_report_to_printer.ir_cron_dispatch_spool", raise_if_not_found=False
+        )
+        if cron:
+            cron.sudo()._trigger(at=at)
+
+    @api.model
+    def _dispatch(self):
+        """Send the pending documents to their printers
+
+        The queue of each printer is drained in order: a document waiting for
+        a retry blocks the following ones. The queues are drained concurrently,
+        each one in its own thread and transaction, so that a slow printer
+        does not delay the other ones.
+        """
+        groups = self.read_group(
+            [("state", "=", "pending")], ["printer_id"], ["printer_id"]
+        )
+        printer_ids = [group["printer_id"][0] for group in groups]
+        if self.env.registry.in_test_mode():
+            # The test cursor cannot be used by other threads
+            for printer_id in printer_ids:
+                self._dispatch_printer(self.env["printing.printer"].browse(printer_id))
+            return True
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(len(printer_ids), SPOOL_MAX_WORKERS)),
+            thread_name_prefix="printing_spool_dispatch",
+        ) as executor:
+            for printer_id in printer_ids:
+                executor.submit(self._dispatch_printer_in_thread, printer_id)
+        return True
+
+    @api.model
+    def _dispatch_printer_in_thread(self, printer_id):
+        """Drain the queue of a printer with a new cursor"""
+        try:
+            with api.Environment.manage(), self.env.registry.cursor() as cr:
+                env = api.Environment(cr, self.env.uid, self.env.context)
+                env[self._name]._dispatch_printer(
+                    env["printing.printer"].browse(printer_id)
+                )
+        except Exception:
+            _logger.exception(
+                "Failed to dispatch the spooled documents of the printer %s",
+                printer_id,
+            )
+
+    @api.model
+    def _dispatch_printer(self, printer):
+        while self._lock_printer(printer):
+            job = self.search(
+                [("printer_id", "=", printer.id), ("state", "=", "pending")],
+                limit=1,
+            )
+            if not job or job.next_attempt > fields.Datetime.now():
+                break
+            job._send()
+            if not self.env.registry.in_test_mode():
+                # A document sent to the printer cannot be taken back,
+                # its state must not be rolled back by a later failure.
+                self.env.cr.commit()  # pylint: disable=invalid-commit
+
+    @api.model
+    def _lock_printer(self, printer):
+        """Prevent concurrent dispatchers to drain the same printer queue
+
+        The lock is released at the end of the transaction.
+        """
+        self.env.cr.execute(
+            "SELECT pg_try_advisory_xact_lock(%s, %s)", (SPOOL_LOCK_KEY, printer.id)
+        )
+        return self.env.cr.fetchone()[0]
+
+    def _send(self):
+        self.ensure_one()
+        attempts = self.attempts + 1
+        try:
+            with self.env.cr.savepoint():
+                self.printer_id.with_context(
+                    printing_spool_dispatch=True
+                ).print_document(
+                    self.report_id,
+                    base64.b64decode(self.content),
+                    **json.loads(self.print_options or "{}")
+                )
+        except Exception as exc:
+            _logger.warning(
+                "Failed to send the spooled document %s to the printer %s",
+                self.id,
+                self.printer_id.name,
+                exc_info=True,
+            )
+            values = {"attempts": attempts, "error_message": str(exc)}
+            if attempts >= SPOOL_MAX_ATTEMPTS:
+                values["state"] = "failed"
+            else:
+                delay = min(
+                    SPOOL_RETRY_DELAY * 2 ** (attempts - 1), SPOOL_RETRY_MAX_DELAY
+                )
+                values["next_attempt"] = fields.Datetime.now() + timedelta(
+                    seconds=delay
+                )
+                self._trigger_dispatch(at=values["next_attempt"])
+            self.write(values)
+            return False
+
+        self.write(
+            {
+                "state": "done",
+                "attempts": attempts,
+                "error_message": False,
+                "content": False,
+            }
+        )
+        return True
+
+    def action_retry(self):
+        self.write(
+            {
+                "state": "pending",
+                "attempts": 0,
+                "next_attempt": fields.Datetime.now(),
+            }
+        )
+        self._trigger_dispatch()
+        return True
+
+    def action_cancel(self):
+        self.filtered(lambda job: job.state == "pending").write({"state": "cancel"})
+        return True
+
+    @api.autovacuum
+    def _gc_done_jobs(self):
+        limit_date = fields.Datetime.now() - timedelta(days=SPOOL_DONE_RETENTION_DAYS)
+        self.search([("state", "=", "done"), ("write_date", "<", limit_date)]).unlink()
@@ -19,3 +19,15 @@ class PrinterTray(models.Model):
         readonly=True,
         ondelete="cascade",
     )
+
+    def write(self, vals):
+        res = super().write(vals)
+        if "system_name" in vals:
+            # Drop the cached print behaviours
+            self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.clear_caches()
+        return res
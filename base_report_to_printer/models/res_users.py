@@ -7,6 +7,9 @@
 
 from odoo import api, fields, models
 
+# Fields of the users used to compute the print behaviour
+BEHAVIOUR_FIELDS = {"printing_action", "printing_printer_id", "printer_tray_id"}
+
 
 class ResUsers(models.Model):
     _inherit = "res.users"
@@ -40,3 +43,10 @@ class ResUsers(models.Model):
     def onchange_printing_printer_id(self):
         """Reset the tray when the printer is changed"""
         self.printer_tray_id = False
+
+    def write(self, vals):
+        res = super().write(vals)
+        if BEHAVIOUR_FIELDS.intersection(vals):
+            # Drop the cached print behaviours
+            self.clear_caches()
+        return res
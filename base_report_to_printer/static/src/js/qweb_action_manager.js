@@ -9,49 +9,40 @@ odoo.define("base_report_to_printer.print", function (require) {
         _triggerDownload: function (action, options, type) {
             var self = this;
             var _super = this._super;
-            if (type === "pdf" || "text") {
-                this._rpc({
-                    model: "ir.actions.report",
-                    method: "print_action_for_report_name",
-                    args: [action.report_name],
-                }).then(function (print_action) {
-                    if (print_action && print_action.action === "server") {
-                        self._rpc({
-                            model: "ir.actions.report",
-                            method: "print_document",
-                            args: [action.id, action.context.active_ids],
-                            kwargs: {data: action.data || {}},
-                            context: action.context || {},
-                        }).then(
-                            function () {
-                                self.do_notify(
-                                    _t("Report"),
-                                    _.str.sprintf(
-                                        _t("Document sent to the printer %s"),
-                                        print_action.printer_name
-                                    )
-                                );
-                            },
-                            function () {
-                                self.do_notify(
-                                    _t("Report"),
-                                    _.str.sprintf(
-                                        _t(
-                                            "Error when sending the document " +
-                                                "to the printer "
-                                        ),
-                                        print_action.printer_name
-                                    )
-                                );
-                            }
-                        );
-                    } else {
-                        return _super.apply(self, [action, options, type]);
-                    }
-                });
-                return Promise.reject();
+            if (type !== "pdf" && type !== "text") {
+                return _super.apply(this, arguments);
             }
-            return _super.apply(self, [action, options, type]);
+            // The print behaviour depends on the company and the context of
+            // the action, so the server decides it on each print
+            this._rpc({
+                model: "ir.actions.report",
+                method: "print_document_from_client",
+                args: [action.id, action.context.active_ids],
+                kwargs: {data: action.data || {}},
+                context: action.context || {},
+            }).then(function (result) {
+                if (result.action !== "server") {
+                    return _super.apply(self, [action, options, type]);
+                }
+                if (result.error) {
+                    self.do_warn(
+                        _.str.sprintf(
+                            _t("Error when sending the document to the printer %s"),
+                            result.printer_name
+                        ),
+                        result.error
+                    );
+                } else {
+                    self.do_notify(
+                        _t("Report"),
+                        _.str.sprintf(
+                            _t("Document sent to the printer %s"),
+                            result.printer_name
+                        )
+                    );
+                }
+            });
+            return Promise.reject();
         },
     });
 });
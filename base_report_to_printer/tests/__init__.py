@@ -11,3 +11,5 @@ from . import test_res_users
 from . import test_ir_actions_report
 from . import test_printing_printer_wizard
 from . import test_printing_report_xml_action
+from . import test_printing_spool_job
+from . import test_printing_batch
@@ -209,6 +209,37 @@ class TestIrActionsReportXml(TransactionCase):
             {"action": "client", "printer": report.printing_printer_id, "tray": False},
         )
 
+    def test_behaviour_cache(self):
+        """It should compute the behaviour once until the settings change"""
+        report = self.Model.search([], limit=1)
+        self.env.user.printing_action = "client"
+        report.property_printing_action_id = False
+        report.behaviour()
+        with mock.patch.object(
+            type(self.env["printing.report.xml.action"]), "search"
+        ) as search:
+            behaviour = report.behaviour()
+            search.assert_not_called()
+        self.assertEqual(behaviour["action"], "client")
+        behaviour.pop("action")
+        self.assertEqual(report.behaviour()["action"], "client")
+
+        self.env.user.printing_action = "server"
+        self.assertEqual(report.behaviour()["action"], "server")
+        printer = self.new_printer()
+        self.assertEqual(report.behaviour()["printer"], printer)
+        printer.unset_default()
+        self.assertFalse(report.behaviour()["printer"])
+        self.env["printing.report.xml.action"].create(
+            {
+                "user_id": self.env.user.id,
+                "report_id": report.id,
+                "action": "server",
+                "printer_id": printer.id,
+            }
+        )
+        self.assertEqual(report.behaviour()["printer"], printer)
+
     def test_print_tray_behaviour(self):
         """
         It should return the correct tray
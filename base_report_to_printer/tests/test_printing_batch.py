@@ -0,0 +1,100 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from unittest import mock
+
+from odoo.tests.common import TransactionCase
+
+server_model = "odoo.addons.base_report_to_printer.models.printing_server"
+
+
+class TestPrintingBatch(TransactionCase):
+    def setUp(self):
+        super().setUp()
+        self.server = self.env["printing.server"].create({})
+        self.printer = self.env["printing.printer"].create(
+            {
+                "name": "Printer",
+                "server_id": self.server.id,
+                "system_name": "Sys Name",
+                "status": "unknown",
+            }
+        )
+        self.report = self.env["ir.actions.report"].create(
+            {
+                "name": "Test",
+                "report_type": "qweb-pdf",
+                "model": "res.partner",
+                "report_name": "base_report_to_printer.test_batch",
+                "printing_printer_id": self.printer.id,
+            }
+        )
+        self.partners = self.env["res.partner"].create(
+            [{"name": "Test %d" % n} for n in range(3)]
+        )
+        render = mock.patch.object(
+            type(self.report),
+            "_render_qweb_pdf",
+            autospec=True,
+            return_value=(b"document", "pdf"),
+        )
+        self.render = render.start()
+        self.addCleanup(render.stop)
+
+    @mock.patch("%s.cups" % server_model)
+    def test_print_batch(self, cups):
+        """It should print all the documents of a printer over one connection"""
+        cups.Connection.reset_mock()
+        results = self.env["printing.batch"].print_batch(
+            [
+                (self.report, self.partners[0].ids),
+                (self.report.id, self.partners[1:].ids, {"copies": 2}),
+                (self.report.report_name, self.partners.ids),
+            ]
+        )
+        self.assertEqual(
+            results,
+            [{"success": True, "printer_id": self.printer.id, "error": False}] * 3,
+        )
+        self.assertEqual(self.render.call_count, 3)
+        self.assertEqual(cups.Connection.call_count, 1)
+        self.assertEqual(cups.Connection().createJob.call_count, 3)
+        self.assertEqual(
+            cups.Connection().createJob.call_args_list[1][0][2], {"copies": "2"}
+        )
+
+    @mock.patch("%s.cups" % server_model)
+    def test_print_batch_errors(self, cups):
+        """It should print the valid items and report the errors"""
+        other_report = self.report.copy({"printing_printer_id": False})
+        self.env.user.printing_printer_id = False
+        self.env["printing.printer"].search([]).unset_default()
+        cups.Connection().createJob.side_effect = [Exception("Printer error"), 42]
+        results = self.env["printing.batch"].print_batch(
+            [
+                ("unknown.report", self.partners.ids),
+                (other_report, self.partners.ids),
+                (self.report, self.partners[0].ids),
+                (self.report, self.partners[1].ids),
+            ]
+        )
+        self.assertEqual(
+            [result["success"] for result in results], [False, False, False, True]
+        )
+        self.assertTrue(all(result["error"] for result in results[:3]))
+        self.assertEqual(results[2]["error"], "Printer error")
+        self.assertFalse(results[3]["error"])
+        self.assertEqual(cups.Connection().createJob.call_count, 2)
+
+    @mock.patch("%s.cups" % server_model)
+    def test_print_batch_connection_error(self, cups):
+        """It should fail all the documents when the server is unreachable"""
+        cups.Connection.side_effect = Exception("Unreachable")
+        results = self.env["printing.batch"].print_batch(
+            [
+                (self.report, self.partners[0].ids),
+                (self.report, self.partners[1].ids),
+            ]
+        )
+        self.assertEqual([result["success"] for result in results], [False, False])
+        self.assertEqual(results[0]["error"], results[1]["error"])
+        cups.Connection.assert_called_once()
@@ -61,3 +61,38 @@ class TestPrintingJob(TransactionCase):
         cups.Connection().cancelJob.assert_called_once_with(
             job.job_id_cups, purge_job=False
         )
+
+    def test_gc_jobs(self):
+        """It should remove the archived jobs exceeding the retention"""
+        printer = self.new_printer()
+        old_job = self.new_job(
+            printer,
+            {"job_id_cups": 1, "active": False, "time_at_creation": "2000-01-01"},
+        )
+        old_active_job = self.new_job(
+            printer,
+            {"job_id_cups": 2, "active": True, "time_at_creation": "2000-01-02"},
+        )
+        archived_jobs = self.env["printing.job"]
+        for job_id_cups in range(3, 6):
+            archived_jobs |= self.new_job(
+                printer,
+                {
+                    "job_id_cups": job_id_cups,
+                    "active": False,
+                    "time_at_creation": fields.Datetime.now(),
+                },
+            )
+        self.env["printing.job"]._gc_jobs()
+        self.assertTrue(old_job.exists())
+
+        self.server.job_retention_days = 30
+        self.env["printing.job"]._gc_jobs()
+        self.assertFalse(old_job.exists())
+        self.assertTrue(old_active_job.exists())
+        self.assertEqual(len(archived_jobs.exists()), 3)
+
+        self.server.write({"job_retention_days": 0, "job_retention_count": 2})
+        self.env["printing.job"]._gc_jobs()
+        self.assertTrue(old_active_job.exists())
+        self.assertEqual(archived_jobs.exists(), archived_jobs[1:])
@@ -7,6 +7,8 @@ from unittest import mock
 from odoo.exceptions import UserError
 from odoo.tests.common import TransactionCase
 
+from ..models.printing_printer import RawSocketPool, _raw_socket_pool
+
 model = "odoo.addons.base_report_to_printer.models.printing_printer"
 server_model = "odoo.addons.base_report_to_printer.models.printing_server"
 
@@ -81,7 +83,56 @@ class TestPrintingPrinter(TransactionCase):
 
     @mock.patch("%s.cups" % server_model)
     def test_print_report(self, cups):
-        """It should print a report through CUPS"""
+        """It should stream a report to CUPS"""
+        printer = self.new_record()
+        connection = cups.Connection()
+        connection.createJob.return_value = 42
+        printer.print_document(self.report, b"content to print", doc_format="pdf")
+        connection.createJob.assert_called_once_with(
+            printer.system_name, self.report.name, {}
+        )
+        connection.startDocument.assert_called_once_with(
+            printer.system_name, 42, self.report.name, "application/octet-stream", 1
+        )
+        connection.writeRequestData.assert_called_once_with(b"content to print", 16)
+        connection.finishDocument.assert_called_once_with(printer.system_name)
+        connection.printFile.assert_not_called()
+
+    @mock.patch("%s.cups" % server_model)
+    def test_print_report_chunks(self, cups):
+        """It should stream each chunk of a report to CUPS"""
+        printer = self.new_record()
+        connection = cups.Connection()
+        printer.print_document(
+            None, iter([b"first", b"", b"second"]), doc_format="raw", title="Label"
+        )
+        connection.createJob.assert_called_once_with(
+            printer.system_name, "Label", {"raw": "True"}
+        )
+        self.assertEqual(
+            connection.startDocument.call_args[0][3], "application/vnd.cups-raw"
+        )
+        self.assertEqual(
+            connection.writeRequestData.call_args_list,
+            [mock.call(b"first", 5), mock.call(b"second", 6)],
+        )
+
+    @mock.patch("%s.cups" % server_model)
+    def test_print_report_cancel(self, cups):
+        """It should cancel the CUPS job when the transfer fails"""
+        printer = self.new_record()
+        connection = cups.Connection()
+        connection.createJob.return_value = 42
+        connection.writeRequestData.side_effect = Exception
+        with self.assertRaises(Exception):
+            printer.print_document(self.report, b"content to print")
+        connection.cancelJob.assert_called_once_with(42)
+        connection.finishDocument.assert_not_called()
+
+    @mock.patch("%s.cups" % server_model)
+    def test_print_report_fallback(self, cups):
+        """It should print through a file when streaming is not supported"""
+        cups.Connection.return_value = mock.MagicMock(spec=["printFile"])
         fd, file_name = tempfile.mkstemp()
         with mock.patch("%s.mkstemp" % model) as mkstemp:
             mkstemp.return_value = fd, file_name
@@ -95,14 +146,100 @@ class TestPrintingPrinter(TransactionCase):
     def test_print_report_error(self, cups):
         """It should print a report through CUPS"""
         cups.Connection.side_effect = Exception
-        fd, file_name = tempfile.mkstemp()
-        with mock.patch("%s.mkstemp" % model) as mkstemp:
-            mkstemp.return_value = fd, file_name
-            printer = self.new_record()
-            with self.assertRaises(UserError):
-                printer.print_document(
-                    self.report, b"content to print", doc_format="pdf"
-                )
+        printer = self.new_record()
+        with self.assertRaises(UserError):
+            printer.print_document(self.report, b"content to print", doc_format="pdf")
+
+    def new_socket_printer(self, **vals):
+        self.addCleanup(_raw_socket_pool._idle.clear)
+        return self.Model.create(
+            dict(
+                self.printer_vals,
+                raw_transport="socket",
+                raw_host="printer.example.com",
+                **vals
+            )
+        )
+
+    @mock.patch("%s.select.select" % model)
+    @mock.patch("%s.socket.create_connection" % model)
+    @mock.patch("%s.cups" % server_model)
+    def test_print_raw_socket(self, cups, create_connection, select):
+        """It should send raw documents straight to the printer"""
+        select.return_value = [], [], []
+        printer = self.new_socket_printer()
+        printer.print_document(None, b"^XA^XZ", doc_format="raw")
+        create_connection.assert_called_once_with(
+            ("printer.example.com", 9100), timeout=10.0
+        )
+        sock = create_connection.return_value
+        sock.sendall.assert_called_once_with(b"^XA^XZ")
+        cups.Connection().createJob.assert_not_called()
+        # The idle socket is reused
+        printer.print_document(None, b"^XA^XZ", doc_format="raw")
+        create_connection.assert_called_once()
+        self.assertEqual(sock.sendall.call_count, 2)
+        # Other documents are printed through CUPS
+        printer.print_document(self.report, b"content to print", doc_format="pdf")
+        cups.Connection().createJob.assert_called_once()
+
+    @mock.patch("%s.select.select" % model)
+    @mock.patch("%s.socket.create_connection" % model)
+    def test_print_raw_socket_closed(self, create_connection, select):
+        """It should not reuse a socket closed by the printer"""
+        printer = self.new_socket_printer()
+        printer.print_document(None, b"^XA^XZ", doc_format="raw")
+        sock = create_connection.return_value
+        select.return_value = [sock], [], []
+        printer.print_document(None, b"^XA^XZ", doc_format="raw")
+        sock.close.assert_called_once()
+        self.assertEqual(create_connection.call_count, 2)
+
+    @mock.patch("%s.time.monotonic" % model)
+    def test_raw_socket_pool_expiry(self, monotonic):
+        """It should close the idle sockets after their idle timeout"""
+        pool = RawSocketPool(idle_timeout=5)
+        address = ("printer.example.com", 9100)
+        other_address = ("other.example.com", 9100)
+        sock = mock.Mock()
+        other_sock = mock.Mock()
+        monotonic.return_value = 100
+        pool.release(address, sock)
+        monotonic.return_value = 104
+        pool.release(other_address, other_sock)
+        # The idle socket of another printer is closed by the next use
+        monotonic.return_value = 106
+        with mock.patch("%s.socket.create_connection" % model) as create_connection:
+            self.assertEqual(pool.acquire(address, 10), create_connection.return_value)
+        sock.close.assert_called_once()
+        other_sock.close.assert_not_called()
+        monotonic.return_value = 110
+        pool.release(address, create_connection.return_value)
+        other_sock.close.assert_called_once()
+        self.assertEqual(list(pool._idle), [address])
+
+    @mock.patch("%s.socket.create_connection" % model)
+    def test_print_raw_socket_status(self, create_connection):
+        """It should not print when the printer status reports an error"""
+        printer = self.new_socket_printer(raw_status_check=True)
+        sock = create_connection.return_value
+        sock.recv.return_value = (
+            b"\x02030,1,0,1245,000,0,0,0,000,0,0,0\x03\r\n"
+            b"\x02001,0,0,0,1,2,6,0,00000000,1,000\x03\r\n"
+            b"\x021234,0\x03\r\n"
+        )
+        with self.assertRaises(UserError):
+            printer.print_document(None, b"^XA^XZ", doc_format="raw")
+        sock.sendall.assert_called_once_with(b"~HS")
+        sock.close.assert_called_once()
+
+    @mock.patch("%s.socket.create_connection" % model)
+    def test_print_raw_socket_error(self, create_connection):
+        """It should raise an error when the printer cannot be reached"""
+        create_connection.side_effect = OSError
+        printer = self.new_socket_printer()
+        with self.assertRaises(UserError):
+            printer.print_document(None, b"^XA^XZ", doc_format="raw")
 
     @mock.patch("%s.cups" % server_model)
     def test_print_file(self, cups):
@@ -110,6 +110,83 @@ class TestPrintingPrinter(TransactionCase):
         self.ServerModel.update_printers()
         self.assertEqual(self.printer.name, "info")
 
+    @mock.patch("%s.cups" % server_model)
+    def test_update_printers_diff(self, cups):
+        """
+        Check that update_printers creates, updates and disables the printers
+        and their trays
+        """
+        self.mock_cups_ppd(cups)
+        missing_printer = self.printer.copy({"system_name": "Missing"})
+
+        def get_ppd(*args, **kwargs):
+            # Each PPD file is removed once read
+            fd, file_name = tempfile.mkstemp()
+            with open(file_name, "w") as fp:
+                fp.write(self.build_ppd())
+            return 200, 0, file_name
+
+        cups.Connection().getPPD3.side_effect = get_ppd
+        old_tray = self.new_tray()
+        cups.Connection().getPrinters.return_value = {
+            self.printer.system_name: {
+                "printer-info": "info",
+                "printer-uri-supported": "uri",
+            },
+            "New 1": {"printer-info": "New 1", "printer-uri-supported": "uri"},
+            "New 2": {"printer-info": "New 2", "printer-uri-supported": "uri"},
+        }
+
+        self.server.update_printers()
+        self.assertEqual(self.printer.name, "info")
+        self.assertEqual(self.printer.tray_ids.mapped("system_name"), ["Auto"])
+        self.assertFalse(old_tray.exists())
+        self.assertEqual(missing_printer.status, "unavailable")
+        new_printers = self.server.printer_ids - self.printer - missing_printer
+        self.assertEqual(sorted(new_printers.mapped("system_name")), ["New 1", "New 2"])
+        self.assertEqual(len(new_printers.mapped("tray_ids")), 2)
+
+    @mock.patch("%s.cups" % server_model)
+    def test_update_printers_grouped_writes(self, cups):
+        """
+        Check that the printers with the same changes are written together
+        """
+        other_printer = self.Model.create(
+            {
+                "name": "Other Printer",
+                "server_id": self.server.id,
+                "system_name": "Other",
+                "status": "unknown",
+                "status_message": "Msg",
+            }
+        )
+        cups.Connection().getPPD3.return_value = (200, 0, False)
+        cups.Connection().getPrinters.return_value = {
+            printer.system_name: {
+                "printer-info": printer.name,
+                "printer-make-and-model": printer.model,
+                "printer-location": printer.location,
+                "device-uri": printer.uri,
+                "printer-state": 3,
+                "printer-state-message": "Msg",
+                "printer-uri-supported": "uri/" + printer.system_name,
+            }
+            for printer in self.printer | other_printer
+        }
+        write = type(self.Model).write
+        with mock.patch.object(
+            type(self.Model), "write", autospec=True, side_effect=write
+        ) as mock_write:
+            self.server.update_printers()
+        mock_write.assert_called_once_with(
+            self.printer | other_printer, {"status": "available"}
+        )
+        self.assertTrue(self.printer.cups_attributes_hash)
+        self.assertTrue(other_printer.cups_attributes_hash)
+        self.assertNotEqual(
+            self.printer.cups_attributes_hash, other_printer.cups_attributes_hash
+        )
+
     @mock.patch("%s.cups" % server_model)
     def test_prepare_update_from_cups_no_ppd(self, cups):
         """
@@ -253,3 +330,39 @@ class TestPrintingPrinter(TransactionCase):
             vals["tray_ids"],
             [(0, 0, {"name": "Auto (Default)", "system_name": "Auto"}), (2, tray.id)],
         )
+
+    @mock.patch("%s.cups" % server_model)
+    def test_prepare_update_from_cups_ppd_not_modified(self, cups):
+        """
+        Check that the trays are kept when the PPD file did not change
+        """
+        self.mock_cups_ppd(cups, file_name=False)
+        cups.Connection().getPPD3.return_value = (304, 1234, "")
+        self.printer.ppd_modtime = 1234
+        self.new_tray()
+
+        connection = cups.Connection()
+        cups_printer = connection.getPrinters()[self.printer.system_name]
+
+        vals = self.printer._prepare_update_from_cups(connection, cups_printer)
+        connection.getPPD3.assert_called_once_with("uri", modtime=1234)
+        self.assertFalse("tray_ids" in vals)
+        self.assertFalse("ppd_modtime" in vals)
+
+    @mock.patch("%s.cups" % server_model)
+    def test_prepare_update_from_cups_ppd_modtime(self, cups):
+        """
+        Check that the modification time of a downloaded PPD file is stored
+        """
+        self.mock_cups_ppd(cups)
+        connection = cups.Connection()
+        status, modtime, file_name = connection.getPPD3.return_value
+        connection.getPPD3.return_value = (status, 1234, file_name)
+        cups_printer = connection.getPrinters()[self.printer.system_name]
+
+        vals = self.printer._prepare_update_from_cups(connection, cups_printer)
+        self.assertEqual(vals["ppd_modtime"], 1234)
+        self.assertEqual(
+            vals["tray_ids"],
+            [(0, 0, {"name": "Auto (Default)", "system_name": "Auto"})],
+        )
@@ -1,11 +1,14 @@
 # Copyright 2016 LasLabs Inc.
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
+import threading
 from unittest import mock
 
 from odoo import fields
 from odoo.tests.common import TransactionCase
 
+from ..models.printing_server import CupsConnectionPool, _apply_connection_settings
+
 model = "odoo.addons.base_report_to_printer.models.printing_server"
 model_base = "odoo.models.BaseModel"
 
@@ -103,12 +106,190 @@ class TestPrintingServer(TransactionCase):
             rec_id.status,
         )
 
+    @mock.patch("%s.cups" % model)
+    def test_update_printers_skip_unchanged(self, cups):
+        """It should not refresh printers whose CUPS attributes are unchanged"""
+        printer = self.new_printer()
+        printer_info = {
+            "printer-info": "Info",
+            "printer-uri-supported": "uri/" + printer.system_name,
+        }
+        cups.Connection().getPrinters.return_value = {printer.system_name: printer_info}
+        cups.Connection().getPPD3.return_value = (200, 0, "")
+        self.server.update_printers()
+        self.assertEqual(printer.name, "Info")
+        self.assertTrue(printer.cups_attributes_hash)
+        cups.Connection().getPPD3.reset_mock()
+        self.server.update_printers()
+        cups.Connection().getPPD3.assert_not_called()
+        self.server.action_update_printers()
+        cups.Connection().getPPD3.assert_called_once()
+
+    @mock.patch("%s.cups" % model)
+    def test_update_printers_settings_main_thread(self, cups):
+        """It should apply the server settings in the thread using the PPDs"""
+        self.server.write({"user": "user", "password": "password"})
+        threads = []
+
+        def apply_settings(*args, **kwargs):
+            threads.append((threading.current_thread(), kwargs.get("user")))
+
+        with mock.patch(
+            "%s._apply_connection_settings" % model, side_effect=apply_settings
+        ):
+            self.server.update_printers()
+        self.assertIn((threading.current_thread(), "user"), threads)
+
+    @mock.patch("%s.cups" % model)
+    def test_connection_pool_reuse(self, cups):
+        """It should reuse the connections to a server"""
+        with self.server._cups_connection() as connection:
+            self.assertEqual(connection, cups.Connection.return_value)
+        with self.server._cups_connection() as connection:
+            self.assertEqual(connection, cups.Connection.return_value)
+        cups.Connection.assert_called_once_with(
+            host=self.server.address, port=self.server.port
+        )
+
+    @mock.patch("%s.cups" % model)
+    def test_connection_pool_exclusive(self, cups):
+        """It should not share a connection checked out by another caller"""
+        cups.Connection.side_effect = lambda host, port: mock.MagicMock()
+        with self.server._cups_connection() as connection:
+            with self.server._cups_connection() as other_connection:
+                self.assertNotEqual(connection, other_connection)
+        self.assertEqual(cups.Connection.call_count, 2)
+
+    @mock.patch("%s.cups" % model)
+    def test_connection_pool_discard_on_error(self, cups):
+        """It should not reuse a connection which raised an error"""
+        with self.assertRaises(ValueError):
+            with self.server._cups_connection():
+                raise ValueError()
+        with self.server._cups_connection():
+            pass
+        self.assertEqual(cups.Connection.call_count, 2)
+
+    @mock.patch("%s.cups" % model)
+    def test_connection_pool_invalidate(self, cups):
+        """It should drop the connections when the server settings change"""
+        with self.server._cups_connection():
+            pass
+        self.server.write({"last_job_id_cups": 10})
+        with self.server._cups_connection():
+            pass
+        cups.Connection.assert_called_once()
+        self.server.write({"port": 632})
+        with self.server._cups_connection():
+            pass
+        cups.Connection.assert_called_with(host=self.server.address, port=632)
+        self.assertEqual(cups.Connection.call_count, 2)
+
+    @mock.patch("%s.getpass.getuser" % model)
+    @mock.patch("%s.cups" % model)
+    def test_connection_settings_reset(self, cups, getuser):
+        """It should reset the user and encryption of servers without them"""
+        getuser.return_value = "odoo"
+        _apply_connection_settings("server1", 631, user="user", encryption_policy="3")
+        cups.setUser.assert_called_with("user")
+        cups.setEncryption.assert_called_with(3)
+        _apply_connection_settings("server2", 631)
+        cups.setUser.assert_called_with("odoo")
+        cups.setEncryption.assert_called_with(cups.HTTP_ENCRYPT_IF_REQUESTED)
+        self.assertIsNone(cups.setPasswordCB.call_args[0][0]("Password: "))
+
+    @mock.patch("%s.cups" % model)
+    def test_connection_settings_per_thread(self, cups):
+        """It should give its own server password to each thread"""
+        barrier = threading.Barrier(2)
+        passwords = {}
+
+        def use_server(address, password):
+            _apply_connection_settings(address, 631, user="user", password=password)
+            barrier.wait()
+            password_callback = cups.setPasswordCB.call_args[0][0]
+            passwords[address] = password_callback("Password: ")
+
+        threads = [
+            threading.Thread(target=use_server, args=("server1", "password1")),
+            threading.Thread(target=use_server, args=("server2", "password2")),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(passwords, {"server1": "password1", "server2": "password2"})
+
+    @mock.patch("%s.time" % model)
+    def test_connection_pool_expiry(self, time):
+        """It should evict the idle connections and recycle the old ones"""
+        pool = CupsConnectionPool(idle_timeout=60, max_age=600, check_after=10)
+        connect = mock.MagicMock(side_effect=lambda: mock.MagicMock())
+        time.monotonic.return_value = 0
+        connection, created = pool.acquire("key", connect)
+        time.monotonic.return_value = 5
+        pool.release("key", connection, created)
+        self.assertEqual(pool.acquire("key", connect)[0], connection)
+        connection.getDefault.assert_not_called()
+        # Checked before being reused after a while
+        pool.release("key", connection, created)
+        time.monotonic.return_value = 30
+        self.assertEqual(pool.acquire("key", connect)[0], connection)
+        connection.getDefault.assert_called_once_with()
+        # Evicted when idle for too long
+        pool.release("key", connection, created)
+        time.monotonic.return_value = 100
+        self.assertNotEqual(pool.acquire("key", connect)[0], connection)
+        # Recycled when too old
+        connection, created = pool.acquire("key", connect)
+        time.monotonic.return_value = 800
+        pool.release("key", connection, created)
+        self.assertNotEqual(pool.acquire("key", connect)[0], connection)
+        self.assertEqual(connect.call_count, 4)
+
+    @mock.patch("%s.cups" % model)
+    def test_update_printers_multi_server_error(self, cups):
+        """It should refresh the other servers when one of them fails"""
+        printer = self.new_printer()
+        other_server = self.Model.create({"address": "other-server"})
+        other_printer = self.env["printing.printer"].create(
+            dict(self.printer_vals, server_id=other_server.id)
+        )
+        connection = mock.MagicMock()
+        connection.getPrinters.return_value = {
+            other_printer.system_name: {"printer-info": "Other Info"},
+        }
+        connection.getPPD3.return_value = (200, 0, "")
+
+        def cups_connection(host, port):
+            if host == other_server.address:
+                return connection
+            raise Exception
+
+        cups.Connection.side_effect = cups_connection
+        (self.server | other_server).update_printers()
+        self.assertEqual(printer.status, "server-error")
+        self.assertEqual(other_printer.name, "Other Info")
+
+    @mock.patch("%s.cups" % model)
+    def test_update_jobs_unknown_printer(self, cups):
+        """It should skip the jobs of the unknown printers"""
+        printer = self.new_printer()
+        cups.Connection().getJobs.return_value = {
+            1: {"printer-uri": "hostname:port/" + printer.system_name},
+            2: {"printer-uri": "hostname:port/New Printer"},
+        }
+        self.server.update_jobs()
+        cups.Connection().getPrinters.assert_not_called()
+        jobs = self.env["printing.job"].search([("server_id", "=", self.server.id)])
+        self.assertEqual(jobs.mapped("job_id_cups"), [1])
+
     @mock.patch("%s.cups" % model)
     def test_update_jobs_cron(self, cups):
         """It should get all jobs from CUPS server"""
         self.new_printer()
         self.Model.action_update_jobs()
-        cups.Connection().getPrinters.assert_called_once_with()
+        cups.Connection().getPrinters.assert_not_called()
         cups.Connection().getJobs.assert_called_once_with(
             which_jobs="all",
             first_job_id=-1,
@@ -130,7 +311,7 @@ class TestPrintingServer(TransactionCase):
         """It should get all jobs from CUPS server"""
         self.new_printer()
         self.server.action_update_jobs()
-        cups.Connection().getPrinters.assert_called_once_with()
+        cups.Connection().getPrinters.assert_not_called()
         cups.Connection().getJobs.assert_called_once_with(
             which_jobs="all",
             first_job_id=-1,
@@ -206,3 +387,197 @@ class TestPrintingServer(TransactionCase):
         self.assertEqual(completed_job.job_state, "completed")
         self.assertEqual(purged_job.active, False)
         self.assertEqual(new_job.job_state, "processing")
+
+    @mock.patch("%s.cups" % model)
+    def test_update_jobs_purge_other_server(self, cups):
+        """It should only archive the purged jobs of the synchronized server"""
+        printer = self.new_printer()
+        other_server = self.Model.create({})
+        self.printer_vals["server_id"] = other_server.id
+        other_printer = self.new_printer()
+        printer_uri = "hostname:port/" + printer.system_name
+        cups.Connection().getJobs.return_value = {1: {"printer-uri": printer_uri}}
+        job = self.new_job(printer)
+        purged_job = self.new_job(printer, vals={"job_id_cups": 2})
+        other_job = self.new_job(
+            other_printer, vals={"job_id_cups": 3, "server_id": other_server.id}
+        )
+        self.server.update_jobs()
+        self.assertTrue(job.active)
+        self.assertFalse(purged_job.active)
+        self.assertTrue(other_job.active)
+
+    @mock.patch("%s.cups" % model)
+    def test_update_jobs_cron_incremental(self, cups):
+        """It should only fetch new and unfinished jobs between full syncs"""
+        printer = self.new_printer()
+        self.new_job(printer, vals={"job_id_cups": 2, "job_state": "completed"})
+        self.new_job(printer, vals={"job_id_cups": 3, "job_state": "processing"})
+        self.server.write(
+            {"last_job_id_cups": 5, "last_job_full_sync": fields.Datetime.now()}
+        )
+        self.Model.action_update_jobs()
+        cups.Connection().getJobs.assert_called_once_with(
+            which_jobs="all",
+            first_job_id=3,
+            requested_attributes=[
+                "job-name",
+                "job-id",
+                "printer-uri",
+                "job-media-progress",
+                "time-at-creation",
+                "job-state",
+                "job-state-reasons",
+                "time-at-processing",
+                "time-at-completed",
+            ],
+        )
+
+    @mock.patch("%s.cups" % model)
+    def test_update_jobs_cron_full_sync_interval(self, cups):
+        """It should run a full sync when the interval is elapsed"""
+        self.new_printer()
+        self.server.write(
+            {
+                "last_job_id_cups": 5,
+                "last_job_full_sync": "2000-01-01 00:00:00",
+                "job_full_sync_interval": 60,
+            }
+        )
+        self.Model.action_update_jobs()
+        self.assertEqual(cups.Connection().getJobs.call_args[1]["first_job_id"], -1)
+        self.assertNotEqual(
+            fields.Datetime.to_string(self.server.last_job_full_sync),
+            "2000-01-01 00:00:00",
+        )
+
+    @mock.patch("%s.cups" % model)
+    def test_update_jobs_watermark(self, cups):
+        """It should store the highest CUPS job id seen"""
+        printer = self.new_printer()
+        printer_uri = "hostname:port/" + printer.system_name
+        cups.Connection().getJobs.return_value = {
+            1: {"printer-uri": printer_uri},
+            7: {"printer-uri": printer_uri, "job-state": 5},
+        }
+        self.server.update_jobs()
+        self.assertEqual(self.server.last_job_id_cups, 7)
+        self.assertTrue(self.server.last_job_full_sync)
+
+    @mock.patch("%s.cups" % model)
+    def test_update_jobs_batch(self, cups):
+        """It should create and update many jobs across printers at once"""
+        printer = self.new_printer()
+        self.printer_vals["system_name"] = "Other Sys Name"
+        other_printer = self.new_printer()
+        printer_uri = "hostname:port/" + printer.system_name
+        other_printer_uri = "hostname:port/" + other_printer.system_name
+        cups.Connection().getJobs.return_value = {
+            1: {"printer-uri": printer_uri, "job-state": 9},
+            2: {"printer-uri": other_printer_uri, "job-state": 9},
+            3: {"printer-uri": printer_uri, "job-state": 5},
+            4: {"printer-uri": other_printer_uri, "job-state": 3},
+            5: {"printer-uri": "hostname:port/unknown", "job-state": 3},
+        }
+        job_1 = self.new_job(printer, vals={"job_state": "processing"})
+        job_2 = self.new_job(
+            printer, vals={"job_id_cups": 2, "job_state": "processing"}
+        )
+        self.server.update_jobs()
+        jobs = self.env["printing.job"].search([("server_id", "=", self.server.id)])
+        self.assertEqual(sorted(jobs.mapped("job_id_cups")), [1, 2, 3, 4])
+        self.assertEqual(job_1.job_state, "completed")
+        self.assertEqual(job_2.job_state, "completed")
+        self.assertEqual(job_2.printer_id, other_printer)
+        new_job = jobs.filtered(lambda job: job.job_id_cups == 4)
+        self.assertEqual(new_job.printer_id, other_printer)
+        self.assertEqual(new_job.job_state, "pending")
+
+    @mock.patch("%s.cups" % model)
+    def test_sync_notifications_subscribe(self, cups):
+        """It should subscribe to the CUPS events, then poll the server"""
+        self.new_printer()
+        cups.Connection().createSubscription.return_value = 12
+        self.server.write(
+            {"use_subscription": True, "last_job_full_sync": fields.Datetime.now()}
+        )
+        self.server._sync_jobs()
+        cups.Connection().getNotifications.assert_not_called()
+        cups.Connection().getJobs.assert_called_once()
+        self.assertEqual(self.server.subscription_id_cups, 12)
+        self.assertEqual(self.server.subscription_sequence, 0)
+        self.assertTrue(self.server.subscription_expiry)
+
+    @mock.patch("%s.cups" % model)
+    def test_sync_notifications_events(self, cups):
+        """It should only fetch the jobs and printers found in the events"""
+        printer = self.new_printer()
+        job = self.new_job(printer, vals={"job_state": "processing"})
+        self.server.write(
+            {
+                "use_subscription": True,
+                "last_job_full_sync": fields.Datetime.now(),
+                "subscription_id_cups": 12,
+                "subscription_sequence": 4,
+                "subscription_expiry": "2100-01-01 00:00:00",
+            }
+        )
+        cups.Connection().getNotifications.return_value = {
+            "events": [
+                {
+                    "notify-subscription-id": 12,
+                    "notify-sequence-number": 5,
+                    "notify-subscribed-event": "job-completed",
+                    "notify-job-id": 1,
+                },
+                {
+                    "notify-subscription-id": 12,
+                    "notify-sequence-number": 6,
+                    "notify-subscribed-event": "printer-state-changed",
+                    "printer-name": printer.system_name,
+                    "printer-state": 5,
+                },
+            ]
+        }
+        cups.Connection().getJobAttributes.return_value = {
+            "printer-uri": "hostname:port/" + printer.system_name,
+            "job-state": 9,
+        }
+        self.server._sync_jobs()
+        cups.Connection().getNotifications.assert_called_once_with(
+            [12], sequence_numbers=[5]
+        )
+        cups.Connection().getJobs.assert_not_called()
+        cups.Connection().renewSubscription.assert_not_called()
+        self.assertEqual(job.job_state, "completed")
+        self.assertEqual(printer.status, "error")
+        self.assertEqual(self.server.subscription_sequence, 6)
+
+    @mock.patch("%s.cups" % model)
+    def test_sync_notifications_lost_events(self, cups):
+        """It should poll the server when some events were lost"""
+        self.new_printer()
+        self.server.write(
+            {
+                "use_subscription": True,
+                "last_job_full_sync": fields.Datetime.now(),
+                "subscription_id_cups": 12,
+                "subscription_sequence": 4,
+                "subscription_expiry": "2100-01-01 00:00:00",
+            }
+        )
+        cups.Connection().getNotifications.return_value = {
+            "events": [
+                {
+                    "notify-subscription-id": 12,
+                    "notify-sequence-number": 8,
+                    "notify-subscribed-event": "job-created",
+                    "notify-job-id": 3,
+                },
+            ]
+        }
+        cups.Connection().createSubscription.return_value = 13
+        self.server._sync_jobs()
+        cups.Connection().getJobs.assert_called_once()
+        self.assertEqual(self.server.subscription_id_cups, 13)
+        self.assertEqual(self.server.subscription_sequence, 0)
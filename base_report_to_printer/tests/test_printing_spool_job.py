@@ -0,0 +1,115 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import base64
+from datetime import timedelta
+from unittest import mock
+
+from odoo import fields
+from odoo.tests.common import TransactionCase
+
+from ..models.printing_spool_job import SPOOL_MAX_ATTEMPTS
+
+server_model = "odoo.addons.base_report_to_printer.models.printing_server"
+
+
+class TestPrintingSpoolJob(TransactionCase):
+    def setUp(self):
+        super(TestPrintingSpoolJob, self).setUp()
+        self.Model = self.env["printing.spool.job"]
+        self.server = self.env["printing.server"].create({})
+        self.printer = self.env["printing.printer"].create(
+            {
+                "name": "Printer",
+                "server_id": self.server.id,
+                "system_name": "Sys Name",
+                "spool": True,
+            }
+        )
+        self.report = self.env["ir.actions.report"].search([], limit=1)
+
+    @mock.patch("%s.cups" % server_model)
+    def test_print_document_enqueue(self, cups):
+        """It should queue the documents of a spooling printer"""
+        self.printer.print_document(
+            self.report, b"content to print", doc_format="pdf", title="Title"
+        )
+        cups.Connection.assert_not_called()
+        job = self.Model.search([("printer_id", "=", self.printer.id)])
+        self.assertEqual(job.state, "pending")
+        self.assertEqual(job.name, "Title")
+        self.assertEqual(job.report_id, self.report)
+        self.assertEqual(base64.b64decode(job.content), b"content to print")
+
+    @mock.patch("%s.cups" % server_model)
+    def test_dispatch(self, cups):
+        """It should send the queued documents in order"""
+        self.printer.print_document(self.report, b"first", title="First")
+        self.printer.print_document(None, iter([b"sec", b"ond"]), title="Second")
+        self.Model._dispatch()
+        connection = cups.Connection()
+        self.assertEqual(
+            [call[0][1] for call in connection.createJob.call_args_list],
+            ["First", "Second"],
+        )
+        self.assertEqual(
+            [call[0][0] for call in connection.writeRequestData.call_args_list],
+            [b"first", b"second"],
+        )
+        jobs = self.Model.search([("printer_id", "=", self.printer.id)])
+        self.assertEqual(jobs.mapped("state"), ["done", "done"])
+        self.assertFalse(any(jobs.mapped("content")))
+
+    @mock.patch("%s.cups" % server_model)
+    def test_dispatch_printer_in_thread(self, cups):
+        """It should drain the queue of a printer with its own cursor"""
+        self.printer.print_document(self.report, b"first", title="First")
+        new_cursor = mock.MagicMock()
+        new_cursor.__enter__.return_value = self.env.cr
+        with mock.patch.object(
+            self.env.registry, "cursor", return_value=new_cursor
+        ) as cursor:
+            self.Model._dispatch_printer_in_thread(self.printer.id)
+        cursor.assert_called_once_with()
+        cups.Connection().createJob.assert_called_once()
+        job = self.Model.search([("printer_id", "=", self.printer.id)])
+        job.invalidate_cache()
+        self.assertEqual(job.state, "done")
+
+    @mock.patch("%s.cups" % server_model)
+    def test_dispatch_retry(self, cups):
+        """It should retry later and keep the following documents queued"""
+        self.printer.print_document(self.report, b"first", title="First")
+        self.printer.print_document(self.report, b"second", title="Second")
+        cups.Connection.side_effect = Exception
+        self.Model._dispatch()
+        first, second = self.Model.search([("printer_id", "=", self.printer.id)])
+        self.assertEqual(first.state, "pending")
+        self.assertEqual(first.attempts, 1)
+        self.assertTrue(first.error_message)
+        self.assertGreater(first.next_attempt, fields.Datetime.now())
+        self.assertEqual(second.attempts, 0)
+
+        # Not sent before the next attempt
+        cups.Connection.side_effect = None
+        self.Model._dispatch()
+        self.assertEqual(first.state, "pending")
+
+        first.next_attempt = fields.Datetime.now() - timedelta(seconds=1)
+        self.Model._dispatch()
+        self.assertEqual(first.state, "done")
+        self.assertEqual(second.state, "done")
+
+    @mock.patch("%s.cups" % server_model)
+    def test_dispatch_failed(self, cups):
+        """It should give up a document after too many attempts"""
+        self.printer.print_document(self.report, b"first", title="First")
+        self.printer.print_document(self.report, b"second", title="Second")
+        first, second = self.Model.search([("printer_id", "=", self.printer.id)])
+        first.attempts = SPOOL_MAX_ATTEMPTS - 1
+        cups.Connection().createJob.side_effect = [Exception, 1]
+        self.Model._dispatch()
+        self.assertEqual(first.state, "failed")
+        self.assertEqual(second.state, "done")
+        first.action_retry()
+        self.assertEqual(first.state, "pending")
+        self.assertEqual(first.attempts, 0)
@@ -7,6 +7,8 @@ from unittest import mock
 from odoo import exceptions
 from odoo.tests import common
 
+from ..models.ir_actions_report import RenderCache
+
 
 class TestReport(common.HttpCase):
     def setUp(self):
@@ -162,3 +164,90 @@ class TestReport(common.HttpCase):
         """It should raise an error"""
         with self.assertRaises(exceptions.UserError):
             self.report.print_document(self.partners.ids)
+
+    def test_print_document_from_client_server(self):
+        """It should print the report when it is sent to the printer"""
+        self.report.property_printing_action_id.action_type = "server"
+        printer = self.new_printer()
+        self.report.printing_printer_id = printer
+        with mock.patch(
+            "odoo.addons.base_report_to_printer.models."
+            "printing_printer.PrintingPrinter."
+            "print_document"
+        ) as print_document:
+            res = self.report.print_document_from_client(self.partners.ids)
+            print_document.assert_called_once()
+        self.assertEqual(res, {"action": "server", "printer_name": printer.name})
+
+    def test_print_document_from_client_error(self):
+        """It should return the error when the document is not sent"""
+        self.report.property_printing_action_id.action_type = "server"
+        printer = self.new_printer()
+        self.report.printing_printer_id = printer
+        with mock.patch(
+            "odoo.addons.base_report_to_printer.models."
+            "printing_printer.PrintingPrinter."
+            "print_document",
+            side_effect=exceptions.UserError("Printer offline"),
+        ):
+            res = self.report.print_document_from_client(self.partners.ids)
+        self.assertEqual(
+            res,
+            {
+                "action": "server",
+                "printer_name": printer.name,
+                "error": "Printer offline",
+            },
+        )
+
+    def test_print_document_from_client_client(self):
+        """It should not print the report when it is downloaded"""
+        self.env.user.printing_action = "client"
+        self.report.property_printing_action_id = False
+        with mock.patch(
+            "odoo.addons.base_report_to_printer.models."
+            "printing_printer.PrintingPrinter."
+            "print_document"
+        ) as print_document:
+            res = self.report.print_document_from_client(self.partners.ids)
+            print_document.assert_not_called()
+        self.assertEqual(res["action"], "client")
+
+    def test_print_document_render_cache(self):
+        """It should render the same document once when it is cached"""
+        self.report.printing_printer_id = self.new_printer()
+        self.report.printing_render_cache = True
+        with mock.patch(
+            "odoo.addons.base_report_to_printer.models."
+            "printing_printer.PrintingPrinter."
+            "print_document"
+        ) as print_document, mock.patch.object(
+            type(self.report),
+            "_render_qweb_pdf",
+            autospec=True,
+            return_value=(b"document", "pdf"),
+        ) as render:
+            self.report.print_document(self.partners.ids)
+            self.report.print_document(self.partners.ids)
+            self.assertEqual(render.call_count, 1)
+            self.assertEqual(print_document.call_count, 2)
+            self.assertEqual(print_document.call_args[0][1], b"document")
+            self.report.print_document(self.partners[:2].ids)
+            self.report.print_document(self.partners.ids, data={"copies": 2})
+            self.assertEqual(render.call_count, 3)
+            self.report.printing_render_cache = False
+            self.report.print_document(self.partners.ids)
+            self.assertEqual(render.call_count, 4)
+
+    def test_render_cache_size(self):
+        """It should drop the least recently used documents when full"""
+        cache = RenderCache(10)
+        cache.set(1, (b"1111", "pdf"))
+        cache.set(2, (b"2222", "pdf"))
+        cache.get(1)
+        cache.set(3, (b"3333", "pdf"))
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), (b"1111", "pdf"))
+        self.assertEqual(cache.size, 8)
+        cache.set(4, (b"4" * 11, "pdf"))
+        self.assertIsNone(cache.get(4))
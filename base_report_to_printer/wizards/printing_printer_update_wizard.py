@@ -16,7 +16,9 @@ class PrintingPrinterUpdateWizard(models.TransientModel):
     _description = "Printing Printer Update Wizard"
 
     def action_ok(self):
-        self.env["printing.server"].search([]).update_printers(raise_on_error=True)
+        self.env["printing.server"].search([]).update_printers(
+            raise_on_error=True, force=True
+        )
 
         return {
             "name": "Printers",
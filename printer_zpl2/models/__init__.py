@@ -3,3 +3,6 @@
 
 from . import printing_label_zpl2_component
 from . import printing_label_zpl2
+from . import printing_label_zpl2_format
+from . import printing_job
+from . import printing_spool_job
@@ -0,0 +1,29 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import api, models
+
+# States of the CUPS jobs whose data may not have reached the printer
+FAILED_JOB_STATES = ("canceled", "aborted")
+
+
+class PrintingJob(models.Model):
+    _inherit = "printing.job"
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        jobs = super().create(vals_list)
+        jobs._reset_stored_formats()
+        return jobs
+
+    def write(self, vals):
+        res = super().write(vals)
+        if vals.get("job_state") in FAILED_JOB_STATES:
+            self._reset_stored_formats()
+        return res
+
+    def _reset_stored_formats(self):
+        """Download the stored formats again on the printers of failed jobs"""
+        printers = self.filtered(lambda job: job.job_state in FAILED_JOB_STATES).mapped(
+            "printer_id"
+        )
+        self.env["printing.label.zpl2.format"]._reset_printers(printers)
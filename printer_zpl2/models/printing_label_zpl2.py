@@ -2,22 +2,57 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 import base64
+import hashlib
 import io
 import itertools
 import logging
+import types
 from collections import defaultdict
+from datetime import timedelta
 
-import requests
 from PIL import Image, ImageOps
 
-from odoo import _, api, exceptions, fields, models
+from odoo import _, api, exceptions, fields, models, tools
 from odoo.exceptions import ValidationError
-from odoo.tools.safe_eval import safe_eval, wrap_module
+from odoo.tools import split_every
+from odoo.tools.lru import LRU
+from odoo.tools.safe_eval import check_values, safe_eval, wrap_module
 
-from . import zpl2
+from . import zpl2, zpl2_render
 
 _logger = logging.getLogger(__name__)
 
+# Number of converted graphic images kept in memory
+GRAPHIC_CACHE_SIZE = 64
+_graphic_cache = LRU(GRAPHIC_CACHE_SIZE)
+
+# Number of emulated images kept in memory, and defaults of the images shared
+# between the workers as attachments
+PREVIEW_CACHE_SIZE = 32
+PREVIEW_ATTACHMENT_PREFIX = "printer_zpl2_preview_"
+PREVIEW_ATTACHMENT_DAYS = 7
+PREVIEW_ATTACHMENT_COUNT = 500
+_preview_cache = LRU(PREVIEW_CACHE_SIZE)
+
+# Digits of the ids in the names of the stored formats, which Zebra printers
+# limit to 8 characters
+STORED_FORMAT_DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+EVAL_TIME = wrap_module(__import__("time"), ["time", "strptime", "strftime"])
+EVAL_DATETIME = wrap_module(
+    __import__("datetime"),
+    [
+        "date",
+        "datetime",
+        "time",
+        "timedelta",
+        "timezone",
+        "tzinfo",
+        "MAXYEAR",
+        "MINYEAR",
+    ],
+)
+
 
 class PrintingLabelZpl2(models.Model):
     _name = "printing.label.zpl2"
@@ -56,11 +91,41 @@ class PrintingLabelZpl2(models.Model):
         help="Components which will be printed on the label.",
         copy=True,
     )
+    stored_format = fields.Boolean(
+        string="Use Stored Format",
+        help="Download the static parts of the label once in the printer "
+        "memory, then only send the variable data of each label. Not used if "
+        "the label contains sublabels, ZPL2 or repeatable components, "
+        "autofilled data, or graphics and shapes depending on the record.",
+    )
+    stored_format_ids = fields.One2many(
+        comodel_name="printing.label.zpl2.format",
+        inverse_name="label_id",
+        string="Stored Formats",
+        readonly=True,
+        help="Printers holding the stored format of this label.",
+    )
     restore_saved_config = fields.Boolean(
         string="Restore printer's configuration",
         help="Restore printer's saved configuration and end of each label ",
         default=True,
     )
+    graphic_compression = fields.Selection(
+        selection=[
+            (zpl2.GRAPHIC_COMPRESSION_NONE, "Hexadecimal"),
+            (zpl2.GRAPHIC_COMPRESSION_ACS, "ASCII Compression"),
+            (zpl2.GRAPHIC_COMPRESSION_Z64, "Z64"),
+        ],
+        required=True,
+        default=zpl2.GRAPHIC_COMPRESSION_NONE,
+        help="Encoding of the graphics sent to the printer. The compressed "
+        "encodings are much smaller, but are not supported by old printers.",
+    )
+    batch_size = fields.Integer(
+        default=0,
+        help="Maximum number of records whose labels are sent to the printer "
+        "in a single job. Set to 0 to send all the labels in one job.",
+    )
     action_window_id = fields.Many2one(
         comodel_name="ir.actions.act_window",
         string="Action",
@@ -72,7 +137,7 @@ class PrintingLabelZpl2(models.Model):
     extra = fields.Text(string="Extra", default="{}")
     printer_id = fields.Many2one(comodel_name="printing.printer", string="Printer")
     labelary_image = fields.Binary(
-        string="Image from Labelary", compute="_compute_labelary_image"
+        string="Emulated Image", compute="_compute_labelary_image"
     )
     labelary_dpmm = fields.Selection(
         selection=[
@@ -124,9 +189,59 @@ class PrintingLabelZpl2(models.Model):
     def _get_component_data(self, record, component, eval_args):
         if component.data_autofill:
             data = component.autofill_data(record, eval_args)
+            return safe_eval(str(data), eval_args) or ""
+        return self._eval_component_data(component, eval_args) or ""
+
+    @api.model
+    def _compile_data(self, data):
+        """Return the data of a component as a function without arguments,
+        checked and compiled by ``safe_eval``"""
+        return safe_eval("lambda: (\n%s\n)" % data, {}, nocopy=True)
+
+    @api.model
+    @tools.ormcache("component.id", "component.write_date")
+    def _compile_component_data(self, component):
+        """Return the compiled data of a component
+
+        The cache is cleared when a component is modified.
+        """
+        return self._compile_data(str(component.data))
+
+    @api.model
+    def _eval_component_data(self, component, eval_args):
+        """Evaluate the data of a component like ``safe_eval`` does, with
+        its compiled code kept in cache"""
+        if isinstance(component.id, models.NewId):
+            # Unsaved component, its data may still change
+            function = self._compile_data(str(component.data))
         else:
-            data = component.data
-        return safe_eval(str(data), eval_args) or ""
+            function = self._compile_component_data(component)
+        # Evaluate the checked code with the restricted builtins set by
+        # safe_eval, and the values of the current record
+        globals_dict = dict(
+            eval_args, __builtins__=function.__globals__["__builtins__"]
+        )
+        try:
+            return types.FunctionType(function.__code__, globals_dict)()
+        except exceptions.UserError:
+            raise
+        except Exception as e:
+            raise ValueError(
+                '{}: "{}" while evaluating\n{!r}'.format(type(e), e, component.data)
+            )
+
+    def _get_eval_args(self, record, page_number, page_count, extra):
+        eval_args = extra
+        eval_args.update(
+            {
+                "object": record,
+                "page_number": str(page_number + 1),
+                "page_count": str(page_count),
+                "time": EVAL_TIME,
+                "datetime": EVAL_DATETIME,
+            }
+        )
+        return check_values(eval_args)
 
     def _get_to_data_to_print(
         self,
@@ -138,31 +253,8 @@ class PrintingLabelZpl2(models.Model):
         **extra
     ):
         to_print = []
+        eval_args = self._get_eval_args(record, page_number, page_count, extra)
         for component in self.component_ids:
-            eval_args = extra
-            eval_args.update(
-                {
-                    "object": record,
-                    "page_number": str(page_number + 1),
-                    "page_count": str(page_count),
-                    "time": wrap_module(
-                        __import__("time"), ["time", "strptime", "strftime"]
-                    ),
-                    "datetime": wrap_module(
-                        __import__("datetime"),
-                        [
-                            "date",
-                            "datetime",
-                            "time",
-                            "timedelta",
-                            "timezone",
-                            "tzinfo",
-                            "MAXYEAR",
-                            "MINYEAR",
-                        ],
-                    ),
-                }
-            )
             data = self._get_component_data(record, component, eval_args)
             if isinstance(data, str) and data == "component_not_show":
                 continue
@@ -193,7 +285,6 @@ class PrintingLabelZpl2(models.Model):
                 )
         return to_print
 
-    # flake8: noqa: C901
     def _generate_zpl2_components_data(
         self,
         label_data,
@@ -207,7 +298,10 @@ class PrintingLabelZpl2(models.Model):
         to_print = self._get_to_data_to_print(
             record, page_number, page_count, label_offset_x, label_offset_y, **extra
         )
+        self._write_zpl2_components_data(label_data, record, to_print)
 
+    # flake8: noqa: C901
+    def _write_zpl2_components_data(self, label_data, record, to_print):
         for (component, data, offset_x, offset_y) in to_print:
             component_offset_x = component.origin_x + offset_x
             component_offset_y = component.origin_y + offset_y
@@ -263,29 +357,11 @@ class PrintingLabelZpl2(models.Model):
                     component.with_context(bin_size_graphic_image=False).graphic_image
                     or data
                 )
-                try:
-                    pil_image = Image.open(io.BytesIO(base64.b64decode(image))).convert(
-                        "RGB"
-                    )
-                except Exception:
+                graphic_data = self._get_graphic_data(component, image)
+                if not graphic_data:
                     continue
-                if component.width and component.height:
-                    pil_image = pil_image.resize((component.width, component.height))
-
-                # Invert the colors
-                if component.reverse_print:
-                    pil_image = ImageOps.invert(pil_image)
-
-                # Rotation (PIL rotates counter clockwise)
-                if component.orientation == zpl2.ORIENTATION_ROTATED:
-                    pil_image = pil_image.transpose(Image.ROTATE_270)
-                elif component.orientation == zpl2.ORIENTATION_INVERTED:
-                    pil_image = pil_image.transpose(Image.ROTATE_180)
-                elif component.orientation == zpl2.ORIENTATION_BOTTOM_UP:
-                    pil_image = pil_image.transpose(Image.ROTATE_90)
-
-                label_data.graphic_field(
-                    component_offset_x, component_offset_y, pil_image
+                label_data.graphic_field_command(
+                    component_offset_x, component_offset_y, graphic_data
                 )
             elif component.component_type == "circle":
                 label_data.graphic_circle(
@@ -307,9 +383,11 @@ class PrintingLabelZpl2(models.Model):
                     label_offset_y=component_offset_y,
                 )
             else:
-                if component.component_type == zpl2.BARCODE_QR_CODE:
+                if component.component_type == zpl2.BARCODE_QR_CODE and not isinstance(
+                    data, zpl2.FieldNumber
+                ):
                     # Adding Control Arguments to QRCode data Label
-                    data = "{}A,{}".format(component.error_correction, data)
+                    data = self._get_qr_code_data(component, data)
 
                 barcode_arguments = {
                     field_name: component[field_name]
@@ -368,19 +446,247 @@ class PrintingLabelZpl2(models.Model):
 
         return label_data.output()
 
-    def print_label(self, printer, record, page_count=1, **extra):
+    def _get_graphic_data(self, component, image):
+        """Return the ^GF command printing the image of a graphic component
+
+        The commands are cached, an image is only converted once for each
+        combination of size, orientation, colors and compression.
+        """
+        self.ensure_one()
+        if isinstance(image, str):
+            image = image.encode()
+        key = (
+            hashlib.sha1(image).hexdigest(),
+            component.width,
+            component.height,
+            component.orientation,
+            component.reverse_print,
+            self.graphic_compression,
+        )
+        graphic_data = _graphic_cache.get(key)
+        if graphic_data is not None:
+            return graphic_data
+        try:
+            pil_image = Image.open(io.BytesIO(base64.b64decode(image))).convert("RGB")
+        except Exception:
+            return None
+        if component.width and component.height:
+            pil_image = pil_image.resize((component.width, component.height))
+
+        # Invert the colors
+        if component.reverse_print:
+            pil_image = ImageOps.invert(pil_image)
+
+        # Rotation (PIL rotates counter clockwise)
+        if component.orientation == zpl2.ORIENTATION_ROTATED:
+            pil_image = pil_image.transpose(Image.ROTATE_270)
+        elif component.orientation == zpl2.ORIENTATION_INVERTED:
+            pil_image = pil_image.transpose(Image.ROTATE_180)
+        elif component.orientation == zpl2.ORIENTATION_BOTTOM_UP:
+            pil_image = pil_image.transpose(Image.ROTATE_90)
+
+        graphic_data = zpl2.Zpl2().graphic_field_data(
+            pil_image, compression=self.graphic_compression
+        )
+        _graphic_cache[key] = graphic_data
+        return graphic_data
+
+    def _get_qr_code_data(self, component, data):
+        return "{}A,{}".format(component.error_correction, data)
+
+    def _get_stored_format_name(self):
+        """Return the name of the stored format, ``OD`` followed by the id of
+        the label in base 36, which fits in 8 characters up to 2 billions"""
+        self.ensure_one()
+        number = self.id
+        name = ""
+        while True:
+            number, digit = divmod(number, len(STORED_FORMAT_DIGITS))
+            name = STORED_FORMAT_DIGITS[digit] + name
+            if not number:
+                break
+        return "E:OD%s.ZPL" % name
+
+    @api.model
+    @tools.ormcache("data")
+    def _get_data_names(self, data):
+        """Return the names used by the data of a component, to tell
+        whether it depends on the printed record"""
+        return compile(data, "<component>", "eval").co_names
+
+    def _get_stored_format_fields(self):
+        """Return the components printed in the variable fields of the stored
+        format, or ``None`` when the label cannot be stored in the printer
+
+        Only text and barcode components can be variable, the other ones must
+        not depend on the printed record.
+        """
+        self.ensure_one()
+        variable_components = []
+        for component in self.component_ids:
+            if (
+                component.component_type in ("sublabel", "zpl2_raw")
+                or component.repeat
+                or component.data_autofill
+            ):
+                return None
+            try:
+                constant = not self._get_data_names(str(component.data))
+            except SyntaxError:
+                # Reported when the label is printed without stored format
+                return None
+            if component.component_type in ("rectangle", "diagonal", "circle"):
+                if not constant:
+                    return None
+            elif component.component_type == "graphic":
+                if not constant or not component.graphic_image:
+                    return None
+            elif not constant:
+                variable_components.append(component)
+        return variable_components
+
+    def _generate_zpl2_format_data(self, format_fields):
+        """Generate the definition of the stored format of the label"""
+        self.ensure_one()
+        label_data = zpl2.Zpl2()
+        label_data.label_start()
+        label_data.download_format(self._get_stored_format_name())
+        label_data.print_width(self.width)
+        label_data.label_encoding()
+        label_data.label_home(self.origin_x, self.origin_y)
+
+        record = self.env[self.model_id.model]
+        to_print = []
+        for component in self.component_ids:
+            if component in format_fields:
+                data = zpl2.FieldNumber(format_fields.index(component) + 1)
+            else:
+                data = self._get_component_data(record, component, {})
+                if isinstance(data, str) and data == "component_not_show":
+                    continue
+            to_print.append((component, data, 0, 0))
+        self._write_zpl2_components_data(label_data, record, to_print)
+
+        label_data.label_end()
+        return label_data.output()
+
+    def _generate_zpl2_stored_format_data(
+        self, record, format_fields, page_count=1, **extra
+    ):
+        """Generate the labels of a record using the stored format"""
+        self.ensure_one()
+        label_data = zpl2.Zpl2()
+        for page_number in range(page_count):
+            label_data.label_start()
+            label_data.recall_format(self._get_stored_format_name())
+            label_data.label_encoding()
+
+            eval_args = self._get_eval_args(record, page_number, page_count, extra)
+            for number, component in enumerate(format_fields, 1):
+                data = self._get_component_data(record, component, eval_args)
+                if isinstance(data, str) and data == "component_not_show":
+                    data = ""
+                elif component.component_type == zpl2.BARCODE_QR_CODE:
+                    data = self._get_qr_code_data(component, data)
+                label_data.field_number_data(number, data)
+
+            # Restore printer's configuration and end the label
+            if self.restore_saved_config:
+                label_data.configuration_update(zpl2.CONF_RECALL_LAST_SAVED)
+            label_data.label_end()
+
+        return label_data.output()
+
+    def _get_stored_format_download(self, printer, format_fields):
+        """Return the definition of the stored format to send to the printer
+        and its version, or nothing when the printer already holds its
+        current version
+
+        The version must be recorded with :meth:`_set_stored_format_version`
+        once the definition was sent to the printer.
+        """
+        self.ensure_one()
+        format_data = self._generate_zpl2_format_data(format_fields)
+        version = hashlib.sha1(format_data).hexdigest()
+        stored_format = self.stored_format_ids.filtered(
+            lambda stored_format: stored_format.printer_id == printer
+        )
+        if stored_format.version == version:
+            return b"", False
+        return format_data, version
+
+    def _set_stored_format_version(self, printer, version):
+        self.ensure_one()
+        stored_format = self.stored_format_ids.filtered(
+            lambda stored_format: stored_format.printer_id == printer
+        )
+        if stored_format:
+            stored_format.sudo().version = version
+        else:
+            self.env["printing.label.zpl2.format"].sudo().create(
+                {"label_id": self.id, "printer_id": printer.id, "version": version}
+            )
+
+    def action_reset_stored_formats(self):
+        """Download the stored formats again on the next print, for example
+        after the memory of a printer was cleared"""
+        self.mapped("stored_format_ids").unlink()
+        return True
+
+    def _iter_zpl2_stored_format_data(
+        self, format_data, records, format_fields, page_count=1, **extra
+    ):
+        self.ensure_one()
+        if format_data:
+            yield format_data
+        for record in records:
+            yield self._generate_zpl2_stored_format_data(
+                record, format_fields, page_count=page_count, **extra
+            )
+
+    def _iter_zpl2_data(self, records, page_count=1, **extra):
+        self.ensure_one()
+        for record in records:
+            yield self._generate_zpl2_data(record, page_count=page_count, **extra)
+
+    def print_label(self, printer, record, page_count=1, batch_size=None, **extra):
+        """Print the labels of one or several records
+
+        The labels of all the records are sent to the printer in a single raw
+        job, or in jobs of ``batch_size`` records (the ``batch_size`` of the
+        label by default).
+        """
         for label in self:
             if record._name != label.model_id.model:
                 raise exceptions.UserError(
                     _("This label cannot be used on {model}").format(model=record._name)
                 )
-            # Send the label to printer
-            label_contents = label._generate_zpl2_data(
-                record, page_count=page_count, **extra
-            )
-            printer.print_document(
-                report=None, content=label_contents, doc_format="raw"
-            )
+            format_fields = None
+            if label.stored_format:
+                format_fields = label._get_stored_format_fields()
+            size = label.batch_size if batch_size is None else batch_size
+            for records in split_every(size or len(record), record.ids, record.browse):
+                version = False
+                if format_fields is not None:
+                    format_data, version = label._get_stored_format_download(
+                        printer, format_fields
+                    )
+                    content = label._iter_zpl2_stored_format_data(
+                        format_data,
+                        records,
+                        format_fields,
+                        page_count=page_count,
+                        **extra
+                    )
+                else:
+                    content = label._iter_zpl2_data(
+                        records, page_count=page_count, **extra
+                    )
+                # Send the labels to printer
+                printer.print_document(report=None, content=content, doc_format="raw")
+                # The format is only known to be stored once sent
+                if version:
+                    label._set_stored_format_version(printer, version)
         return True
 
     @api.model
@@ -495,34 +801,88 @@ class PrintingLabelZpl2(models.Model):
             # If case there an error (in the data field with the safe_eval
             # for exemple) the new component or the update is not lost.
             try:
-                url = (
-                    "http://api.labelary.com/v1/printers/"
-                    "{dpmm}/labels/{width}x{height}/0/"
-                )
-                width = round(self.labelary_width / 25.4, 2)
-                height = round(self.labelary_height / 25.4, 2)
-                url = url.format(dpmm=self.labelary_dpmm, width=width, height=height)
                 extra = safe_eval(self.extra, {"env": self.env})
                 zpl_file = self._generate_zpl2_data(record, labelary_emul=True, **extra)
-                files = {"file": zpl_file}
-                headers = {"Accept": "image/png"}
-                response = requests.post(url, headers=headers, files=files, stream=True)
-                if response.status_code == 200:
-                    # Add a padd
-                    im = Image.open(io.BytesIO(response.content))
-                    im_size = im.size
-                    new_im = Image.new(
-                        "RGB", (im_size[0] + 2, im_size[1] + 2), (164, 164, 164)
-                    )
-                    new_im.paste(im, (1, 1))
-                    imgByteArr = io.BytesIO()
-                    new_im.save(imgByteArr, format="PNG")
-                    return base64.b64encode(imgByteArr.getvalue())
-                else:
-                    _logger.warning(
-                        _("Error with Labelary API. %s") % response.status_code
-                    )
-
+                return self._get_labelary_image(zpl_file)
             except Exception as e:
-                _logger.warning(_("Error with Labelary API. %s") % e)
+                _logger.warning(_("Error with the label emulation. %s") % e)
         return False
+
+    def _get_labelary_image_key(self, zpl_data):
+        self.ensure_one()
+        settings = "{},{},{}:".format(
+            self.labelary_dpmm, self.labelary_width, self.labelary_height
+        )
+        return hashlib.sha1(settings.encode() + zpl_data).hexdigest()
+
+    def _get_labelary_image(self, zpl_data):
+        """Return the emulated image of some ZPL II data
+
+        The images are cached in memory, and shared with the other workers as
+        attachments, so that an image is only drawn again when the generated
+        data or the emulation settings change.
+        """
+        self.ensure_one()
+        key = self._get_labelary_image_key(zpl_data)
+        image = _preview_cache.get(key)
+        if image is not None:
+            return image
+        attachment_name = PREVIEW_ATTACHMENT_PREFIX + key
+        attachments = self.env["ir.attachment"].sudo()
+        attachment = attachments.search(
+            [("res_model", "=", self._name), ("name", "=", attachment_name)], limit=1
+        )
+        if attachment:
+            image = attachment.datas
+        else:
+            image = self._render_labelary_image(zpl_data)
+            attachments.create(
+                {
+                    "name": attachment_name,
+                    "res_model": self._name,
+                    "datas": image,
+                    "mimetype": "image/png",
+                }
+            )
+        _preview_cache[key] = image
+        return image
+
+    def _render_labelary_image(self, zpl_data):
+        self.ensure_one()
+        im = zpl2_render.render(
+            zpl_data,
+            int(self.labelary_dpmm.replace("dpmm", "")),
+            self.labelary_width,
+            self.labelary_height,
+        )
+        # Add a padd
+        im_size = im.size
+        new_im = Image.new("RGB", (im_size[0] + 2, im_size[1] + 2), (164, 164, 164))
+        new_im.paste(im, (1, 1))
+        imgByteArr = io.BytesIO()
+        new_im.save(imgByteArr, format="PNG")
+        return base64.b64encode(imgByteArr.getvalue())
+
+    @api.autovacuum
+    def _gc_labelary_images(self):
+        """Remove the shared emulated images which are too old or too many"""
+        params = self.env["ir.config_parameter"].sudo()
+        days = int(
+            params.get_param("printer_zpl2.preview_cache_days", PREVIEW_ATTACHMENT_DAYS)
+        )
+        count = int(
+            params.get_param(
+                "printer_zpl2.preview_cache_count", PREVIEW_ATTACHMENT_COUNT
+            )
+        )
+        attachments = self.env["ir.attachment"].sudo()
+        domain = [
+            ("res_model", "=", self._name),
+            ("name", "=like", PREVIEW_ATTACHMENT_PREFIX + "%"),
+        ]
+        limit_date = fields.Datetime.now() - timedelta(days=days)
+        expired = attachments.search(domain + [("create_date", "<", limit_date)])
+        expired |= attachments.search(
+            domain, order="create_date desc, id desc", offset=count
+        )
+        expired.unlink()
@@ -238,6 +238,17 @@ class PrintingLabelZpl2Component(models.Model):
         "If not set, the data field is evaluated.",
     )
 
+    def write(self, vals):
+        res = super().write(vals)
+        # Drop the compiled data of the components
+        self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.clear_caches()
+        return res
+
     def process_model(self, model):
         # Used for expansions of this module
         return model
@@ -0,0 +1,41 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import api, fields, models
+
+
+class PrintingLabelZpl2Format(models.Model):
+    _name = "printing.label.zpl2.format"
+    _description = "ZPL II Label Stored Format"
+
+    label_id = fields.Many2one(
+        comodel_name="printing.label.zpl2",
+        string="Label",
+        required=True,
+        ondelete="cascade",
+        help="Label stored in the printer memory.",
+    )
+    printer_id = fields.Many2one(
+        comodel_name="printing.printer",
+        string="Printer",
+        required=True,
+        ondelete="cascade",
+        help="Printer holding the stored format.",
+    )
+    version = fields.Char(
+        required=True, help="Checksum of the format stored in the printer memory."
+    )
+
+    _sql_constraints = [
+        (
+            "label_printer_unique",
+            "UNIQUE(label_id, printer_id)",
+            "A label can only be stored once per printer !",
+        )
+    ]
+
+    @api.model
+    def _reset_printers(self, printers):
+        """Download the formats again on printers which may have missed them,
+        because a document sent to them failed"""
+        if printers:
+            self.sudo().search([("printer_id", "in", printers.ids)]).unlink()
@@ -0,0 +1,22 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import models
+
+
+class PrintingSpoolJob(models.Model):
+    _inherit = "printing.spool.job"
+
+    def _send(self):
+        res = super()._send()
+        if not res:
+            # The stored formats of the document may not have been downloaded
+            self.env["printing.label.zpl2.format"]._reset_printers(self.printer_id)
+        return res
+
+    def action_cancel(self):
+        printers = self.filtered(lambda job: job.state == "pending").mapped(
+            "printer_id"
+        )
+        res = super().action_cancel()
+        self.env["printing.label.zpl2.format"]._reset_printers(printers)
+        return res
@@ -5,8 +5,11 @@
 # of code is not too much, we put it on the module itself, being able to control the
 # whole chain, and to reduce the code with the considerations of current Odoo version
 
+import base64
 import binascii
+import itertools
 import math
+import zlib
 
 from PIL import ImageOps
 
@@ -105,6 +108,123 @@ BARCODE_CODE_128 = "code_128"
 BARCODE_EAN_13 = "ean-13"
 BARCODE_QR_CODE = "qr_code"
 
+# Graphic data encodings
+GRAPHIC_COMPRESSION_NONE = "hex"
+GRAPHIC_COMPRESSION_ACS = "acs"
+GRAPHIC_COMPRESSION_Z64 = "z64"
+
+# Highest repeat count of a single ZPL ASCII compression code
+ACS_MAX_COUNT = 419
+
+
+def _acs_count(count):
+    """Return the ASCII compression code repeating a character count times"""
+    if count == 1:
+        return ""
+    code = ""
+    if count >= 20:
+        # g to z: 20 to 400, by steps of 20
+        code += chr(ord("g") + count // 20 - 1)
+    if count % 20:
+        # G to Y: 1 to 19
+        code += chr(ord("G") + count % 20 - 1)
+    return code
+
+
+def _encode_acs_row(row):
+    end = ""
+    # Fill the end of the row with zeros (",") or ones ("!")
+    for char, shortcut in (("0", ","), ("F", "!")):
+        stripped = row.rstrip(char)
+        if len(stripped) < len(row):
+            row, end = stripped, shortcut
+            break
+    codes = []
+    for char, group in itertools.groupby(row):
+        count = len(list(group))
+        while count:
+            repeat = min(count, ACS_MAX_COUNT)
+            codes.append(_acs_count(repeat) + char)
+            count -= repeat
+    return "".join(codes) + end
+
+
+def encode_acs(data, bytes_per_row):
+    """Encode a bitmap with the ZPL ASCII compression scheme"""
+    hex_data = binascii.hexlify(data).decode("ascii").upper()
+    row_size = bytes_per_row * 2
+    rows = []
+    previous_row = None
+    for index in range(0, len(hex_data), row_size):
+        row = hex_data[index : index + row_size]
+        # Repeat the previous row (":")
+        rows.append(":" if row == previous_row else _encode_acs_row(row))
+        previous_row = row
+    return "".join(rows)
+
+
+def decode_acs(data, bytes_per_row):
+    """Decode a bitmap encoded in hexadecimal, with or without the ZPL ASCII
+    compression scheme"""
+    row_size = bytes_per_row * 2
+    hex_data = []
+    row = ""
+    count = 0
+    for char in data:
+        if "G" <= char <= "Y":
+            count += ord(char) - ord("G") + 1
+            continue
+        elif "g" <= char <= "z":
+            count += (ord(char) - ord("g") + 1) * 20
+            continue
+        elif char in "0123456789ABCDEF":
+            row += char * (count or 1)
+        elif char == ",":
+            row += "0" * (row_size - len(row))
+        elif char == "!":
+            row += "F" * (row_size - len(row))
+        elif char == ":":
+            row += hex_data[-1] if hex_data else "0" * row_size
+        count = 0
+        while len(row) >= row_size:
+            hex_data.append(row[:row_size])
+            row = row[row_size:]
+    if row:
+        hex_data.append(row.ljust(row_size, "0"))
+    return binascii.unhexlify("".join(hex_data))
+
+
+def encode_z64(data):
+    """Encode a bitmap in the ZPL Z64 format (deflate, base64 and CRC)"""
+    encoded = base64.b64encode(zlib.compress(data))
+    return ":Z64:{data}:{crc:04x}".format(
+        data=encoded.decode("ascii"), crc=binascii.crc_hqx(encoded, 0)
+    )
+
+
+def decode_z64(data):
+    """Decode a bitmap encoded in the ZPL Z64 or B64 format"""
+    _empty, encoding, encoded, crc = data.strip().split(":")
+    encoded = encoded.encode("ascii")
+    if crc and int(crc, 16) != binascii.crc_hqx(encoded, 0):
+        raise ValueError("Invalid CRC of the %s graphic data" % encoding)
+    decoded = base64.b64decode(encoded)
+    if encoding == "Z64":
+        decoded = zlib.decompress(decoded)
+    return decoded
+
+
+def decode_graphic_data(data, bytes_per_row):
+    """Decode the data of a ^GFA command, in any supported format"""
+    if data.startswith((":Z64:", ":B64:")):
+        return decode_z64(data)
+    return decode_acs(data, bytes_per_row)
+
+
+class FieldNumber(int):
+    """Number of a variable field in a stored format, printed as ``^FN``
+    instead of the field data"""
+
 
 class Zpl2(object):
     """ZPL II management class
@@ -169,6 +289,18 @@ class Zpl2(object):
         """Adds the label start command to the buffer"""
         self._write_command("^XZ")
 
+    def download_format(self, name):
+        """Start the definition of a format stored in the printer memory"""
+        self._write_command("^DF%s^FS" % name)
+
+    def recall_format(self, name):
+        """Use a format stored in the printer memory"""
+        self._write_command("^XF%s^FS" % name)
+
+    def field_number_data(self, number, data):
+        """Fill a variable field of the recalled format"""
+        self._write_command("^FN%d%s" % (number, self._field_data(data)))
+
     def label_home(self, left, top):
         """Define the label top left corner"""
         self._write_command("^LH%d,%d" % (left, top))
@@ -358,6 +490,9 @@ class Zpl2(object):
 
     def _field_data(self, data):
         """Add data to the buffer, between start and stop commands"""
+        if isinstance(data, FieldNumber):
+            # Variable field of a stored format
+            return "^FN%d%s" % (data, self._field_data_stop())
         command = "{start}{data}{stop}".format(
             start=self._field_data_start(),
             data=data,
@@ -484,6 +619,14 @@ class Zpl2(object):
 
     def graphic_field(self, right, down, pil_image):
         """Encode a PIL image into an ASCII string suitable for ZPL printers"""
+        self.graphic_field_command(right, down, self.graphic_field_data(pil_image))
+
+    def graphic_field_data(self, pil_image, compression=GRAPHIC_COMPRESSION_NONE):
+        """Return the ^GF command of a PIL image, without its position
+
+        The result only depends on the image, it can be reused at any place of
+        any label.
+        """
         width, height = pil_image.size
         rounded_width = int(math.ceil(width / 8.0) * 8)
         # Transform the image :
@@ -494,22 +637,34 @@ class Zpl2(object):
         pil_image = (
             ImageOps.invert(pil_image).convert("1").crop((0, 0, rounded_width, height))
         )
+        if compression in (GRAPHIC_COMPRESSION_ACS, GRAPHIC_COMPRESSION_Z64):
+            bytes_per_row = rounded_width // 8
+            if compression == GRAPHIC_COMPRESSION_ACS:
+                ascii_data = encode_acs(pil_image.tobytes(), bytes_per_row)
+            else:
+                ascii_data = encode_z64(pil_image.tobytes())
+            return "^GFA,{total_bytes},{total_bytes},{bytes_per_row},{data}".format(
+                total_bytes=bytes_per_row * height,
+                bytes_per_row=bytes_per_row,
+                data=ascii_data,
+            )
         # Convert the image to a two-character hexadecimal values string
         ascii_data = binascii.hexlify(pil_image.tobytes()).upper()
         # Each byte is composed of two characters
         bytes_per_row = rounded_width / 8
         total_bytes = bytes_per_row * height
-        graphic_image_command = (
-            "^GFA,{total_bytes},{total_bytes},{bytes_per_row},{ascii_data}".format(
-                total_bytes=total_bytes,
-                bytes_per_row=bytes_per_row,
-                ascii_data=ascii_data,
-            )
+        return "^GFA,{total_bytes},{total_bytes},{bytes_per_row},{ascii_data}".format(
+            total_bytes=total_bytes,
+            bytes_per_row=bytes_per_row,
+            ascii_data=ascii_data,
         )
+
+    def graphic_field_command(self, right, down, graphic_data):
+        """Add a ^GF command returned by graphic_field_data at a position"""
         # Generate the ZPL II command
         command = "{origin}{data}{stop}".format(
             origin=self._field_origin(right, down),
-            data=graphic_image_command,
+            data=graphic_data,
             stop=self._field_data_stop(),
         )
         self._write_command(command)
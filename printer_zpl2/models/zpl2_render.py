@@ -0,0 +1,588 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Rasterize ZPL II labels to images, to preview them without a printer
+
+Only the commands generated by the ``zpl2`` module are supported: the
+other commands are ignored.
+"""
+
+import functools
+import logging
+import os
+
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+
+from . import zpl2
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import reportlab
+    from reportlab.graphics.barcode import code39, code128, common, qrencoder
+except ImportError:
+    _logger.debug("Cannot `import reportlab`.")
+    reportlab = None
+
+# Largest rendered label side, in millimeters (15 inches)
+MAX_LABEL_SIZE = 381
+
+# Rotations of the fields, PIL rotates counter clockwise
+ORIENTATION_TRANSPOSE = {
+    zpl2.ORIENTATION_ROTATED: Image.ROTATE_270,
+    zpl2.ORIENTATION_INVERTED: Image.ROTATE_180,
+    zpl2.ORIENTATION_BOTTOM_UP: Image.ROTATE_90,
+}
+
+# EAN encodings of the digits, the "R" encoding is the inverse of the "L" one,
+# and the "G" encoding is the "R" one reversed
+EAN_L_CODES = [
+    "0001101",
+    "0011001",
+    "0010011",
+    "0111101",
+    "0100011",
+    "0110001",
+    "0101111",
+    "0111011",
+    "0110111",
+    "0001011",
+]
+EAN_R_CODES = [code.translate(str.maketrans("01", "10")) for code in EAN_L_CODES]
+EAN_G_CODES = [code[::-1] for code in EAN_R_CODES]
+# Encodings of the left digits of an EAN-13, depending on its first digit
+EAN_13_PARITIES = [
+    "LLLLLL",
+    "LLGLGG",
+    "LLGGLG",
+    "LLGGGL",
+    "LGLLGG",
+    "LGGLLG",
+    "LGGGLL",
+    "LGLGLG",
+    "LGLGGL",
+    "LGGLGL",
+]
+
+# Two-letter commands, the other commands are identified by their first letter
+TWO_LETTER_COMMANDS = {
+    "BY",
+    "CF",
+    "CI",
+    "DF",
+    "FB",
+    "FD",
+    "FN",
+    "FO",
+    "FR",
+    "FS",
+    "GB",
+    "GC",
+    "GD",
+    "GF",
+    "JU",
+    "LH",
+    "PW",
+    "XA",
+    "XF",
+    "XZ",
+}
+
+
+def _parse_int(value, default=0):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return default
+
+
+def _ean_checksum(digits):
+    total = sum(
+        int(digit) * (3 if index % 2 == 0 else 1)
+        for index, digit in enumerate(reversed(digits))
+    )
+    return str((10 - total % 10) % 10)
+
+
+def encode_ean13(data):
+    """Return the modules (``"1"`` for a bar) of an EAN-13 barcode, and its
+    human readable text"""
+    digits = "".join(char for char in data if char.isdigit())[:12].rjust(12, "0")
+    digits += _ean_checksum(digits)
+    parities = EAN_13_PARITIES[int(digits[0])]
+    modules = "101"
+    for digit, parity in zip(digits[1:7], parities):
+        codes = EAN_L_CODES if parity == "L" else EAN_G_CODES
+        modules += codes[int(digit)]
+    modules += "01010"
+    modules += "".join(EAN_R_CODES[int(digit)] for digit in digits[7:])
+    return modules + "101", digits
+
+
+def encode_ean8(data):
+    """Return the modules of an EAN-8 barcode, and its human readable text"""
+    digits = "".join(char for char in data if char.isdigit())[:7].rjust(7, "0")
+    digits += _ean_checksum(digits)
+    modules = "101"
+    modules += "".join(EAN_L_CODES[int(digit)] for digit in digits[:4])
+    modules += "01010"
+    modules += "".join(EAN_R_CODES[int(digit)] for digit in digits[4:])
+    return modules + "101", digits
+
+
+def _reportlab_modules(barcode, ratio):
+    """Convert the bars computed by a reportlab barcode into modules
+
+    The wide elements are ``ratio`` modules wide.
+    """
+    barcode.validate()
+    barcode.encode()
+    barcode.decompose()
+    wide = max(int(round(ratio)), 2)
+    modules = ""
+    for char in barcode.decomposed:
+        if isinstance(barcode, common.MultiWidthBarcode):
+            # Letters give the width of bars (upper case) and spaces
+            if char.isupper():
+                modules += "1" * (ord(char) - ord("A") + 1)
+            elif char.islower():
+                modules += "0" * (ord(char) - ord("a") + 1)
+        elif char == "b":
+            modules += "1"
+        elif char == "B":
+            modules += "1" * wide
+        elif char in "si":
+            modules += "0"
+        elif char == "S":
+            modules += "0" * wide
+    return modules
+
+
+def encode_linear_barcode(barcode_type, data, ratio=3.0, check_digits=False):
+    """Return the modules of a linear barcode, and its human readable text
+
+    Return ``None`` for the unsupported barcode types.
+    """
+    if barcode_type == "E":
+        return encode_ean13(data)
+    elif barcode_type == "8":
+        return encode_ean8(data)
+    if reportlab is None:
+        return None
+    if barcode_type == "C":
+        barcode = code128.Code128(data, quiet=0)
+    elif barcode_type == "3":
+        barcode = code39.Standard39(
+            data.upper(), quiet=0, checksum=int(bool(check_digits))
+        )
+    elif barcode_type == "2":
+        barcode = common.I2of5(
+            data, quiet=0, bearers=0, checksum=int(bool(check_digits))
+        )
+    elif barcode_type == "1":
+        barcode = common.Code11(data, quiet=0, checksum=2 if check_digits else 0)
+    else:
+        return None
+    return _reportlab_modules(barcode, ratio), data
+
+
+def encode_qr_code(data, error_correction=zpl2.ERROR_CORRECTION_HIGH):
+    """Return the dark modules of a QR Code, as a list of rows of booleans"""
+    if reportlab is None:
+        return None
+    level = getattr(
+        qrencoder.QRErrorCorrectLevel,
+        error_correction,
+        qrencoder.QRErrorCorrectLevel.Q,
+    )
+    qr_code = qrencoder.QRCode(None, level)
+    qr_code.addData(data)
+    qr_code.make()
+    count = qr_code.getModuleCount()
+    return [[qr_code.isDark(row, col) for col in range(count)] for row in range(count)]
+
+
+@functools.lru_cache()
+def _get_font_path():
+    if reportlab is not None:
+        path = os.path.join(os.path.dirname(reportlab.__file__), "fonts", "VeraBd.ttf")
+        if os.path.exists(path):
+            return path
+    return None
+
+
+@functools.lru_cache(maxsize=64)
+def _get_font(size):
+    path = _get_font_path()
+    if path:
+        return ImageFont.truetype(path, size)
+    return ImageFont.load_default()
+
+
+def _text_size(font, text):
+    if hasattr(font, "getbbox"):
+        return font.getbbox(text)[2:]
+    return font.getsize(text)
+
+
+class Zpl2Renderer(object):
+    """Draw the first label of ZPL II data on an image
+
+    :param dpmm: print density, in dots per millimeter
+    :param width: width of the label, in millimeters
+    :param height: height of the label, in millimeters
+    """
+
+    def __init__(self, dpmm, width, height):
+        if not 0 < width <= MAX_LABEL_SIZE or not 0 < height <= MAX_LABEL_SIZE:
+            raise ValueError(
+                "The size of the label must be between 0 and %smm" % MAX_LABEL_SIZE
+            )
+        self.image = Image.new(
+            "L", (int(round(width * dpmm)), int(round(height * dpmm))), 255
+        )
+        self.home = (0, 0)
+        self.default_font = {"height": 9, "width": 5}
+        self.barcode_defaults = {"module_width": 2, "ratio": 3.0, "height": 10}
+        self._reset_field()
+
+    def _reset_field(self):
+        self.field = {"origin": (0, 0), "reverse": False}
+
+    def render(self, data):
+        """Draw the data and return the image"""
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        started = False
+        for command in data.split("^"):
+            command = command.strip("\r\n")
+            name = command[:2].upper()
+            if name not in TWO_LETTER_COMMANDS:
+                name = command[:1].upper()
+            if name == "XA":
+                started = True
+            elif name == "XZ" and started:
+                # Only the first label is rendered
+                break
+            elif started:
+                method = getattr(self, "_command_%s" % name, None)
+                if method:
+                    method(command[len(name) :])
+        return self.image
+
+    def _command_LH(self, args):
+        left, top = (args.split(",") + ["", ""])[:2]
+        self.home = (_parse_int(left), _parse_int(top))
+
+    def _command_FO(self, args):
+        left, top = (args.split(",") + ["", ""])[:2]
+        self.field["origin"] = (
+            self.home[0] + _parse_int(left),
+            self.home[1] + _parse_int(top),
+        )
+
+    def _command_FR(self, args):
+        self.field["reverse"] = True
+
+    def _command_CF(self, args):
+        font, height, width = (args.split(",") + ["", "", ""])[:3]
+        height = _parse_int(height, self.default_font["height"])
+        self.default_font = {"height": height, "width": _parse_int(width, height)}
+
+    def _command_A(self, args):
+        font_name, height, width = (args.split(",") + ["", "", ""])[:3]
+        height = _parse_int(height, self.default_font["height"])
+        self.field["font"] = {
+            "orientation": font_name[1:2] or zpl2.ORIENTATION_NORMAL,
+            "height": height,
+            "width": _parse_int(width, height),
+        }
+
+    def _command_FB(self, args):
+        width, lines, spaces, justify, margin = (args.split(",") + [""] * 5)[:5]
+        self.field["block"] = {
+            "width": _parse_int(width),
+            "lines": max(_parse_int(lines, 1), 1),
+            "spaces": _parse_int(spaces),
+            "justify": justify or zpl2.JUSTIFY_LEFT,
+            "margin": _parse_int(margin),
+        }
+
+    def _command_BY(self, args):
+        module_width, ratio, height = (args.split(",") + ["", "", ""])[:3]
+        defaults = self.barcode_defaults
+        defaults["module_width"] = _parse_int(module_width, defaults["module_width"])
+        try:
+            defaults["ratio"] = float(ratio)
+        except ValueError:
+            pass
+        defaults["height"] = _parse_int(height, defaults["height"])
+
+    def _command_B(self, args):
+        self.field["barcode"] = (args[:1], args[1:].split(","))
+
+    def _command_FD(self, args):
+        self.field["data"] = args
+
+    def _command_GB(self, args):
+        self.field["graphic"] = ("box", args.split(","))
+
+    def _command_GD(self, args):
+        self.field["graphic"] = ("diagonal", args.split(","))
+
+    def _command_GC(self, args):
+        self.field["graphic"] = ("circle", args.split(","))
+
+    def _command_GF(self, args):
+        self.field["graphic"] = ("field", args.split(",", 4))
+
+    def _command_FS(self, args):
+        field = self.field
+        try:
+            if "graphic" in field:
+                self._draw_graphic(*field["graphic"])
+            elif "barcode" in field:
+                self._draw_barcode(*field["barcode"])
+            elif "data" in field:
+                self._draw_text()
+        except Exception:
+            # Like a printer, skip the fields which cannot be printed
+            _logger.debug("Unable to render the field %s", field, exc_info=True)
+        self._reset_field()
+
+    def _paste(self, mask, white=False):
+        """Draw the pixels set in a mask at the origin of the current field"""
+        left, top = self.field["origin"]
+        box = (left, top, left + mask.width, top + mask.height)
+        if self.field["reverse"]:
+            region = self.image.crop(box)
+            self.image.paste(ImageOps.invert(region), box, mask)
+        else:
+            self.image.paste(255 if white else 0, box, mask)
+
+    def _render_text(self, text, height, width):
+        font = _get_font(max(height, 1))
+        text_width, text_height = _text_size(font, text)
+        mask = Image.new("L", (max(text_width, 1), max(height, text_height, 1)), 0)
+        ImageDraw.Draw(mask).text((0, 0), text, fill=255, font=font)
+        if width != height:
+            # Stretch the characters to the requested width
+            mask = mask.resize(
+                (max(int(round(mask.width * width / height)), 1), mask.height)
+            )
+        return mask
+
+    def _draw_text(self):
+        font = self.field.get("font") or dict(
+            self.default_font, orientation=zpl2.ORIENTATION_NORMAL
+        )
+        text = self.field["data"]
+        block = self.field.get("block")
+        if block:
+            mask = self._render_block(text, font, block)
+        else:
+            mask = self._render_text(text, font["height"], font["width"])
+        transpose = ORIENTATION_TRANSPOSE.get(font["orientation"])
+        if transpose is not None:
+            mask = mask.transpose(transpose)
+        self._paste(mask)
+
+    def _render_block(self, text, font, block):
+        line_masks = []
+        for paragraph in text.split("\\&"):
+            words = paragraph.split(" ")
+            line = words.pop(0)
+            for word in words:
+                candidate = "%s %s" % (line, word)
+                candidate_mask = self._render_text(
+                    candidate, font["height"], font["width"]
+                )
+                if candidate_mask.width <= block["width"]:
+                    line = candidate
+                else:
+                    line_masks.append(
+                        self._render_text(line, font["height"], font["width"])
+                    )
+                    line = word
+            line_masks.append(self._render_text(line, font["height"], font["width"]))
+        line_masks = line_masks[: block["lines"]]
+        line_height = font["height"] + block["spaces"]
+        mask = Image.new(
+            "L", (max(block["width"], 1), line_height * len(line_masks)), 0
+        )
+        for index, line_mask in enumerate(line_masks):
+            left = 0
+            if index:
+                left = block["margin"]
+            if block["justify"] == zpl2.JUSTIFY_CENTER:
+                left = (block["width"] - line_mask.width) // 2
+            elif block["justify"] == zpl2.JUSTIFY_RIGHT:
+                left = block["width"] - line_mask.width
+            mask.paste(255, (left, index * line_height), line_mask)
+        return mask
+
+    def _draw_graphic(self, graphic_type, args):
+        draw_method = getattr(self, "_draw_graphic_%s" % graphic_type)
+        draw_method(args + [""] * (5 - len(args)))
+
+    def _draw_graphic_box(self, args):
+        thickness = max(_parse_int(args[2], 1), 1)
+        width = max(_parse_int(args[0], thickness), thickness)
+        height = max(_parse_int(args[1], thickness), thickness)
+        rounding = min(max(_parse_int(args[4]), 0), 8)
+        mask = Image.new("L", (width, height), 0)
+        draw = ImageDraw.Draw(mask)
+        box = [0, 0, width - 1, height - 1]
+        if rounding and hasattr(draw, "rounded_rectangle"):
+            radius = rounding * min(width, height) // 16
+            draw.rounded_rectangle(box, radius=radius, outline=255, width=thickness)
+        else:
+            draw.rectangle(box, outline=255, width=thickness)
+        self._paste(mask, white=args[3] == zpl2.COLOR_WHITE)
+
+    def _draw_graphic_diagonal(self, args):
+        thickness = max(_parse_int(args[2], 1), 1)
+        width = max(_parse_int(args[0], 3), 3)
+        height = max(_parse_int(args[1], 3), 3)
+        mask = Image.new("L", (width, height), 0)
+        if args[4] == zpl2.DIAGONAL_ORIENTATION_LEFT:
+            points = [
+                (0, 0),
+                (thickness, 0),
+                (width, height),
+                (width - thickness, height),
+            ]
+        else:
+            points = [
+                (0, height),
+                (thickness, height),
+                (width, 0),
+                (width - thickness, 0),
+            ]
+        ImageDraw.Draw(mask).polygon(points, fill=255)
+        self._paste(mask, white=args[3] == zpl2.COLOR_WHITE)
+
+    def _draw_graphic_circle(self, args):
+        diameter = max(_parse_int(args[0], 3), 3)
+        thickness = max(_parse_int(args[1], 1), 1)
+        mask = Image.new("L", (diameter, diameter), 0)
+        ImageDraw.Draw(mask).ellipse(
+            [0, 0, diameter - 1, diameter - 1], outline=255, width=thickness
+        )
+        self._paste(mask, white=args[2] == zpl2.COLOR_WHITE)
+
+    def _draw_graphic_field(self, args):
+        bytes_per_row = _parse_int(args[3])
+        if bytes_per_row <= 0:
+            return
+        bitmap = zpl2.decode_graphic_data(args[4], bytes_per_row)
+        height = len(bitmap) // bytes_per_row
+        if not height:
+            return
+        # The dots to print are set in the ZPL II data, like in the mask
+        mask = Image.frombytes(
+            "1", (bytes_per_row * 8, height), bitmap[: bytes_per_row * height]
+        )
+        self._paste(mask.convert("L"))
+
+    def _draw_barcode(self, barcode_type, args):
+        orientation = args[0] or zpl2.ORIENTATION_NORMAL
+        data = self.field.get("data", "")
+        if barcode_type == "Q":
+            mask = self._render_qr_code(args, data)
+        else:
+            mask = self._render_linear_barcode(barcode_type, args, data)
+        transpose = ORIENTATION_TRANSPOSE.get(orientation)
+        if transpose is not None:
+            mask = mask.transpose(transpose)
+        self._paste(mask)
+
+    def _render_qr_code(self, args, data):
+        magnification = max(_parse_int((args + ["", "", ""])[2], 1), 1)
+        error_correction = zpl2.ERROR_CORRECTION_HIGH
+        mode, separator, text = data.partition(",")
+        if separator and len(mode) <= 2:
+            # Error correction and input mode given before the data
+            error_correction = mode[:1] or error_correction
+            data = text
+        rows = encode_qr_code(data, error_correction)
+        if rows is None:
+            return self._render_unsupported(21 * magnification, 21 * magnification)
+        mask = Image.new("L", (len(rows), len(rows)), 0)
+        mask.putdata([255 if dark else 0 for row in rows for dark in row])
+        return mask.resize(
+            (len(rows) * magnification, len(rows) * magnification), Image.NEAREST
+        )
+
+    def _get_barcode_arguments(self, barcode_type, args):
+        """Return the height, interpretation line and check digits flags"""
+        args = args + [""] * 6
+        positions = {
+            # Barcode type: height, interpretation line, above, check digits
+            "1": (2, 3, 4, 1),
+            "2": (1, 2, 3, 4),
+            "3": (2, 3, 4, 1),
+            "8": (1, 2, 3, None),
+            "9": (1, 2, 3, 4),
+            "C": (1, 2, 3, 4),
+            "E": (1, 2, 3, None),
+        }.get(barcode_type, (1, None, None, None))
+        height = _parse_int(args[positions[0]], self.barcode_defaults["height"])
+        # The interpretation line is printed by default
+        interpretation = positions[1] is not None and args[positions[1]] != zpl2.BOOL_NO
+        above = positions[2] is not None and args[positions[2]] == zpl2.BOOL_YES
+        check_digits = positions[3] is not None and args[positions[3]] == zpl2.BOOL_YES
+        return height, interpretation, above, check_digits
+
+    def _render_linear_barcode(self, barcode_type, args, data):
+        module_width = max(self.barcode_defaults["module_width"], 1)
+        height, interpretation, above, check_digits = self._get_barcode_arguments(
+            barcode_type, args
+        )
+        encoded = encode_linear_barcode(
+            barcode_type,
+            data,
+            ratio=self.barcode_defaults["ratio"],
+            check_digits=check_digits,
+        )
+        if not encoded:
+            return self._render_unsupported(
+                max(len(data), 1) * 11 * module_width, height
+            )
+        modules, text = encoded
+        bars = Image.new("L", (len(modules), 1), 0)
+        bars.putdata([255 if module == "1" else 0 for module in modules])
+        bars = bars.resize((len(modules) * module_width, height), Image.NEAREST)
+        if not interpretation:
+            return bars
+        text_height = max(module_width * 9, 10)
+        text_mask = self._render_text(text, text_height, text_height)
+        mask = Image.new(
+            "L", (max(bars.width, text_mask.width), height + text_height), 0
+        )
+        text_left = (mask.width - text_mask.width) // 2
+        if above:
+            mask.paste(255, (text_left, 0), text_mask)
+            mask.paste(bars, (0, text_height))
+        else:
+            mask.paste(bars, (0, 0))
+            mask.paste(255, (text_left, height), text_mask)
+        return mask
+
+    @staticmethod
+    def _render_unsupported(width, height):
+        """Draw a crossed box in place of a barcode which cannot be encoded"""
+        mask = Image.new("L", (max(width, 2), max(height, 2)), 0)
+        draw = ImageDraw.Draw(mask)
+        draw.rectangle([0, 0, mask.width - 1, mask.height - 1], outline=255)
+        draw.line([0, 0, mask.width - 1, mask.height - 1], fill=255)
+        draw.line([0, mask.height - 1, mask.width - 1, 0], fill=255)
+        return mask
+
+
+def render(data, dpmm, width, height):
+    """Render the first label of ZPL II data on an image
+
+    :param dpmm: print density, in dots per millimeter
+    :param width: width of the label, in millimeters
+    :param height: height of the label, in millimeters
+    """
+    return Zpl2Renderer(dpmm, width, height).render(data)
@@ -6,3 +6,4 @@ from . import test_wizard_print_record_label
 from . import test_generate_action
 from . import test_test_mode
 from . import test_wizard_import_zpl2
+from . import test_zpl2_render
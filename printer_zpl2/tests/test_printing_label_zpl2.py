@@ -6,7 +6,7 @@ import mock
 from odoo import exceptions
 from odoo.tests.common import TransactionCase
 
-from ..models import zpl2
+from ..models import printing_label_zpl2, zpl2
 
 model = "odoo.addons.base_report_to_printer.models.printing_server"
 
@@ -61,7 +61,174 @@ class TestPrintingLabelZpl2(TransactionCase):
         """Check that printing an empty label works"""
         label = self.new_label()
         label.print_label(self.printer, self.printer)
-        cups.Connection().printFile.assert_called_once()
+        cups.Connection().createJob.assert_called_once()
+
+    @mock.patch("%s.cups" % model)
+    def test_print_label_batch(self, cups):
+        """Check that the labels of several records are printed in one job"""
+        label = self.new_label()
+        printers = self.printer | self.printer.copy({"name": "Other Printer"})
+        label.print_label(self.printer, printers)
+        connection = cups.Connection()
+        connection.createJob.assert_called_once()
+        data = b"".join(
+            call[0][0] for call in connection.writeRequestData.call_args_list
+        )
+        self.assertEqual(
+            data,
+            label._generate_zpl2_data(printers[0])
+            + label._generate_zpl2_data(printers[1]),
+        )
+
+    @mock.patch("%s.cups" % model)
+    def test_print_label_batch_size(self, cups):
+        """Check that the labels are split in jobs of the batch size"""
+        label = self.new_label({"batch_size": 2})
+        printers = self.printer
+        for index in range(4):
+            printers |= self.printer.copy({"name": "Printer %s" % index})
+        label.print_label(self.printer, printers)
+        self.assertEqual(cups.Connection().createJob.call_count, 3)
+        label.print_label(self.printer, printers, batch_size=0)
+        self.assertEqual(cups.Connection().createJob.call_count, 4)
+
+    @mock.patch("%s.cups" % model)
+    def test_print_label_stored_format(self, cups):
+        """Check that only the variable data is sent with a stored format"""
+        label = self.new_label({"stored_format": True})
+        self.new_component({"label_id": label.id, "data": '"Fixed"'})
+        component = self.new_component(
+            {"label_id": label.id, "data": "object.name", "origin_y": 50}
+        )
+        self.assertEqual(label._get_stored_format_fields(), [component])
+        format_name = label._get_stored_format_name()
+        format_data = (
+            "^XA\n"
+            # Format download
+            "^DF{name}^FS\n"
+            "^PW480\n"
+            "^CI28\n"
+            "^LH10,10\n"
+            # Static component
+            "^FO10,10^A0N,10,10^FDFixed^FS\n"
+            # Variable field
+            "^FO10,50^A0N,10,10^FN1^FS\n"
+            "^XZ".format(name=format_name)
+        )
+        recall_data = (
+            "^XA\n"
+            # Format recall
+            "^XF{name}^FS\n"
+            "^CI28\n"
+            # Variable field data
+            "^FN1^FDPrinter^FS\n"
+            "^JUR\n"
+            "^XZ".format(name=format_name)
+        )
+        connection = cups.Connection()
+
+        def printed_data():
+            data = b"".join(
+                call[0][0] for call in connection.writeRequestData.call_args_list
+            )
+            connection.writeRequestData.reset_mock()
+            return data.decode("utf-8")
+
+        label.print_label(self.printer, self.printer)
+        self.assertEqual(printed_data(), format_data + recall_data)
+        self.assertEqual(label.stored_format_ids.printer_id, self.printer)
+
+        # The format is already stored in the printer
+        label.print_label(self.printer, self.printer)
+        self.assertEqual(printed_data(), recall_data)
+
+        # The format is downloaded again when it changed
+        component.origin_y = 60
+        label.print_label(self.printer, self.printer)
+        self.assertTrue(printed_data().startswith("^XA\n^DF"))
+        label.action_reset_stored_formats()
+        label.print_label(self.printer, self.printer)
+        self.assertTrue(printed_data().startswith("^XA\n^DF"))
+
+    def test_stored_format_name(self):
+        """Check that the stored format names fit in 8 characters"""
+        label = self.new_label()
+        self.assertEqual(label.browse(35)._get_stored_format_name(), "E:ODZ.ZPL")
+        self.assertEqual(label.browse(36)._get_stored_format_name(), "E:OD10.ZPL")
+        self.assertEqual(
+            label.browse(36**6 - 1)._get_stored_format_name(), "E:ODZZZZZZ.ZPL"
+        )
+
+    @mock.patch("%s.cups" % model)
+    def test_print_label_stored_format_failure(self, cups):
+        """Check that the stored format is only recorded once sent"""
+        label = self.new_label({"stored_format": True})
+        self.new_component({"label_id": label.id, "data": "object.name"})
+        cups.Connection().createJob.side_effect = Exception("Printer offline")
+        with self.assertRaises(Exception):
+            label.print_label(self.printer, self.printer)
+        self.assertFalse(label.stored_format_ids)
+
+        cups.Connection().createJob.side_effect = None
+        label.print_label(self.printer, self.printer)
+        self.assertEqual(label.stored_format_ids.printer_id, self.printer)
+        # The printer may have missed the format of an aborted job
+        job = self.env["printing.job"].create(
+            {
+                "name": "Label",
+                "server_id": self.server.id,
+                "printer_id": self.printer.id,
+                "job_id_cups": 1,
+                "job_state": "processing",
+            }
+        )
+        self.assertTrue(label.stored_format_ids)
+        job.job_state = "aborted"
+        self.assertFalse(label.stored_format_ids)
+
+    def test_component_data_names(self):
+        """Check the names used by the data of the components"""
+        label = self.new_label({"stored_format": True})
+        component = self.new_component(
+            {"label_id": label.id, "data": "object.name + ' ' + page_number"}
+        )
+        self.assertEqual(
+            label._get_data_names(component.data), ("object", "name", "page_number")
+        )
+        self.assertEqual(label._get_stored_format_fields(), [component])
+        # The names follow the changes of the data
+        component.data = '"Fixed"'
+        self.assertEqual(label._get_data_names(component.data), ())
+        self.assertEqual(label._get_stored_format_fields(), [])
+        component.data = "object.name +"
+        self.assertIsNone(label._get_stored_format_fields())
+
+    def test_component_data_names_unsaved(self):
+        """Check the stored format fields of unsaved components"""
+        label = self.Model.new(
+            dict(
+                self.label_vals,
+                stored_format=True,
+                component_ids=[(0, 0, dict(self.component_vals, data="object.name"))],
+            )
+        )
+        self.assertEqual(label._get_stored_format_fields(), [label.component_ids])
+
+    def test_stored_format_not_eligible(self):
+        """Check the labels which cannot be stored in the printer"""
+        label = self.new_label({"stored_format": True})
+        self.new_component({"label_id": label.id, "component_type": "rectangle"})
+        self.assertEqual(label._get_stored_format_fields(), [])
+        component = self.new_component(
+            {
+                "label_id": label.id,
+                "component_type": "rectangle",
+                "data": "object.name == 'Printer' and 'component_not_show' or ''",
+            }
+        )
+        self.assertIsNone(label._get_stored_format_fields())
+        component.write({"component_type": "zpl2_raw", "data": '"^FO10,10"'})
+        self.assertIsNone(label._get_stored_format_fields())
 
     def test_empty_label_contents(self):
         """Check contents of an empty label"""
@@ -429,6 +596,42 @@ class TestPrintingLabelZpl2(TransactionCase):
             "^XZ".format(contents=data),
         )
 
+    def test_component_data_compiled_once(self):
+        """Check that the data of a component is only compiled once"""
+        label = self.new_label()
+        component = self.new_component(
+            {"label_id": label.id, "data": "object.name + ' ' + page_number"}
+        )
+        printers = self.printer | self.printer.copy({"name": "Other Printer"})
+        with mock.patch(
+            "odoo.addons.printer_zpl2.models.printing_label_zpl2.safe_eval",
+            wraps=printing_label_zpl2.safe_eval,
+        ) as safe_eval:
+            for printer in printers:
+                contents = label._generate_zpl2_data(printer, page_count=2)
+                self.assertIn(("^FD%s 2^FS" % printer.name).encode(), contents)
+            safe_eval.assert_called_once()
+
+            # The cache is dropped when the component is modified
+            component.data = "object.system_name"
+            contents = label._generate_zpl2_data(self.printer)
+            self.assertIn(b"^FDSys Name^FS", contents)
+            self.assertEqual(safe_eval.call_count, 2)
+
+    def test_component_data_forbidden(self):
+        """Check that the data is checked by safe_eval"""
+        label = self.new_label()
+        self.new_component({"label_id": label.id, "data": "object.__class__"})
+        with self.assertRaises(ValueError):
+            label._generate_zpl2_data(self.printer)
+
+    def test_component_data_error(self):
+        """Check that evaluation errors are reported like safe_eval does"""
+        label = self.new_label()
+        self.new_component({"label_id": label.id, "data": "object.name / 2"})
+        with self.assertRaises(ValueError):
+            label._generate_zpl2_data(self.printer)
+
     def test_reversed_text_label_contents(self):
         """Check contents of a text label"""
         label = self.new_label()
@@ -1074,6 +1277,45 @@ class TestPrintingLabelZpl2(TransactionCase):
             "^XZ",
         )
 
+    def test_graphic_label_contents_compressed(self):
+        """Check contents of compressed image labels"""
+        label = self.new_label({"graphic_compression": zpl2.GRAPHIC_COMPRESSION_ACS})
+        data = "R0lGODlhAQABAIAAAP7//wAAACH5BAAAAAAALAAAAAABAAEAAAICRAEAOw=="
+        self.new_component(
+            {
+                "label_id": label.id,
+                "component_type": "graphic",
+                "data": '"' + data + '"',
+                "height": 10,
+                "width": 10,
+                "reverse_print": 1,
+                "orientation": zpl2.ORIENTATION_ROTATED,
+            }
+        )
+        contents = label._generate_zpl2_data(self.printer).decode("utf-8")
+        self.assertEqual(
+            contents,
+            "^XA\n"
+            "^PW480\n"
+            "^CI28\n"
+            "^LH10,10\n"
+            "^FO10,10^GFA,20,20,2,HFC,:::::::::^FS\n"
+            "^JUR\n"
+            "^XZ",
+        )
+        label.graphic_compression = zpl2.GRAPHIC_COMPRESSION_Z64
+        contents = label._generate_zpl2_data(self.printer).decode("utf-8")
+        self.assertEqual(
+            contents,
+            "^XA\n"
+            "^PW480\n"
+            "^CI28\n"
+            "^LH10,10\n"
+            "^FO10,10^GFA,20,20,2,:Z64:eJz7f+A/BgQAuKYRdw==:4b79^FS\n"
+            "^JUR\n"
+            "^XZ",
+        )
+
     def test_graphic_label_contents_blank_inverted(self):
         """Check contents of a image inverted label"""
         label = self.new_label()
@@ -1122,6 +1364,28 @@ class TestPrintingLabelZpl2(TransactionCase):
             "^XZ",
         )
 
+    def test_graphic_data_cache(self):
+        """Check that a graphic is converted once for all the labels"""
+        label = self.new_label()
+        data = "R0lGODlhAQABAIAAAP7//wAAACH5BAAAAAAALAAAAAABAAEAAAICRAEAOw=="
+        component = self.new_component(
+            {
+                "label_id": label.id,
+                "component_type": "graphic",
+                "data": '"' + data + '"',
+            }
+        )
+        printing_label_zpl2._graphic_cache.clear()
+        image = printing_label_zpl2.Image
+        with mock.patch.object(image, "open", wraps=image.open) as image_open:
+            contents = label._generate_zpl2_data(self.printer)
+            self.assertEqual(label._generate_zpl2_data(self.printer), contents)
+            image_open.assert_called_once()
+            # Another orientation is converted again
+            component.orientation = zpl2.ORIENTATION_ROTATED
+            label._generate_zpl2_data(self.printer)
+            self.assertEqual(image_open.call_count, 2)
+
     def test_zpl2_raw_contents_blank(self):
         """Check contents of a image label"""
         label = self.new_label()
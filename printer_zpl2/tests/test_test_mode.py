@@ -4,6 +4,8 @@ import mock
 
 from odoo.tests.common import TransactionCase
 
+from ..models import printing_label_zpl2
+
 model = "odoo.addons.base_report_to_printer.models.printing_server"
 
 
@@ -52,7 +54,7 @@ class TestWizardPrintRecordLabel(TransactionCase):
         self.label.printer_id = self.printer
         self.label.record_id = 10
         self.label.print_test_label()
-        cups.Connection().printFile.assert_called_once()
+        cups.Connection().createJob.assert_called_once()
 
     def test_emulation_without_params(self):
         """Check if not execute next if not in this mode"""
@@ -92,3 +94,40 @@ class TestWizardPrintRecordLabel(TransactionCase):
             {"name": "ZPL II Label", "label_id": self.label.id, "data": '"good_data"'}
         )
         self.assertTrue(self.label.labelary_image)
+
+    def test_emulation_cache(self):
+        """Check that the emulated images are cached"""
+        self.label.test_labelary_mode = True
+        self.label.labelary_width = 80
+        self.label.labelary_height = 30
+        self.label.labelary_dpmm = "8dpmm"
+        self.env["printing.label.zpl2.component"].create(
+            {"name": "ZPL II Label", "label_id": self.label.id, "data": '"good_data"'}
+        )
+        printing_label_zpl2._preview_cache.clear()
+        render = printing_label_zpl2.zpl2_render.render
+        with mock.patch.object(
+            printing_label_zpl2.zpl2_render, "render", wraps=render
+        ) as mock_render:
+            image = self.label._generate_labelary_image()
+            self.assertEqual(self.label._generate_labelary_image(), image)
+            mock_render.assert_called_once()
+            # The image is shared with the other workers
+            printing_label_zpl2._preview_cache.clear()
+            self.assertEqual(self.label._generate_labelary_image(), image)
+            mock_render.assert_called_once()
+            # The emulation settings are part of the key
+            self.label.labelary_dpmm = "12dpmm"
+            self.assertNotEqual(self.label._generate_labelary_image(), image)
+            self.assertEqual(mock_render.call_count, 2)
+
+        attachments = self.env["ir.attachment"].search(
+            [
+                ("res_model", "=", "printing.label.zpl2"),
+                ("name", "=like", "printer_zpl2_preview_%"),
+            ]
+        )
+        self.assertEqual(len(attachments), 2)
+        self.env["ir.config_parameter"].set_param("printer_zpl2.preview_cache_count", 1)
+        self.label._gc_labelary_images()
+        self.assertEqual(len(attachments.exists()), 1)
@@ -93,3 +93,22 @@ class TestWizardImportZpl2(TransactionCase):
         wizard = self.env["wizard.import.zpl2"].create(vals)
         wizard.import_zpl2()
         self.assertEqual(2, len(self.label.component_ids))
+
+    def test_wizard_import_zpl2_compressed_graphics(self):
+        """Import compressed graphics from wizard"""
+        zpl_data = (
+            "^XA\n"
+            "^FO10,10^GFA,20,20,2,HFC,:::::::::^FS\n"
+            "^FO10,60^GFA,20,20,2,:Z64:eJz7f+A/BgQAuKYRdw==:4b79^FS\n"
+            "^XZ"
+        )
+
+        vals = {"label_id": self.label.id, "delete_component": True, "data": zpl_data}
+        wizard = self.env["wizard.import.zpl2"].create(vals)
+        wizard.import_zpl2()
+        self.assertEqual(2, len(self.label.component_ids))
+        for component in self.label.component_ids:
+            self.assertEqual(component.component_type, "graphic")
+            self.assertEqual((component.width, component.height), (16, 10))
+        images = self.label.component_ids.mapped("graphic_image")
+        self.assertEqual(images[0], images[1])
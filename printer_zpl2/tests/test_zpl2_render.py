@@ -0,0 +1,60 @@
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo.tests.common import TransactionCase
+
+from ..models import zpl2, zpl2_render
+
+
+class TestZpl2Render(TransactionCase):
+    def render(self, *commands):
+        data = "^XA\n^LH10,10\n%s\n^XZ" % "\n".join(commands)
+        return zpl2_render.render(data, 8, 10, 10)
+
+    def test_render_size(self):
+        """Check the size of the rendered label"""
+        image = zpl2_render.render("^XA^XZ", 8, 10, 5)
+        self.assertEqual(image.size, (80, 40))
+        self.assertEqual(image.getextrema(), (255, 255))
+        with self.assertRaises(ValueError):
+            zpl2_render.render("^XA^XZ", 8, 10, 10000000)
+
+    def test_render_box(self):
+        """Check the rendering of a box"""
+        image = self.render("^FO10,10^GB20,20,2,B,0^FS")
+        # The origin is relative to the label home
+        self.assertEqual(image.getpixel((20, 20)), 0)
+        self.assertEqual(image.getpixel((21, 21)), 0)
+        self.assertEqual(image.getpixel((25, 25)), 255)
+        self.assertEqual(image.getpixel((19, 19)), 255)
+        # Reverse print inverts the pixels below the field
+        image = self.render("^FO0,0^GB40,40,40,B,0^FS", "^FO10,10^GB20,20,20^FR^FS")
+        self.assertEqual(image.getpixel((15, 15)), 0)
+        self.assertEqual(image.getpixel((25, 25)), 255)
+
+    def test_render_graphic_field(self):
+        """Check the rendering of a graphic field, in any encoding"""
+        for graphic_data in ("F0F0", "F0:", zpl2.encode_z64(b"\xf0\xf0")):
+            image = self.render("^FO0,0^GFA,2,2,1,%s^FS" % graphic_data)
+            self.assertEqual(image.getpixel((13, 11)), 0)
+            self.assertEqual(image.getpixel((14, 11)), 255)
+            self.assertEqual(image.getpixel((13, 12)), 255)
+
+    def test_render_text_and_barcodes(self):
+        """Check that texts and barcodes are drawn"""
+        for command in (
+            "^FO0,0^A0N,20,20^FDText^FS",
+            "^FO0,0^A0R,20,20^FB50,2,0,C,0^FDText in a block^FS",
+            "^BY2,3.0^FO0,0^BCN,20,N,N,N^FD12345^FS",
+            "^BY2,3.0^FO0,0^BEN,20,Y,N^FD400638133393^FS",
+            "^BY2,3.0^FO0,0^BQN,2,2,Q,7^FDQA,12345^FS",
+        ):
+            image = self.render(command)
+            self.assertEqual(image.getextrema(), (0, 255), command)
+
+    def test_encode_ean13(self):
+        """Check the encoding of EAN-13 barcodes"""
+        modules, text = zpl2_render.encode_ean13("400638133393")
+        self.assertEqual(text, "4006381333931")
+        self.assertEqual(len(modules), 95)
+        self.assertTrue(modules.startswith("1010001101"))
+        self.assertTrue(modules.endswith("1100110101"))
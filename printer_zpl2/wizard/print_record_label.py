@@ -53,6 +53,5 @@ class PrintRecordLabel(models.TransientModel):
     def print_label(self):
         """Prints a label per selected record"""
         record_model = self.env.context["active_model"]
-        for record_id in self.env.context["active_ids"]:
-            record = self.env[record_model].browse(record_id)
-            self.label_id.print_label(self.printer_id, record)
+        records = self.env[record_model].browse(self.env.context["active_ids"])
+        self.label_id.print_label(self.printer_id, records)
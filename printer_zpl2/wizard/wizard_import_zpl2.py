@@ -2,10 +2,8 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 import base64
-import binascii
 import io
 import logging
-import re
 
 from PIL import Image, ImageOps
 
@@ -271,14 +269,15 @@ def _graphic_field(data):
             "bytes_per_row",
             "ascii_data",
         ]
-        vals.update(_compute_arg(data[3:], args))
+        # The compressed data can contain commas
+        vals.update(dict(zip(args, data[3:].split(",", len(args) - 1))))
 
         # Image
-        rawData = re.sub("[^A-F0-9]+", "", vals["ascii_data"])
-        rawData = binascii.unhexlify(rawData)
+        bytes_per_row = int(float(vals["bytes_per_row"]))
+        rawData = zpl2.decode_graphic_data(vals["ascii_data"], bytes_per_row)
 
-        width = int(float(vals["bytes_per_row"]) * 8)
-        height = int(float(vals["total_bytes"]) / width) * 8
+        width = bytes_per_row * 8
+        height = len(rawData) // bytes_per_row
 
         img = Image.frombytes("1", (width, height), rawData, "raw").convert("L")
         img = ImageOps.invert(img)
@@ -7,6 +7,12 @@ from odoo import models
 class IrActionsReport(models.Model):
     _inherit = "ir.actions.report"
 
+    def _get_behaviour_cache_key(self):
+        return super()._get_behaviour_cache_key() + (
+            self.remote.id,
+            self.env.context.get("printer_usage", "standard"),
+        )
+
     def _get_user_default_print_behaviour(self):
         res = super()._get_user_default_print_behaviour()
         if res.get("action", "unknown") == "remote_default":
@@ -33,6 +33,23 @@ class ResRemotePrinter(models.Model):
         )
     ]
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        remote_printers = super().create(vals_list)
+        # Drop the cached print behaviours
+        self.clear_caches()
+        return remote_printers
+
+    def write(self, vals):
+        res = super().write(vals)
+        self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.clear_caches()
+        return res
+
     @api.onchange("printer_id")
     def _onchange_printing_printer_id(self):
         """Reset the tray when the printer is changed"""